@@ -0,0 +1,154 @@
+# app/admission.py
+"""
+准入控制 / 削峰 (按路由类别)
+每一类请求有独立的并发上限和有界等待队列：
+- checkin  签到/签退/状态查询，优先级最高，容量最大
+- auth     发送验证码、登录、刷新令牌
+- bulk     Excel/CSV 导出、汇总报表、二维码渲染，优先级最低
+- default  其余 API
+队列已满、等待超时，或更高优先级的类别正在排队时 (低优先级请求让路)，
+立即返回 503 + Retry-After，而不是让请求在 worker 上堆积。
+流式响应 (导出) 在整个响应发送完毕后才释放名额。
+"""
+
+import asyncio
+import json
+import re
+
+from .config import settings
+
+
+class RouteClass:
+    def __init__(self, name: str, priority: int, max_concurrent: int, max_queue: int,
+                 queue_timeout: float, retry_after: int):
+        self.name = name
+        self.priority = priority            # 数字越大越优先
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+        self._semaphore = None
+
+    def semaphore(self) -> asyncio.Semaphore:
+        # 在事件循环中惰性创建
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        return self._semaphore
+
+    def stats(self) -> dict:
+        return {
+            "priority": self.priority,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "queue_depth": self.waiting,
+            "admitted": self.admitted,
+            "shed": self.shed,
+        }
+
+
+ROUTE_CLASSES = {
+    "checkin": RouteClass("checkin", priority=3, max_concurrent=64, max_queue=512, queue_timeout=5.0, retry_after=1),
+    "auth": RouteClass("auth", priority=2, max_concurrent=16, max_queue=64, queue_timeout=3.0, retry_after=2),
+    "default": RouteClass("default", priority=1, max_concurrent=32, max_queue=128, queue_timeout=3.0, retry_after=2),
+    "bulk": RouteClass("bulk", priority=0, max_concurrent=2, max_queue=4, queue_timeout=10.0, retry_after=10),
+}
+
+# (方法, 路径正则, 类别)，按顺序匹配
+ROUTE_RULES = [
+    ("POST", re.compile(r"^/api/participant/(checkin-auth|checkout-auth)$"), "checkin"),
+    ("GET", re.compile(r"^/api/participant/status$"), "checkin"),
+    ("POST", re.compile(r"^/api/admin/activities/[^/]+/batch-checkin$"), "checkin"),
+    ("POST", re.compile(r"^/api/participant/(send-code|login|refresh)$"), "auth"),
+    ("POST", re.compile(r"^/api/admin/(login|refresh)$"), "auth"),
+    ("GET", re.compile(r"^/api/admin/activities/[^/]+/(export|qr)$"), "bulk"),
+    ("POST", re.compile(r"^/api/admin/activities/[^/]+/exports$"), "bulk"),
+    ("GET", re.compile(r"^/api/admin/exports/[^/]+(/download)?$"), "bulk"),
+    ("GET", re.compile(r"^/api/admin/activities/[^/]+/heatmap$"), "bulk"),
+    ("GET", re.compile(r"^/api/admin/report$"), "bulk"),
+    ("GET", re.compile(r"^/api/participant/activity/[^/]+/qr$"), "bulk"),
+]
+
+
+def classify(method: str, path: str):
+    """返回请求所属的类别；静态文件等非 API 请求返回 None (不做准入控制)"""
+    if not path.startswith("/api/"):
+        return None
+    for rule_method, pattern, name in ROUTE_RULES:
+        if method == rule_method and pattern.match(path):
+            return ROUTE_CLASSES[name]
+    return ROUTE_CLASSES["default"]
+
+
+def _higher_priority_waiting(route_class: RouteClass) -> bool:
+    return any(other.waiting > 0 for other in ROUTE_CLASSES.values()
+               if other.priority > route_class.priority)
+
+
+async def _admit(route_class: RouteClass) -> bool:
+    semaphore = route_class.semaphore()
+    if not semaphore.locked():
+        await semaphore.acquire()  # 有空闲名额时不会挂起
+        return True
+    if route_class.waiting >= route_class.max_queue or _higher_priority_waiting(route_class):
+        return False
+    route_class.waiting += 1
+    try:
+        await asyncio.wait_for(semaphore.acquire(), route_class.queue_timeout)
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        route_class.waiting -= 1
+    return True
+
+
+def snapshot() -> dict:
+    """各类别的并发数、队列深度与累计削峰次数 (供监控拉取)"""
+    return {name: route_class.stats() for name, route_class in ROUTE_CLASSES.items()}
+
+
+class AdmissionControlMiddleware:
+    """纯 ASGI 中间件，名额一直占用到响应 (包括流式响应) 发送完毕"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.ADMISSION_CONTROL_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        route_class = classify(scope["method"], scope["path"])
+        if route_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        if not await _admit(route_class):
+            route_class.shed += 1
+            await self._reject(route_class, send)
+            return
+
+        route_class.admitted += 1
+        route_class.active += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            route_class.active -= 1
+            route_class.semaphore().release()
+
+    @staticmethod
+    async def _reject(route_class: RouteClass, send):
+        body = json.dumps({"detail": "服务器繁忙，请稍后重试"}, ensure_ascii=False).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(route_class.retry_after).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
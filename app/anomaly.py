@@ -0,0 +1,204 @@
+# app/anomaly.py
+"""
+可疑签到检测 (进程内流式)
+签到成功后只把 (活动, 学生, 坐标, IP, 时间) 非阻塞地放入有界队列，签到路径上不做任何计算；
+后台线程按活动维护 ANOMALY_WINDOW_SECONDS 的滑动窗口，每条事件只做常数次字典/队列操作：
+- same_location：窗口内多名学生上报完全相同的坐标 (真实 GPS 总有抖动，常见于改定位/代签脚本)
+- shared_ip：窗口内同一 IP 为多名学生签到 (一部手机替多人签到)
+- rapid_succession：同一 IP 上不同学生的签到间隔都不超过 ANOMALY_BURST_GAP_SECONDS，连续多人
+命中的签到记录在 check_logs.anomaly 中追加标记 (逗号分隔)，管理员在活动签到详情中可见。
+标记只是提示，不拒绝签到。队列满时丢弃事件并计数；多 worker 部署时各 worker 只看到自己处理的签到。
+"""
+
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+
+from . import db_utils
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+QUEUE_SIZE = 10000
+# 同时跟踪的活动数与每个活动窗口内保留的事件数上限
+MAX_ACTIVITIES = 2000
+MAX_EVENTS_PER_ACTIVITY = 5000
+FLUSH_BATCH = 200
+# 坐标取 6 位小数 (约 0.1 米) 视为"完全相同"
+COORD_DECIMALS = 6
+
+REASONS = {
+    "same_location": "多人坐标完全相同",
+    "shared_ip": "同一 IP 多人签到",
+    "rapid_succession": "同一 IP 连续快速签到",
+}
+
+
+class _Window:
+    """单个活动的滑动窗口；只由后台线程访问"""
+    __slots__ = ("events", "coords", "ips", "bursts", "flagged")
+
+    def __init__(self):
+        self.events = deque()   # (时间, 坐标键, IP, participant_id)
+        self.coords = {}        # 坐标键 -> {participant_id}
+        self.ips = {}           # IP -> {participant_id}
+        self.bursts = {}        # IP -> [上一次签到时间, deque(participant_id)]
+        self.flagged = set()    # (participant_id, reason)
+
+    def expire(self, before: float):
+        # 每个事件只入队、出队各一次，均摊 O(1)
+        events = self.events
+        while events and (events[0][0] < before or len(events) > MAX_EVENTS_PER_ACTIVITY):
+            _, key, ip, p_id = events.popleft()
+            _discard(self.coords, key, p_id)
+            if ip is not None and _discard(self.ips, ip, p_id):
+                self.bursts.pop(ip, None)
+
+    def flag(self, members, p_id: int, threshold: int, reason: str) -> list:
+        """刚达到阈值时补标此前的成员 (至多 threshold 个)，之后只标新来的"""
+        if len(members) < threshold:
+            return []
+        targets = list(members) if len(members) == threshold else [p_id]
+        result = []
+        for member in targets:
+            if (member, reason) not in self.flagged:
+                self.flagged.add((member, reason))
+                result.append((member, reason))
+        return result
+
+
+def _discard(index: dict, key, p_id: int) -> bool:
+    """从索引中移除成员，键已清空时删除并返回 True"""
+    members = index.get(key)
+    if members is None:
+        return False
+    members.discard(p_id)
+    if not members:
+        del index[key]
+        return True
+    return False
+
+
+class AnomalyDetector:
+    def __init__(self):
+        self._queue = queue.Queue(QUEUE_SIZE)
+        self._windows = OrderedDict()  # activity_id -> _Window (LRU)
+        self._thread = None
+        self.dropped = 0
+        self.flagged = 0
+
+    def start(self):
+        if self._thread is not None or not settings.ANOMALY_DETECTION_ENABLED:
+            return
+        self._thread = threading.Thread(target=self._run, name="anomaly", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """处理完队列中剩余的事件后停止"""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+        self._thread = None
+
+    def observe(self, admin_id: int, activity_id: int, participant_id: int,
+                latitude: float, longitude: float, ip: str = None):
+        """签到成功后调用；不阻塞，未启动或队列已满时直接返回"""
+        if self._thread is None:
+            return
+        try:
+            self._queue.put_nowait(
+                (admin_id, activity_id, participant_id, latitude, longitude, ip, time.time())
+            )
+        except queue.Full:
+            self.dropped += 1
+
+    def stats(self) -> dict:
+        return {
+            "activities": len(self._windows),
+            "queued": self._queue.qsize(),
+            "dropped": self.dropped,
+            "flagged": self.flagged,
+        }
+
+    # --- 后台线程 ---
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            if event is None:
+                return
+            flags = []
+            # 顺带取走已排队的事件，标记攒成一批写库
+            while event is not None:
+                try:
+                    flags.extend(self._process(event))
+                except Exception:
+                    logger.exception("可疑签到检测处理失败")
+                if len(flags) >= FLUSH_BATCH:
+                    break
+                try:
+                    event = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if flags:
+                self._flush(flags)
+            if event is None:
+                return
+
+    def _window(self, activity_id: int) -> _Window:
+        window = self._windows.get(activity_id)
+        if window is None:
+            window = self._windows[activity_id] = _Window()
+            while len(self._windows) > MAX_ACTIVITIES:
+                self._windows.popitem(last=False)
+        else:
+            self._windows.move_to_end(activity_id)
+        return window
+
+    def _process(self, event) -> list:
+        """返回 [(admin_id, activity_id, participant_id, reason), ...]"""
+        admin_id, activity_id, p_id, latitude, longitude, ip, ts = event
+        window = self._window(activity_id)
+        window.expire(ts - settings.ANOMALY_WINDOW_SECONDS)
+
+        key = (round(float(latitude), COORD_DECIMALS), round(float(longitude), COORD_DECIMALS))
+        window.events.append((ts, key, ip, p_id))
+        found = []
+
+        members = window.coords.setdefault(key, set())
+        members.add(p_id)
+        if settings.ANOMALY_SAME_COORD_STUDENTS:
+            found += window.flag(members, p_id, settings.ANOMALY_SAME_COORD_STUDENTS, "same_location")
+
+        if ip is not None:
+            members = window.ips.setdefault(ip, set())
+            members.add(p_id)
+            if settings.ANOMALY_IP_STUDENTS:
+                found += window.flag(members, p_id, settings.ANOMALY_IP_STUDENTS, "shared_ip")
+
+            if settings.ANOMALY_BURST_STUDENTS:
+                burst = window.bursts.get(ip)
+                if burst is None or ts - burst[0] > settings.ANOMALY_BURST_GAP_SECONDS:
+                    burst = window.bursts[ip] = [ts, deque(maxlen=settings.ANOMALY_BURST_STUDENTS)]
+                burst[0] = ts
+                burst[1].append(p_id)
+                found += window.flag(burst[1], p_id, settings.ANOMALY_BURST_STUDENTS, "rapid_succession")
+
+        return [(admin_id, activity_id, member, reason) for member, reason in found]
+
+    def _flush(self, flags: list):
+        by_admin = {}
+        for admin_id, activity_id, p_id, reason in flags:
+            by_admin.setdefault(admin_id, []).append((activity_id, p_id, reason))
+        for admin_id, rows in by_admin.items():
+            try:
+                with db_utils.get_tenant_connection(admin_id) as db:
+                    db_utils.flag_check_logs(db, rows)
+                self.flagged += len(rows)
+            except Exception:
+                logger.exception("写入可疑签到标记失败 (admin_id=%s, %d 条)", admin_id, len(rows))
+
+
+detector = AnomalyDetector()
@@ -0,0 +1,170 @@
+# app/cache.py
+"""
+进程内缓存
+- activity_cache：按活动码缓存活动行，签到路径与公开详情接口优先读取
+- detail_cache：公开活动详情接口的响应，按活动码缓存已序列化的 JSON 字节与 ETag/Last-Modified
+- wgs_center：活动中心 GCJ02 -> WGS84 的转换结果 (按坐标缓存，坐标变化自然失效)
+修改/删除活动时经由 cache_bus 广播 "activity:<code>"，各节点调用 invalidate_activity
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timezone
+from decimal import Decimal
+from email.utils import format_datetime
+from functools import lru_cache
+
+try:
+    import orjson
+except ImportError:  # 未安装时回退到标准库 json
+    orjson = None
+
+from . import coord_utils
+from . import db_utils
+
+ACTIVITY_CACHE_TTL = 60
+ACTIVITY_CACHE_SIZE = 5000
+
+
+class TTLCache:
+    """
+    带过期时间的 LRU 缓存 (线程安全)
+    失效时记录版本号 (墓碑)：版本早于墓碑的写入会被丢弃，
+    防止 "读库 -> 其他节点修改并广播失效 -> 把旧值写回缓存" 这类乱序
+    """
+
+    TOMBSTONE_SIZE = 10000
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()        # key -> (expires_at, value)
+        self._tombstones = OrderedDict()  # key -> 失效版本号
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, ttl: float = None, version: int = None):
+        """version 为读取数据前取得的版本号 (time.time_ns())，早于最近一次失效则不写入"""
+        expires_at = time.monotonic() + (ttl if ttl is not None else self.ttl)
+        with self._lock:
+            if version is not None and self._tombstones.get(key, -1) >= version:
+                return False
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def invalidate(self, key, version: int):
+        """按版本失效：删除条目并记录墓碑"""
+        with self._lock:
+            self._data.pop(key, None)
+            if self._tombstones.get(key, -1) < version:
+                self._tombstones[key] = version
+                self._tombstones.move_to_end(key)
+                while len(self._tombstones) > self.TOMBSTONE_SIZE:
+                    self._tombstones.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+activity_cache = TTLCache(ACTIVITY_CACHE_TTL, ACTIVITY_CACHE_SIZE)
+detail_cache = TTLCache(ACTIVITY_CACHE_TTL, ACTIVITY_CACHE_SIZE)
+
+# body: JSON 字节；modified_at: 活动最后修改时间 (本地时间，精确到秒)
+ActivityDetail = namedtuple("ActivityDetail", "body etag modified_at last_modified")
+DETAIL_FIELDS = ("name", "location_name", "start_time", "end_time", "latitude", "longitude", "radius_meters")
+
+
+def get_activity(db, code: str):
+    """按活动码读取活动：命中缓存时不访问数据库"""
+    activity = activity_cache.get(code)
+    if activity is None:
+        version = time.time_ns()
+        activity = db_utils.get_activity_by_code(db, code)
+        if activity is not None:
+            activity_cache.set(code, activity, version=version)
+    return activity
+
+
+def load_activity(code: str):
+    """同 get_activity，但只在缓存未命中时才建立数据库连接"""
+    activity = activity_cache.get(code)
+    if activity is None:
+        with db_utils.get_activity_connection(code) as db:
+            activity = get_activity(db, code)
+    return activity
+
+
+def invalidate_activity(code: str, version: int = None):
+    version = version if version is not None else time.time_ns()
+    activity_cache.invalidate(code, version)
+    detail_cache.invalidate(code, version)
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def dumps(value) -> bytes:
+    """与 FastAPI 默认编码结果一致 (datetime -> ISO 8601，Decimal -> 数字)，优先使用 orjson"""
+    if orjson is not None:
+        return orjson.dumps(value, default=_json_default)
+    return json.dumps(value, default=_json_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def build_detail(activity) -> ActivityDetail:
+    body = dumps({field: activity[field] for field in DETAIL_FIELDS})
+    # 旧库没有 updated_at 列时退回创建时间 (此时仍以 ETag 为准)
+    modified_at = (activity.get('updated_at') or activity.get('created_at') or datetime.now()).replace(microsecond=0)
+    return ActivityDetail(
+        body=body,
+        etag=f'"{hashlib.sha1(body).hexdigest()[:20]}"',
+        modified_at=modified_at,
+        last_modified=format_datetime(modified_at.astimezone(timezone.utc), usegmt=True),
+    )
+
+
+def get_activity_detail(code: str):
+    """公开活动详情的预序列化响应；两级缓存都命中时不访问数据库，也不做 JSON 编码"""
+    detail = detail_cache.get(code)
+    if detail is None:
+        version = time.time_ns()
+        activity = load_activity(code)
+        if activity is None:
+            return None
+        detail = build_detail(activity)
+        detail_cache.set(code, detail, version=version)
+    return detail
+
+
+@lru_cache(maxsize=4096)
+def wgs_center(lon: float, lat: float) -> tuple:
+    """活动中心 (GCJ02) 转 WGS84，返回 (lon, lat)"""
+    return tuple(coord_utils.gcj2wgs(lon, lat))
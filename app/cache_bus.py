@@ -0,0 +1,328 @@
+# app/cache_bus.py
+"""
+跨节点缓存失效总线
+修改数据的节点发布精确的键 (如 "activity:<code>"、"report:<admin_id>")，
+所有节点 (包括自己) 收到后驱逐对应的本地缓存。
+
+- 每条消息携带发布节点 id 和该节点单调递增的序号；同一 (节点, 键) 上序号不大于已处理序号的重复消息直接丢弃。
+  不同节点的消息之间不去重，也不比较各自的时钟 (节点间时钟偏差会让较晚的失效被误丢)
+- 处理器收到的版本号是本节点处理时的 time.time_ns()，与本节点读库前取得的版本同一时钟，
+  再传给 TTLCache.invalidate，防止失效前读出的旧值被写回缓存
+- 订阅时标记 blocking=True 的处理器 (如需要查库的) 交给总线的后台线程按顺序执行，发布时不占用事件循环；
+  普通处理器 (只驱逐内存缓存) 仍在发布时立即执行，保证本节点随后的读取看到新数据
+- 后端：
+  * local  进程内广播 (单进程部署 / 本地调试)
+  * redis  Redis 协议 (RESP) 的 PUBLISH/SUBSCRIBE，任何兼容的服务或本地替身都可以
+- 远端发布在后台线程中进行，不阻塞请求；订阅连接断开重连后，可能漏掉消息，因此清空全部本地缓存
+"""
+
+import itertools
+import json
+import logging
+import queue
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from urllib.parse import urlparse, unquote
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+SEEN_SIZE = 10000
+RECONNECT_DELAY_SECONDS = 1.0
+MAX_RECONNECT_DELAY_SECONDS = 30.0
+
+
+# ==================================================
+# 后端
+# ==================================================
+
+class LocalBackend:
+    """进程内后端：同一进程中的所有总线实例互相广播"""
+
+    _subscribers = []
+    _lock = threading.Lock()
+
+    def start(self, on_message, on_resync):
+        with LocalBackend._lock:
+            LocalBackend._subscribers.append(on_message)
+        self._on_message = on_message
+
+    def publish(self, payload: bytes):
+        with LocalBackend._lock:
+            subscribers = list(LocalBackend._subscribers)
+        for deliver in subscribers:
+            deliver(payload)
+
+    def stop(self):
+        with LocalBackend._lock:
+            if self._on_message in LocalBackend._subscribers:
+                LocalBackend._subscribers.remove(self._on_message)
+
+
+class _RespConnection:
+    """极简 RESP 客户端，只实现总线需要的命令"""
+
+    def __init__(self, host: str, port: int, password: str = None, timeout: float = None):
+        self.sock = socket.create_connection((host, port), timeout=5)
+        self.sock.settimeout(timeout)
+        self.reader = self.sock.makefile("rb")
+        if password:
+            self.command(b"AUTH", password.encode())
+
+    def send(self, *parts: bytes):
+        out = [b"*%d\r\n" % len(parts)]
+        for part in parts:
+            out.append(b"$%d\r\n%s\r\n" % (len(part), part))
+        self.sock.sendall(b"".join(out))
+
+    def read(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest
+        if kind == b"-":
+            raise ConnectionError(rest.decode(errors="replace"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            return [self.read() for _ in range(int(rest))]
+        raise ConnectionError(f"unexpected reply {line!r}")
+
+    def command(self, *parts: bytes):
+        self.send(*parts)
+        return self.read()
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RedisBackend:
+    """
+    Redis 协议 pub/sub 后端
+    一个订阅线程 (SUBSCRIBE 后阻塞读取) + 一个发布线程 (消费本地队列，PUBLISH)
+    """
+
+    def __init__(self, url: str, channel: str):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.channel = channel.encode()
+        self._outbox = queue.Queue(maxsize=10000)
+        self._stopping = threading.Event()
+        self._threads = []
+        self._sub_conn = None
+
+    def start(self, on_message, on_resync):
+        self._on_message = on_message
+        self._on_resync = on_resync
+        for target, name in ((self._subscribe_loop, "cache-bus-sub"), (self._publish_loop, "cache-bus-pub")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def publish(self, payload: bytes):
+        try:
+            self._outbox.put_nowait(payload)
+        except queue.Full:
+            logger.warning("缓存失效消息积压，丢弃一条广播")
+
+    def _subscribe_loop(self):
+        delay = RECONNECT_DELAY_SECONDS
+        first = True
+        while not self._stopping.is_set():
+            try:
+                conn = _RespConnection(self.host, self.port, self.password)
+                self._sub_conn = conn
+                conn.command(b"SUBSCRIBE", self.channel)
+                if not first:
+                    # 断线期间可能漏掉消息，保守地清空本地缓存
+                    self._on_resync()
+                first = False
+                delay = RECONNECT_DELAY_SECONDS
+                while not self._stopping.is_set():
+                    reply = conn.read()
+                    if isinstance(reply, list) and len(reply) == 3 and reply[0] == b"message":
+                        self._on_message(reply[2])
+            except Exception as e:
+                if self._stopping.is_set():
+                    break
+                logger.warning("缓存失效总线订阅断开，%.0f 秒后重连: %s", delay, e)
+                self._stopping.wait(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY_SECONDS)
+            finally:
+                if self._sub_conn is not None:
+                    self._sub_conn.close()
+                    self._sub_conn = None
+
+    def _publish_loop(self):
+        conn = None
+        # 停止时先把已排队的消息发完
+        while not self._stopping.is_set() or not self._outbox.empty():
+            try:
+                payload = self._outbox.get(timeout=1)
+            except queue.Empty:
+                continue
+            for _ in range(2):
+                try:
+                    if conn is None:
+                        conn = _RespConnection(self.host, self.port, self.password, timeout=5)
+                    conn.command(b"PUBLISH", self.channel, payload)
+                    break
+                except Exception as e:
+                    logger.warning("缓存失效广播失败: %s", e)
+                    if conn is not None:
+                        conn.close()
+                    conn = None
+        if conn is not None:
+            conn.close()
+
+    def stop(self):
+        self._stopping.set()
+        if self._sub_conn is not None:
+            self._sub_conn.close()
+        for thread in self._threads:
+            thread.join(timeout=2)
+
+
+# ==================================================
+# 总线
+# ==================================================
+
+class InvalidationBus:
+    def __init__(self):
+        self.node_id = uuid.uuid4().hex
+        self._handlers = []       # (prefix, handler, blocking)
+        self._reset_handlers = []
+        self._seen = OrderedDict()  # (node, key) -> 已处理的最大序号
+        self._seq = itertools.count(1)
+        self._lock = threading.Lock()
+        self._backend = None
+        self._deferred = None     # 本节点发布时 blocking 处理器的任务队列
+        self._worker = None
+
+    def subscribe(self, prefix: str, handler, on_reset=None, blocking: bool = False):
+        """
+        注册处理器：键以 prefix 开头的消息调用 handler(键中 prefix 之后的部分, version)
+        on_reset() 在订阅重连后调用，用于清空相应缓存
+        blocking=True 的处理器会做 I/O，在总线的后台线程中执行 (总线未启动时直接执行)
+        """
+        self._handlers.append((prefix, handler, blocking))
+        if on_reset is not None:
+            self._reset_handlers.append(on_reset)
+
+    def _accept(self, node: str, seq: int, key: str) -> bool:
+        with self._lock:
+            seen_key = (node, key)
+            if self._seen.get(seen_key, 0) >= seq:
+                return False
+            self._seen[seen_key] = seq
+            self._seen.move_to_end(seen_key)
+            while len(self._seen) > SEEN_SIZE:
+                self._seen.popitem(last=False)
+            return True
+
+    def _call(self, handler, key: str, arg: str, version: int):
+        try:
+            handler(arg, version)
+        except Exception:
+            logger.exception("缓存失效处理失败 (%s)", key)
+
+    def _apply(self, node: str, seq: int, keys: list):
+        version = time.time_ns()
+        deferred = []
+        for key in keys:
+            if not self._accept(node, seq, key):
+                continue
+            for prefix, handler, blocking in self._handlers:
+                if not key.startswith(prefix):
+                    continue
+                if blocking and self._deferred is not None:
+                    deferred.append((handler, key, key[len(prefix):], version))
+                else:
+                    self._call(handler, key, key[len(prefix):], version)
+        for task in deferred:
+            self._deferred.put(task)
+
+    def _run_deferred(self):
+        while True:
+            task = self._deferred.get()
+            if task is None:
+                return
+            self._call(*task)
+
+    def _on_message(self, payload: bytes):
+        try:
+            message = json.loads(payload)
+            node, seq = message["node"], int(message["seq"])
+        except (ValueError, KeyError, TypeError):
+            return
+        if node == self.node_id:
+            return  # 本节点发布时已经处理过
+        self._apply(node, seq, message.get("keys", []))
+
+    def _on_resync(self):
+        for reset in self._reset_handlers:
+            try:
+                reset()
+            except Exception:
+                logger.exception("缓存重置失败")
+
+    def publish(self, keys: list):
+        """立即在本节点驱逐 (查库的处理器转入后台线程)，并 (异步) 广播给其他节点"""
+        seq = next(self._seq)
+        self._apply(self.node_id, seq, keys)
+        if self._backend is not None:
+            payload = json.dumps({"node": self.node_id, "seq": seq, "keys": keys}).encode()
+            self._backend.publish(payload)
+
+    def start(self):
+        if self._backend is not None:
+            return
+        self._deferred = queue.Queue()
+        self._worker = threading.Thread(target=self._run_deferred, name="cache-bus-apply", daemon=True)
+        self._worker.start()
+        url = settings.CACHE_BUS_URL
+        if url.startswith("redis://"):
+            backend = RedisBackend(url, settings.CACHE_BUS_CHANNEL)
+        else:
+            backend = LocalBackend()
+        backend.start(self._on_message, self._on_resync)
+        self._backend = backend
+
+    def stop(self):
+        if self._backend is not None:
+            self._backend.stop()
+            self._backend = None
+        if self._worker is not None:
+            # 先执行完已排队的处理器
+            self._deferred.put(None)
+            self._worker.join(timeout=5)
+            self._worker = None
+            self._deferred = None
+
+
+bus = InvalidationBus()
+
+
+def publish(keys: list):
+    bus.publish(keys)
+
+
+def subscribe(prefix: str, handler, on_reset=None, blocking: bool = False):
+    bus.subscribe(prefix, handler, on_reset, blocking)
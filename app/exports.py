@@ -0,0 +1,247 @@
+# app/exports.py
+"""
+活动签到表导出任务
+管理员提交导出后拿到任务 ID，后台线程把 XLSX/CSV 写到 EXPORT_DIR，管理员轮询状态后下载。
+产物按 (活动, 格式, 数据版本) 命名：数据版本由该活动签到记录的条数/最大 ID/未签退数/最近签退时间算出，
+数据不变时重复导出直接复用磁盘上的文件。已结束且全部签退的活动，其数据版本记在内存里
+(该组织出现新的签到/签退时经 cache_bus "report:<admin_id>" 作废)，重复下载不访问数据库。
+任务状态也记录在磁盘上 (.part 生成中 / .failed 失败)，同一主机上的多个 worker 都能查询与下载。
+"""
+
+import csv
+import glob
+import hashlib
+import io
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from . import db_utils
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv; charset=utf-8",
+}
+# 任务 ID 即产物文件名：<活动码>-<数据版本>.<格式>
+JOB_ID_PATTERN = re.compile(r"^([0-9a-f-]{36})-([0-9a-f]{12})\.(xlsx|csv)$")
+# 超过这么久仍未完成的 .part 视为 worker 中途退出，允许重新生成
+STALE_PART_SECONDS = 600
+# 旧的同步导出接口最多等待这么久
+BUILD_NOW_TIMEOUT_SECONDS = 120
+
+_executor = None
+_executor_lock = threading.Lock()
+# 活动码 -> (admin_id, 数据版本)，只记录已结束且全部签退的活动；最多 FROZEN_VERSIONS_SIZE 个 (LRU)
+FROZEN_VERSIONS_SIZE = 5000
+_frozen_versions = OrderedDict()
+_versions_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.EXPORT_WORKERS, thread_name_prefix="export")
+        return _executor
+
+
+def _export_dir() -> str:
+    os.makedirs(settings.EXPORT_DIR, exist_ok=True)
+    return settings.EXPORT_DIR
+
+
+def _path(job_id: str) -> str:
+    return os.path.join(_export_dir(), job_id)
+
+
+def parse_job_id(job_id: str):
+    """返回 (活动码, 格式)；非法 ID 返回 None (同时防止路径穿越)"""
+    match = JOB_ID_PATTERN.match(job_id)
+    return (match.group(1), match.group(3)) if match else None
+
+
+# --- 数据版本 ---
+def data_version(activity: dict) -> str:
+    code = activity['unique_code']
+    with _versions_lock:
+        frozen = _frozen_versions.get(code)
+        if frozen is not None:
+            _frozen_versions.move_to_end(code)
+    if frozen is not None:
+        return frozen[1]
+
+    with db_utils.get_activity_read_connection(code, sticky_key=f"report:{activity['admin_id']}") as db:
+        count, max_id, open_logs, last_checkout = db_utils.get_check_log_fingerprint(db, activity['id'])
+    raw = f"{count}:{max_id}:{open_logs}:{last_checkout}"
+    version = hashlib.sha1(raw.encode()).hexdigest()[:12]
+    if activity['end_time'] < datetime.now() and not open_logs:
+        with _versions_lock:
+            _frozen_versions[code] = (activity['admin_id'], version)
+            _frozen_versions.move_to_end(code)
+            while len(_frozen_versions) > FROZEN_VERSIONS_SIZE:
+                _frozen_versions.popitem(last=False)
+    return version
+
+
+def invalidate_admin(admin_id: int):
+    """该组织出现新的签到/签退或活动变更 (cache_bus "report:<admin_id>")"""
+    with _versions_lock:
+        for code in [c for c, (a, _) in _frozen_versions.items() if a == admin_id]:
+            del _frozen_versions[code]
+
+
+def clear():
+    """缓存失效总线重连后调用"""
+    with _versions_lock:
+        _frozen_versions.clear()
+
+
+def forget_activity(code: str, deleted: bool = False):
+    """活动被修改/删除；删除时一并清理其产物"""
+    with _versions_lock:
+        _frozen_versions.pop(code, None)
+    if deleted:
+        for path in glob.glob(os.path.join(_export_dir(), f"{code}-*")):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+# --- 任务 ---
+def status(job_id: str) -> dict:
+    path = _path(job_id)
+    if os.path.exists(path):
+        return {"job_id": job_id, "status": "done", "size": os.path.getsize(path)}
+    if os.path.exists(path + ".failed"):
+        with open(path + ".failed", encoding="utf-8") as f:
+            return {"job_id": job_id, "status": "failed", "error": f.read()}
+    if os.path.exists(path + ".part"):
+        return {"job_id": job_id, "status": "running"}
+    return {"job_id": job_id, "status": "missing"}
+
+
+def artifact_path(job_id: str):
+    path = _path(job_id)
+    return path if os.path.exists(path) else None
+
+
+def _part_is_stale(job_id: str) -> bool:
+    try:
+        return time.time() - os.path.getmtime(_path(job_id) + ".part") >= STALE_PART_SECONDS
+    except FileNotFoundError:
+        return False
+
+
+def submit(activity: dict, fmt: str) -> dict:
+    """提交导出；产物已存在时直接返回 done，已有 worker 在生成时返回 running"""
+    job_id = f"{activity['unique_code']}-{data_version(activity)}.{fmt}"
+    path = _path(job_id)
+    if os.path.exists(path):
+        return status(job_id)
+
+    part = path + ".part"
+    try:
+        # .part 同时作为跨 worker 的生成锁
+        fd = os.open(part, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        if not _part_is_stale(job_id):
+            return status(job_id)
+        try:
+            os.remove(part)
+            fd = os.open(part, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except (FileNotFoundError, FileExistsError):
+            # 其他 worker 同时接管了过期的 .part
+            return status(job_id)
+    os.close(fd)
+    try:
+        os.remove(path + ".failed")
+    except FileNotFoundError:
+        pass
+    _get_executor().submit(_build, activity, fmt, job_id)
+    return {"job_id": job_id, "status": "running"}
+
+
+def _rows(activity: dict):
+    with db_utils.get_activity_read_connection(activity['unique_code'],
+                                               sticky_key=f"report:{activity['admin_id']}") as db:
+        logs = db_utils.get_check_logs_for_activity(db, activity['id'])
+    yield ["学号", "姓名", "签到时间", "签退时间"]
+    for log in logs:
+        yield [
+            log['student_id'],
+            log['name'],
+            log['check_in_time'].strftime('%Y-%m-%d %H:%M:%S') if log['check_in_time'] else "未签到",
+            log['check_out_time'].strftime('%Y-%m-%d %H:%M:%S') if log['check_out_time'] else "未签退",
+        ]
+
+
+def _write_xlsx(rows, part: str):
+    from openpyxl import Workbook  # 延迟导入，仅导出时加载
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("签到记录")
+    for row in rows:
+        ws.append(row)
+    wb.save(part)
+
+
+def _write_csv(rows, part: str):
+    # 带 BOM，Excel 可直接打开中文
+    with io.open(part, "w", encoding="utf-8-sig", newline="") as f:
+        csv.writer(f).writerows(rows)
+
+
+def _build(activity: dict, fmt: str, job_id: str):
+    path = _path(job_id)
+    part = path + ".part"
+    try:
+        (_write_xlsx if fmt == "xlsx" else _write_csv)(_rows(activity), part)
+        os.replace(part, path)
+        # 同一活动同一格式只保留最新版本
+        for old in glob.glob(os.path.join(_export_dir(), f"{activity['unique_code']}-*.{fmt}")):
+            if old != path:
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+    except Exception as e:
+        logger.exception("导出 %s 失败", job_id)
+        with open(path + ".failed", "w", encoding="utf-8") as f:
+            f.write(str(e))
+        try:
+            os.remove(part)
+        except OSError:
+            pass
+
+
+def build_now(activity: dict, fmt: str, timeout: float = BUILD_NOW_TIMEOUT_SECONDS) -> str:
+    """
+    同步导出 (兼容旧的直接下载接口)，返回产物路径；产物已存在时不访问数据库
+    生成 .part 的 worker 中途退出时，等到 .part 过期后重新提交；超过 timeout 仍未完成抛出 TimeoutError
+    """
+    job_id = f"{activity['unique_code']}-{data_version(activity)}.{fmt}"
+    if artifact_path(job_id) is None:
+        submit(activity, fmt)
+        deadline = time.monotonic() + timeout
+        while status(job_id)["status"] == "running":
+            if time.monotonic() >= deadline:
+                raise TimeoutError("导出超时，请稍后重试")
+            if _part_is_stale(job_id):
+                submit(activity, fmt)
+            time.sleep(0.2)
+    path = artifact_path(job_id)
+    if path is None:
+        raise RuntimeError(status(job_id).get("error", "导出失败"))
+    return path
+
+
+def download_filename(activity: dict, fmt: str) -> str:
+    return f"【{activity['name']}】_签到表.{fmt}"
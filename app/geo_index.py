@@ -0,0 +1,207 @@
+# app/geo_index.py
+"""
+进行中活动的内存空间索引 (网格)
+- 以 (admin_id, 纬度格, 经度格) 为桶，保存尚未结束的活动，活动中心预先转换为 WGS84
+- 创建/修改/删除活动时增量更新；查询只扫描附近几个格子，不访问数据库
+- 全量重建 (启动、缓存失效总线重连) 在后台线程进行，完成前查询继续使用旧网格
+"""
+
+import logging
+import math
+import threading
+import time
+from datetime import datetime
+
+from . import coord_utils
+from . import db_utils
+
+logger = logging.getLogger(__name__)
+
+# 每格约 1.1 km (纬度方向)
+CELL_DEG = 0.01
+# 加载失败后，查询触发的后台重试至少间隔这么久
+RETRY_SECONDS = 5.0
+METERS_PER_DEG_LAT = 111320.0
+
+
+class _Entry:
+    __slots__ = ("code", "admin_id", "name", "location_name", "lat", "lon",
+                 "radius", "start_time", "end_time", "cell")
+
+    def to_dict(self, distance: float) -> dict:
+        return {
+            "activity_code": self.code,
+            "name": self.name,
+            "location_name": self.location_name,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "radius_meters": self.radius,
+            "distance_meters": int(distance),
+            "in_range": distance <= self.radius,
+        }
+
+
+class ActivityGeoIndex:
+    def __init__(self, cell_deg: float = CELL_DEG):
+        self.cell_deg = cell_deg
+        self._cells = {}    # (admin_id, iy, ix) -> {code: _Entry}
+        self._by_code = {}  # code -> _Entry
+        self._lock = threading.RLock()
+        self._loaded = False
+        # 后台重建期间发生的增量变更：code -> 活动 (None 表示删除)，换入新网格后重放
+        self._rebuilding = False
+        self._pending = None
+        self._last_attempt = float("-inf")
+
+    def _cell_of(self, admin_id: int, lat: float, lon: float):
+        return (admin_id, math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg))
+
+    @staticmethod
+    def _remove_from(cells: dict, by_code: dict, code: str):
+        entry = by_code.pop(code, None)
+        if entry is None:
+            return
+        bucket = cells.get(entry.cell)
+        if bucket is not None:
+            bucket.pop(code, None)
+            if not bucket:
+                del cells[entry.cell]
+
+    def _remove_locked(self, code: str):
+        self._remove_from(self._cells, self._by_code, code)
+
+    def _put(self, cells: dict, by_code: dict, activity: dict, now: datetime):
+        """写入指定的网格；已结束或无坐标的活动只移除"""
+        code = activity['unique_code']
+        self._remove_from(cells, by_code, code)
+        if activity['latitude'] is None or activity['longitude'] is None or activity['end_time'] < now:
+            return
+        wgs_lon, wgs_lat = coord_utils.gcj2wgs(float(activity['longitude']), float(activity['latitude']))
+        entry = _Entry()
+        entry.code = code
+        entry.admin_id = activity['admin_id']
+        entry.name = activity['name']
+        entry.location_name = activity['location_name']
+        entry.lat = wgs_lat
+        entry.lon = wgs_lon
+        entry.radius = activity['radius_meters']
+        entry.start_time = activity['start_time']
+        entry.end_time = activity['end_time']
+        entry.cell = self._cell_of(entry.admin_id, wgs_lat, wgs_lon)
+        cells.setdefault(entry.cell, {})[code] = entry
+        by_code[code] = entry
+
+    def upsert(self, activity: dict, now: datetime = None):
+        """新增或更新一个活动；已结束或无坐标的活动直接移出索引"""
+        now = now or datetime.now()
+        with self._lock:
+            self._put(self._cells, self._by_code, activity, now)
+            if self._pending is not None:
+                self._pending[activity['unique_code']] = activity
+
+    def remove(self, code: str):
+        with self._lock:
+            self._remove_locked(code)
+            if self._pending is not None:
+                self._pending[code] = None
+
+    def load(self, activities: list):
+        """
+        用数据库中尚未结束的活动全量重建索引
+        新网格在锁外构建，构建期间的增量变更在换入时重放；查询始终使用旧网格直到换入
+        """
+        now = datetime.now()
+        cells, by_code = {}, {}
+        for activity in activities:
+            self._put(cells, by_code, activity, now)
+        with self._lock:
+            for code, activity in (self._pending or {}).items():
+                if activity is None:
+                    self._remove_from(cells, by_code, code)
+                else:
+                    self._put(cells, by_code, activity, now)
+            self._cells, self._by_code = cells, by_code
+            self._pending = None
+            self._loaded = True
+
+    def refresh(self):
+        """从各分片读取尚未结束的活动并重建 (阻塞，在后台线程中调用)"""
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+            self._pending = {}
+        try:
+            activities = []
+            for name in db_utils.iter_shard_names():
+                with db_utils.get_shard_connection(name) as db:
+                    activities += db_utils.get_unfinished_activities(db, datetime.now())
+            self.load(activities)
+        finally:
+            with self._lock:
+                self._rebuilding = False
+                self._pending = None
+
+    def refresh_in_background(self, force: bool = True):
+        """启动后台重建；已在重建时不重复启动。force=False 时距上次尝试不足 RETRY_SECONDS 则跳过"""
+        with self._lock:
+            if self._rebuilding:
+                return
+            now = time.monotonic()
+            if not force and now - self._last_attempt < RETRY_SECONDS:
+                return
+            self._last_attempt = now
+        threading.Thread(target=self._refresh_logged, name="geo-index", daemon=True).start()
+
+    def _refresh_logged(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            # 数据库暂不可用时，之后的查询会再次触发重建
+            logger.warning("加载活动空间索引失败: %s", e)
+
+    def reset(self):
+        """缓存失效总线重连后调用：后台重建，重建完成前继续使用旧网格"""
+        with self._lock:
+            self._loaded = False
+        self.refresh_in_background()
+
+    def nearby(self, admin_id: int, lat: float, lon: float, max_distance: float, now: datetime = None) -> list:
+        """
+        查询某组织在 (lat, lon) [WGS84] 附近 max_distance 米内正在进行的活动，按距离排序
+        """
+        now = now or datetime.now()
+        if not self._loaded:
+            # 尚未加载 (或上次加载失败)：后台加载，本次用现有网格应答
+            self.refresh_in_background(force=False)
+
+        span_lat = math.ceil(max_distance / (METERS_PER_DEG_LAT * self.cell_deg))
+        cos_lat = max(math.cos(math.radians(lat)), 0.01)
+        span_lon = math.ceil(max_distance / (METERS_PER_DEG_LAT * cos_lat * self.cell_deg))
+        _, cy, cx = self._cell_of(admin_id, lat, lon)
+
+        found = []
+        expired = []
+        with self._lock:
+            for iy in range(cy - span_lat, cy + span_lat + 1):
+                for ix in range(cx - span_lon, cx + span_lon + 1):
+                    bucket = self._cells.get((admin_id, iy, ix))
+                    if not bucket:
+                        continue
+                    for entry in bucket.values():
+                        if entry.end_time < now:
+                            expired.append(entry.code)
+                            continue
+                        if entry.start_time > now:
+                            continue
+                        distance = db_utils.calculate_distance(lat, lon, entry.lat, entry.lon)
+                        if distance <= max_distance:
+                            found.append((distance, entry))
+            for code in expired:
+                self._remove_locked(code)
+
+        found.sort(key=lambda item: item[0])
+        return [entry.to_dict(distance) for distance, entry in found]
+
+
+activity_index = ActivityGeoIndex()
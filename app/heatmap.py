@@ -0,0 +1,103 @@
+# app/heatmap.py
+"""
+后台地图的签到/签退位置分布
+按地图缩放级别把活动的签到 (或签退) 坐标划分为约 CELL_PIXELS 像素见方的网格，
+分组计数在 MySQL 中一次 GROUP BY 完成，只把每个网格的 (中心经度, 中心纬度, 人数) 返回给浏览器。
+check_logs 中的坐标来自签到页的高德定位，本身就是 GCJ02，与控制台的高德地图一致，无需转换。
+已结束活动的结果按 (活动码, 类型, 缩放级别) 缓存，该组织出现新的签到/签退 (cache_bus "report:<admin_id>")
+或活动被修改/删除时作废。
+"""
+
+import math
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from . import db_utils
+
+KINDS = ("check_in", "check_out")
+MIN_ZOOM = 12
+MAX_ZOOM = 20
+CELL_PIXELS = 24
+CACHE_SIZE = 2000
+
+# Web 墨卡托下赤道处 zoom 0 的每像素米数
+_METERS_PER_PIXEL_Z0 = 156543.03392
+_METERS_PER_DEGREE_LAT = 111320.0
+
+# (活动码, 类型, 缩放级别) -> (admin_id, 结果)
+_cache = OrderedDict()
+# admin_id -> generation，每次失效 +1
+_generations = {}
+_lock = threading.Lock()
+
+
+def cell_size(center_lat: float, zoom: int) -> tuple:
+    """返回 (纬度步长, 经度步长, 网格边长米数)；经度步长按活动所在纬度缩放，使网格近似正方形"""
+    meters = CELL_PIXELS * _METERS_PER_PIXEL_Z0 * math.cos(math.radians(center_lat)) / (2 ** zoom)
+    lat_step = meters / _METERS_PER_DEGREE_LAT
+    lon_step = lat_step / max(math.cos(math.radians(center_lat)), 0.01)
+    return lat_step, lon_step, meters
+
+
+def invalidate_admin(admin_id: int):
+    with _lock:
+        _generations[admin_id] = _generations.get(admin_id, 0) + 1
+        for key in [k for k, (a, _) in _cache.items() if a == admin_id]:
+            del _cache[key]
+
+
+def forget_activity(code: str):
+    with _lock:
+        for key in [k for k in _cache if k[0] == code]:
+            del _cache[key]
+
+
+def clear():
+    """缓存失效总线重连后调用"""
+    with _lock:
+        for admin_id in list(_generations):
+            _generations[admin_id] += 1
+        _cache.clear()
+
+
+def aggregate(activity: dict, kind: str, zoom: int) -> dict:
+    """
+    返回 {"kind", "zoom", "cell_meters", "center", "total", "max", "cells": [[经度, 纬度, 人数], ...]}
+    """
+    code, admin_id = activity['unique_code'], activity['admin_id']
+    key = (code, kind, zoom)
+    with _lock:
+        entry = _cache.get(key)
+        if entry is not None:
+            _cache.move_to_end(key)
+            return entry[1]
+        generation = _generations.get(admin_id, 0)
+
+    center_lat, center_lon = float(activity['latitude']), float(activity['longitude'])
+    lat_step, lon_step, meters = cell_size(center_lat, zoom)
+    with db_utils.get_activity_read_connection(code, sticky_key=f"report:{admin_id}") as db:
+        bins = db_utils.get_check_coordinate_bins(db, activity['id'], kind, lat_step, lon_step)
+
+    cells = [
+        [round((x + 0.5) * lon_step, 6), round((y + 0.5) * lat_step, 6), count]
+        for y, x, count in bins
+    ]
+    result = {
+        "kind": kind,
+        "zoom": zoom,
+        "cell_meters": round(meters, 1),
+        "center": [center_lon, center_lat],
+        "total": sum(c[2] for c in cells),
+        "max": max((c[2] for c in cells), default=0),
+        "cells": cells,
+    }
+
+    # 进行中的活动还会有新的签到/签退，不缓存
+    if activity['end_time'] < datetime.now():
+        with _lock:
+            if _generations.get(admin_id, 0) == generation:
+                _cache[key] = (admin_id, result)
+                while len(_cache) > CACHE_SIZE:
+                    _cache.popitem(last=False)
+    return result
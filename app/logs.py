@@ -0,0 +1,187 @@
+# app/logs.py
+"""
+结构化日志 (JSON Lines)
+- 业务代码照常使用 logging.getLogger(__name__)；"app" 下的日志记录只在调用线程里附上请求上下文
+  (request_id / method / route / admin_id / 已耗时 ms) 后放入有界队列，JSON 序列化与写文件
+  由 QueueListener 的后台线程完成，事件循环上不做任何 I/O。队列满时丢弃并计数，绝不阻塞请求
+- 输出到 LOG_FILE (按大小轮转，{pid} 会替换为进程号，多 worker 各写各的文件)，为空时写 stderr
+- 每个请求结束时记一条访问日志；成功且不慢的请求按 LOG_ACCESS_SAMPLE_RATE 采样，
+  4xx/5xx 与超过 LOG_SLOW_REQUEST_MS 的请求全部记录
+"""
+
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+import uuid
+from datetime import datetime
+
+from .config import settings
+
+LOGGER_NAME = "app"
+QUEUE_SIZE = 10000
+
+_request_context = contextvars.ContextVar("request_context", default=None)
+access_logger = logging.getLogger("app.access")
+
+_listener = None
+dropped = 0
+
+
+def bind(**fields):
+    """给当前请求的上下文补充字段 (如鉴权后得到的 admin_id)；请求之外调用无效果"""
+    context = _request_context.get()
+    if context is not None:
+        context.update(fields)
+
+
+def current_request_id():
+    context = _request_context.get()
+    return context["request_id"] if context else None
+
+
+class JsonFormatter(logging.Formatter):
+    """一条记录一行 JSON；在监听线程中执行"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        context = getattr(record, "context", None)
+        if context:
+            entry.update(context)
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """只捕获请求上下文，不在调用线程中格式化"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        context = _request_context.get()
+        if context is not None:
+            snapshot = {k: v for k, v in context.items() if k != "started"}
+            snapshot["elapsed_ms"] = round((time.perf_counter() - context["started"]) * 1000, 1)
+            record.context = snapshot
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        global dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped += 1
+
+
+def _output_handler() -> logging.Handler:
+    if settings.LOG_FILE:
+        path = settings.LOG_FILE.format(pid=os.getpid())
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=settings.LOG_MAX_BYTES, backupCount=settings.LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+    else:
+        handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+
+def setup():
+    """启动日志后台线程 (重复调用无效果)"""
+    global _listener
+    if _listener is not None:
+        return
+    log_queue = queue.Queue(QUEUE_SIZE)
+    _listener = logging.handlers.QueueListener(log_queue, _output_handler())
+    _listener.start()
+
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(settings.LOG_LEVEL.upper())
+    logger.addHandler(ContextQueueHandler(log_queue))
+    logger.propagate = False
+
+
+def shutdown():
+    """写完队列中剩余的日志后停止后台线程"""
+    global _listener
+    if _listener is None:
+        return
+    logger = logging.getLogger(LOGGER_NAME)
+    for handler in [h for h in logger.handlers if isinstance(h, ContextQueueHandler)]:
+        logger.removeHandler(handler)
+    logger.propagate = True
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
+
+
+class RequestLogMiddleware:
+    """纯 ASGI 中间件：建立请求上下文，并在响应结束后记录 (采样的) 访问日志"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope.get("headers", ()):
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        context = {
+            "request_id": request_id or uuid.uuid4().hex[:16],
+            "method": scope["method"],
+            "route": scope["path"],
+            "started": time.perf_counter(),
+        }
+        token = _request_context.set(context)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", ())) + [
+                    (b"x-request-id", context["request_id"].encode("latin-1"))
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # 路由匹配后用路由模板代替原始路径，便于按接口聚合
+            route = scope.get("route")
+            if route is not None and hasattr(route, "path"):
+                context["route"] = route.path
+            self._log_access(status, time.perf_counter() - context["started"])
+            _request_context.reset(token)
+
+    @staticmethod
+    def _log_access(status: int, seconds: float):
+        latency_ms = seconds * 1000
+        always = status >= 400 or latency_ms >= settings.LOG_SLOW_REQUEST_MS
+        rate = 1.0 if always else settings.LOG_ACCESS_SAMPLE_RATE
+        if rate <= 0 or (rate < 1.0 and random.random() >= rate):
+            return
+        level = logging.ERROR if status >= 500 else logging.WARNING if always else logging.INFO
+        if access_logger.isEnabledFor(level):
+            access_logger.log(level, "request", extra={"fields": {
+                "status": status, "latency_ms": round(latency_ms, 1), "sample_rate": rate,
+            }})
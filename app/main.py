@@ -1,20 +1,20 @@
-from fastapi import FastAPI, Depends, HTTPException, status, APIRouter, Response
+from fastapi import FastAPI, Depends, HTTPException, status, APIRouter, Response, Query
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse, FileResponse
 from datetime import timedelta, datetime
-import io
-import qrcode # 确保已安装 qrcode[pil]
-import smtplib
-from email.mime.text import MIMEText
-from email.utils import formataddr
+from contextlib import asynccontextmanager
+import asyncio
+import importlib
+import logging
 import random
 import os
+import threading
 from fastapi import Request # 需要导入 Request 对象
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
-from openpyxl import Workbook
 from urllib.parse import quote
+from email.utils import parsedate_to_datetime
 
 # 导入本地模块
 from . import coord_utils
@@ -22,13 +22,114 @@ from . import db_utils
 from .db_utils import get_db_connection
 from . import models
 from . import security
+from . import reports
+from . import exports
+from . import heatmap
+from . import series
+from . import notifications
+from . import qr_utils
+from . import qr_tokens
+from . import cache
+from . import cache_bus
+from . import admission
+from . import profiler
+from . import logs
+from . import anomaly
+from .geo_index import activity_index
+from .scheduler import scheduler
 from .config import settings
 from .security import get_current_student
 from .email_templates import EmailTemplates
 
+logger = logging.getLogger(__name__)
+
+# 二维码 / Excel / SMTP 只在少数请求中使用，启动时不导入，而是在后台线程中预热
+HEAVY_MODULES = ("qrcode", "PIL.Image", "openpyxl", "smtplib", "email.mime.text")
+
+def _warm_up_heavy_modules():
+    for name in HEAVY_MODULES:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            logger.warning("预加载模块 %s 失败: %s", name, e)
+
+# --- 跨节点缓存失效 ---
+def _on_activity_changed(code: str, version: int):
+    """活动被创建/修改/删除 (本节点或其他节点)：立即驱逐缓存"""
+    cache.invalidate_activity(code, version)
+
+def _reload_activity(code: str, version: int):
+    """按数据库最新状态更新导出/热力图缓存、空间索引与排程 (查库，不在事件循环中执行)"""
+    with db_utils.get_activity_connection(code) as db:
+        activity = db_utils.get_activity_by_code(db, code)
+    _apply_activity_state(code, activity)
+
+def _apply_activity_state(code: str, activity):
+    """activity 为 None 表示已删除"""
+    exports.forget_activity(code, deleted=activity is None)
+    heatmap.forget_activity(code)
+    if activity:
+        activity_index.upsert(activity)
+        scheduler.schedule(activity)
+    else:
+        activity_index.remove(code)
+        scheduler.unschedule(code)
+
+def _on_series_changed(key: str, version: int):
+    """周期活动的一批场次被生成/修改/删除：立即驱逐这些活动的缓存"""
+    _, _, codes = series.parse_bus_key(key)
+    for code in codes:
+        cache.invalidate_activity(code, version)
+
+def _reload_series(key: str, version: int):
+    """一条按 series_id 的查询取回系列现有场次，批量更新索引与排程；查不到的场次视为已删除"""
+    admin_id, series_id, codes = series.parse_bus_key(key)
+    with db_utils.get_tenant_connection(admin_id) as db:
+        rows = {row['unique_code']: row for row in db_utils.get_series_activities(db, series_id)}
+    for code in codes:
+        _apply_activity_state(code, rows.get(code))
+
+def _on_activities_resync():
+    cache.activity_cache.clear()
+    cache.detail_cache.clear()
+    activity_index.reset()
+
+def _on_report_changed(admin_id: str, version: int):
+    reports.invalidate(int(admin_id))
+    exports.invalidate_admin(int(admin_id))
+    heatmap.invalidate_admin(int(admin_id))
+
+def _on_reports_resync():
+    reports.clear()
+    exports.clear()
+    heatmap.clear()
+
+cache_bus.subscribe("activity:", _on_activity_changed, _on_activities_resync)
+cache_bus.subscribe("activity:", _reload_activity, blocking=True)
+cache_bus.subscribe("series:", _on_series_changed)
+cache_bus.subscribe("series:", _reload_series, blocking=True)
+cache_bus.subscribe("report:", _on_report_changed, _on_reports_resync)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logs.setup()
+    cache_bus.bus.start()
+    if settings.WARMUP_ON_STARTUP:
+        threading.Thread(target=_warm_up_heavy_modules, name="warmup", daemon=True).start()
+    activity_index.refresh_in_background()
+    if settings.SCHEDULER_ENABLED:
+        scheduler.start()
+    anomaly.detector.start()
+    yield
+    scheduler.stop()
+    anomaly.detector.stop()
+    cache_bus.bus.stop()
+    logs.shutdown()
+
 app = FastAPI(
     title="学生活动签到系统",
-    description="API for student check-in system. Remember Nginx rewrite /students_system/ to /"
+    description="API for student check-in system. Remember Nginx rewrite /students_system/ to /",
+    lifespan=lifespan
 )
 # 初始化 Limiter
 # key_func=get_remote_address 表示根据客户端 IP 进行限制
@@ -36,6 +137,20 @@ limiter = Limiter(key_func=get_remote_address)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
+@app.exception_handler(db_utils.TenantMigratingError)
+async def tenant_migrating_handler(request: Request, exc: db_utils.TenantMigratingError):
+    # 租户迁移分片的切换窗口只有几秒，让客户端稍后重试
+    return JSONResponse(status_code=503, content={"detail": "数据迁移中，请稍后重试"}, headers={"Retry-After": "5"})
+
+# 读写粘滞 Cookie：写过主库的客户端在 READ_YOUR_WRITES_SECONDS 内的读取在任何 worker 上都走主库
+app.add_middleware(db_utils.ReadYourWritesMiddleware)
+# 按需的请求追踪 (关闭时直接透传)；放在准入控制之内，只统计被接纳请求的处理耗时
+app.add_middleware(profiler.TraceMiddleware)
+# 按路由类别做准入控制 (签到优先，导出/二维码让路)
+app.add_middleware(admission.AdmissionControlMiddleware)
+# 最外层：建立请求上下文 (request_id 等) 并记录访问日志，被削峰的 503 也会记录
+app.add_middleware(logs.RequestLogMiddleware)
+
 # --- 路由拆分 ---
 router_admin = APIRouter(prefix="/api/admin", tags=["Admin"])
 router_participant = APIRouter(prefix="/api/participant", tags=["Participant"])
@@ -62,7 +177,27 @@ async def login_for_access_token(form_data: models.AdminLogin):
     access_token = security.create_access_token(
         data={"sub": admin['username']}
     )
-    return {"access_token": access_token, "token_type": "bearer"}
+    with get_db_connection() as db:
+        refresh_token = security.issue_refresh_token(db, "admin", admin['username'])
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token}
+
+@router_admin.post("/refresh", response_model=models.Token)
+async def refresh_admin_token(req: models.RefreshRequest):
+    """用刷新令牌换取新的访问令牌 (刷新令牌同时轮换)"""
+    with get_db_connection() as db:
+        record, refresh_token = security.rotate_refresh_token(db, req.refresh_token, "admin")
+        if not db_utils.get_admin_by_username(db, record['subject']):
+            security.revoke_refresh_token(db, refresh_token)
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
+    access_token = security.create_access_token(data={"sub": record['subject']})
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token}
+
+@router_admin.post("/logout")
+async def logout_admin(req: models.RefreshRequest):
+    """退出登录：吊销刷新令牌 (及其轮换出的所有令牌)"""
+    with get_db_connection() as db:
+        security.revoke_refresh_token(db, req.refresh_token)
+    return {"message": "已退出登录"}
 
 # [修改 1] 根据要求修改 create_activity
 @router_admin.post("/activities", response_model=models.ActivityResponse)
@@ -73,26 +208,134 @@ async def create_activity(
     """
     创建新活动 (受保护)
     """
-    with get_db_connection() as db:
+    with db_utils.get_tenant_connection(current_admin['id']) as db:
         try:
             # 传入 admin_id
             unique_code = db_utils.db_create_activity(db, activity, current_admin['id'])
+            db_utils.register_activity_tenant(unique_code, current_admin['id'])
             new_activity = db_utils.get_activity_by_code(db, unique_code)
-            return new_activity
+            db_utils.mark_primary_sticky(f"admin:{current_admin['id']}")
+            cache_bus.publish([f"activity:{unique_code}", f"report:{current_admin['id']}"])
+            return db_utils.to_dict(new_activity)
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Failed to create activity: {e}")
 
+# --- 周期活动 (系列) ---
+@router_admin.post("/series")
+async def create_activity_series(
+    data: models.ActivitySeriesCreate,
+    current_admin: dict = Depends(security.get_current_admin)
+):
+    """
+    创建周期活动：按规则一次生成 SERIES_HORIZON_DAYS 天内的全部场次，之后由调度器自动向后延伸
+    """
+    if data.until_date is not None and data.until_date < data.start_date:
+        raise HTTPException(status_code=400, detail="结束日期不能早于开始日期")
+    if data.start_clock == data.end_clock:
+        raise HTTPException(status_code=400, detail="开始时刻与结束时刻不能相同")
+    try:
+        series_id, codes = series.create(current_admin['id'], data)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to create series: {e}")
+    db_utils.mark_primary_sticky(f"admin:{current_admin['id']}")
+    with db_utils.get_tenant_connection(current_admin['id']) as db:
+        created = db_utils.get_series(db, series_id)
+    return dict(series.to_dict(created), activity_codes=codes)
+
+@router_admin.get("/series")
+async def list_activity_series(current_admin: dict = Depends(security.get_current_admin)):
+    with db_utils.get_tenant_read_connection(current_admin['id'], sticky_key=f"admin:{current_admin['id']}") as db:
+        rows = db_utils.get_series_list(db, current_admin['id'], datetime.now())
+    return [series.to_dict(row) for row in rows]
+
+def _get_owned_series(db, series_id: int, admin_id: int):
+    found = db_utils.get_series(db, series_id)
+    if not found or found['admin_id'] != admin_id:
+        raise HTTPException(status_code=404, detail="Series not found")
+    return found
+
+@router_admin.put("/series/{series_id}")
+async def update_activity_series(
+    series_id: int,
+    changes: models.ActivitySeriesUpdate,
+    current_admin: dict = Depends(security.get_current_admin)
+):
+    """
+    系列级修改 (名称、地点、范围、时刻、动态二维码)：一条 UPDATE 作用于所有尚未开始的场次，
+    已开始或已结束的场次不变
+    """
+    with db_utils.get_tenant_connection(current_admin['id']) as db:
+        found = _get_owned_series(db, series_id, current_admin['id'])
+        fields = changes.model_dump(exclude_unset=True, exclude_none=True)
+        if series.clock(fields.get('start_clock', found['start_clock'])) == \
+                series.clock(fields.get('end_clock', found['end_clock'])):
+            raise HTTPException(status_code=400, detail="开始时刻与结束时刻不能相同")
+        try:
+            codes = series.update(db, found, fields, datetime.now())
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"更新失败: {e}")
+        updated = db_utils.get_series(db, series_id)
+    db_utils.mark_primary_sticky(f"admin:{current_admin['id']}")
+    return dict(series.to_dict(updated), updated_activities=len(codes))
+
+@router_admin.delete("/series/{series_id}")
+async def delete_activity_series(
+    series_id: int,
+    current_admin: dict = Depends(security.get_current_admin)
+):
+    """
+    删除系列及其尚未开始的场次；已开始/已结束的场次 (及其签到记录) 保留为普通活动
+    """
+    with db_utils.get_tenant_connection(current_admin['id']) as db:
+        found = _get_owned_series(db, series_id, current_admin['id'])
+        try:
+            codes = series.delete(db, found, datetime.now())
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"删除失败: {e}")
+    db_utils.mark_primary_sticky(f"admin:{current_admin['id']}")
+    return {"message": "系列已删除", "deleted_activities": len(codes)}
+
 # [修改 2] 根据要求修改 get_activities_list
 @router_admin.get("/activities")
 async def get_activities_list(current_admin: dict = Depends(security.get_current_admin)):
     """
     获取所有活动列表 (受保护)
     """
-    with get_db_connection() as db:
+    with db_utils.get_tenant_read_connection(current_admin['id'], sticky_key=f"admin:{current_admin['id']}") as db:
         # 传入 admin_id，只获取该管理员的活动
         activities = db_utils.get_all_activities(db, current_admin['id'])
         return activities
 
+@router_admin.get("/activities/page")
+async def get_activities_page(
+    limit: int = Query(20, ge=1, le=100),
+    cursor: str = Query(None, max_length=200),
+    status_filter: str = Query(None, alias="status", pattern="^(upcoming|in_progress|ended)$"),
+    q: str = Query(None, max_length=100),
+    current_admin: dict = Depends(security.get_current_admin)
+):
+    """
+    分页获取活动列表 (游标分页)，附带每个活动的签到/签退/在场人数
+    下一页请求带上返回的 next_cursor；status 为 upcoming / in_progress / ended，q 按名称模糊搜索
+    """
+    now = datetime.now()
+    with db_utils.get_tenant_read_connection(current_admin['id'], sticky_key=f"admin:{current_admin['id']}") as db:
+        try:
+            activities, next_cursor = db_utils.get_activities_page(
+                db, current_admin['id'], now, limit, cursor=cursor, status=status_filter, q=q
+            )
+        except ValueError:
+            raise HTTPException(status_code=400, detail="无效的分页游标")
+
+    for activity in activities:
+        if activity['start_time'] > now:
+            activity['status'] = "upcoming"
+        elif activity['end_time'] < now:
+            activity['status'] = "ended"
+        else:
+            activity['status'] = "in_progress"
+    return {"items": activities, "next_cursor": next_cursor}
+
 @router_admin.get("/activities/{activity_code}/qr")
 async def get_activity_qr_code_admin(
     activity_code: str,
@@ -101,19 +344,30 @@ async def get_activity_qr_code_admin(
     """
     为活动生成签到二维码 (受保护)
     """
-    with get_db_connection() as db:
+    with db_utils.get_activity_connection(activity_code) as db:
         activity = db_utils.get_activity_by_code(db, activity_code)
         if not activity:
             raise HTTPException(status_code=404, detail="Activity not found")
 
-    checkin_url = f"https://havenchannel.xyz/students_system/checkin.html?code={activity_code}"
+    return Response(content=qr_utils.render_checkin_qr(activity_code), media_type="image/png")
 
-    img = qrcode.make(checkin_url)
-    buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    buf.seek(0)
+@router_admin.get("/activities/{activity_code}/qr-token")
+async def get_activity_qr_token(
+    activity_code: str,
+    current_admin: dict = Depends(security.get_current_admin)
+):
+    """
+    动态二维码投屏页定时调用：返回当前时间片的签名令牌和签到链接，refresh_in 秒后应重新获取
+    """
+    activity = None
+    with db_utils.get_activity_connection(activity_code) as db:
+        activity = cache.get_activity(db, activity_code)
+    if not activity or activity['admin_id'] != current_admin['id']:
+        raise HTTPException(status_code=404, detail="Activity not found")
 
-    return StreamingResponse(buf, media_type="image/png")
+    issued = qr_tokens.issue(activity)
+    issued["url"] = f"{settings.CHECKIN_PAGE_URL}?code={activity_code}&t={issued['token']}"
+    return issued
 
 @router_admin.get("/activities/{activity_code}/logs")
 async def get_activity_logs(
@@ -123,13 +377,43 @@ async def get_activity_logs(
     """
     查看指定活动的签到/签退日志 (受保护)
     """
-    with get_db_connection() as db:
+    with db_utils.get_activity_read_connection(activity_code, sticky_key=f"admin:{admin_user['id']}") as db:
         activity = db_utils.get_activity_by_code(db, activity_code)
         if not activity:
             raise HTTPException(status_code=404, detail="Activity not found")
         
         logs = db_utils.get_check_logs_for_activity(db, activity['id'])
-        return {"activity_name": activity['name'], "logs": logs}
+        return {"activity_name": activity['name'], "logs": [log.to_dict() for log in logs]}
+
+def _get_owned_activity(activity_code: str, admin_id: int):
+    activity = cache.load_activity(activity_code)
+    if not activity or activity['admin_id'] != admin_id:
+        raise HTTPException(status_code=404, detail="Activity not found")
+    return activity
+
+@router_admin.get("/activities/{activity_code}/heatmap")
+async def get_activity_heatmap(
+    activity_code: str,
+    kind: str = Query("check_in", pattern="^(check_in|check_out)$"),
+    zoom: int = Query(17, ge=heatmap.MIN_ZOOM, le=heatmap.MAX_ZOOM),
+    current_admin: dict = Depends(security.get_current_admin)
+):
+    """
+    签到/签退位置分布 (高德 GCJ02)，按地图缩放级别聚合为网格计数
+    cells 中每项为 [经度, 纬度, 人数]
+    """
+    activity = _get_owned_activity(activity_code, current_admin['id'])
+    return heatmap.aggregate(activity, kind, zoom)
+
+def _export_file_response(activity, fmt: str, path: str):
+    encoded_filename = quote(exports.download_filename(activity, fmt))
+    return FileResponse(
+        path,
+        media_type=exports.FORMATS[fmt],
+        headers={
+            "Content-Disposition": f"attachment; filename*=utf-8''{encoded_filename}"
+        }
+    )
 
 @router_admin.get("/activities/{activity_code}/export")
 async def export_activity_excel(
@@ -137,56 +421,242 @@ async def export_activity_excel(
     admin_user: str = Depends(security.get_current_admin)
 ):
     """
-    导出指定活动的签到表为 Excel
+    导出指定活动的签到表为 Excel (同步下载；数据未变化时直接返回已生成的文件)
     """
-    with get_db_connection() as db:
-        activity = db_utils.get_activity_by_code(db, activity_code)
-        if not activity:
-            raise HTTPException(status_code=404, detail="Activity not found")
-        
-        # 获取签到记录
-        logs = db_utils.get_check_logs_for_activity(db, activity['id'])
+    activity = _get_owned_activity(activity_code, admin_user['id'])
+    try:
+        path = await asyncio.to_thread(exports.build_now, activity, "xlsx")
+    except TimeoutError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "10"})
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=f"导出失败: {e}")
+    return _export_file_response(activity, "xlsx", path)
 
-    # 创建 Excel 工作簿
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "签到记录"
-    
-    # 写入表头
-    headers = ["学号", "姓名", "签到时间", "签退时间"]
-    ws.append(headers)
-    
-    # 写入数据
-    for log in logs:
-        # 格式化时间，处理 None 的情况
-        c_in = log['check_in_time'].strftime('%Y-%m-%d %H:%M:%S') if log['check_in_time'] else "未签到"
-        c_out = log['check_out_time'].strftime('%Y-%m-%d %H:%M:%S') if log['check_out_time'] else "未签退"
-        
-        ws.append([
-            log['student_id'],
-            log['name'],
-            c_in,
-            c_out
-        ])
-    
-    # 保存到内存流
-    buf = io.BytesIO()
-    wb.save(buf)
-    buf.seek(0)
-    
-    # 生成文件名：【活动名称】_签到表.xlsx
-    filename = f"【{activity['name']}】_签到表.xlsx"
-    # URL 编码文件名以解决中文乱码问题
-    encoded_filename = quote(filename)
-    
+@router_admin.post("/activities/{activity_code}/exports")
+async def create_export_job(
+    activity_code: str,
+    fmt: str = Query("xlsx", alias="format", pattern="^(xlsx|csv)$"),
+    current_admin: dict = Depends(security.get_current_admin)
+):
+    """
+    提交导出任务，返回任务 ID；数据未变化时直接返回 done
+    之后轮询 GET /exports/{job_id}，完成后 GET /exports/{job_id}/download
+    """
+    activity = _get_owned_activity(activity_code, current_admin['id'])
+    return exports.submit(activity, fmt)
+
+@router_admin.get("/exports/{job_id}")
+async def get_export_job(job_id: str, current_admin: dict = Depends(security.get_current_admin)):
+    """查询导出任务状态：running / done / failed"""
+    parsed = exports.parse_job_id(job_id)
+    if not parsed:
+        raise HTTPException(status_code=404, detail="Export not found")
+    _get_owned_activity(parsed[0], current_admin['id'])
+    job = exports.status(job_id)
+    if job["status"] == "missing":
+        raise HTTPException(status_code=404, detail="Export not found")
+    return job
+
+@router_admin.get("/exports/{job_id}/download")
+async def download_export(job_id: str, current_admin: dict = Depends(security.get_current_admin)):
+    """下载已完成的导出文件 (直接读磁盘)"""
+    parsed = exports.parse_job_id(job_id)
+    if not parsed:
+        raise HTTPException(status_code=404, detail="Export not found")
+    activity_code, fmt = parsed
+    activity = _get_owned_activity(activity_code, current_admin['id'])
+    path = exports.artifact_path(job_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="导出文件不存在或尚未生成完成")
+    return _export_file_response(activity, fmt, path)
+
+@router_admin.get("/report")
+async def export_semester_report(
+    fmt: str = Query("xlsx", alias="format", pattern="^(xlsx|csv)$"),
+    current_admin: dict = Depends(security.get_current_admin)
+):
+    """
+    导出学期考勤汇总 (该管理员名下所有活动)：出勤次数、累计在场时长、学生 x 活动出勤矩阵
+    """
+    admin_id = current_admin['id']
+
+    if fmt == "csv":
+        media_type = "text/csv; charset=utf-8"
+        cached = reports.get_cached(admin_id, "csv")
+        body = iter([cached]) if cached is not None else reports.stream_csv(admin_id)
+    else:
+        media_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        cached = reports.get_cached(admin_id, "xlsx")
+        if cached is None:
+            # 聚合查询与生成工作簿都是阻塞操作，放到线程池中执行
+            cached = await asyncio.to_thread(reports.build_xlsx, admin_id)
+        body = iter([cached])
+
+    encoded_filename = quote(f"学期考勤汇总.{fmt}")
     return StreamingResponse(
-        buf,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        body,
+        media_type=media_type,
         headers={
             "Content-Disposition": f"attachment; filename*=utf-8''{encoded_filename}"
         }
     )
 
+@router_admin.post("/activities/{activity_code}/notify")
+async def create_notification_campaign(
+    activity_code: str,
+    req: models.NotificationCampaignCreate,
+    current_admin: dict = Depends(security.get_current_admin)
+):
+    """
+    向本组织所有学生群发活动开始提醒 (立即或定时)，返回群发任务 ID 用于查询进度
+    定时群发由调度器 (SCHEDULER_ENABLED) 到期后发送，最多延迟约 30 秒
+    """
+    with db_utils.get_activity_connection(activity_code) as db:
+        activity = db_utils.get_activity_by_code(db, activity_code)
+    if not activity or activity['admin_id'] != current_admin['id']:
+        raise HTTPException(status_code=404, detail="Activity not found")
+
+    send_at = req.send_at
+    if send_at is not None and send_at.tzinfo is not None:
+        # 带时区的时间 (如 ...Z / +08:00) 统一转为服务器本地时间
+        send_at = send_at.astimezone().replace(tzinfo=None)
+    return notifications.start_campaign(current_admin['id'], activity, send_at)
+
+@router_admin.get("/campaigns")
+async def list_notification_campaigns(current_admin: dict = Depends(security.get_current_admin)):
+    """
+    查看本组织最近的群发任务
+    """
+    return notifications.list_campaigns(current_admin['id'])
+
+@router_admin.get("/campaigns/{campaign_id}")
+async def get_notification_campaign(
+    campaign_id: str,
+    current_admin: dict = Depends(security.get_current_admin)
+):
+    """
+    查询群发任务进度
+    """
+    campaign = notifications.get_campaign(campaign_id, current_admin['id'])
+    if not campaign:
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    return campaign
+
+@router_admin.get("/participants/{student_id}/history")
+async def get_participant_history_admin(
+    student_id: str,
+    limit: int = Query(20, ge=1, le=100),
+    cursor: str = Query(None, max_length=200),
+    current_admin: dict = Depends(security.get_current_admin)
+):
+    """
+    查看本组织某学生的签到历史 (按签到时间倒序，游标分页)
+    """
+    with db_utils.get_tenant_read_connection(current_admin['id'], sticky_key=f"admin:{current_admin['id']}") as db:
+        try:
+            logs, next_cursor = db_utils.get_participant_history(db, student_id, current_admin['id'], limit, cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="无效的分页游标")
+    return {"items": logs, "next_cursor": next_cursor}
+
+@router_admin.get("/admission")
+async def get_admission_stats(current_admin: dict = Depends(security.get_current_admin)):
+    """各路由类别的并发数、队列深度与削峰次数"""
+    return admission.snapshot()
+
+def _require_profiling_admin(current_admin: dict):
+    allowed = {name.strip() for name in settings.PROFILING_ADMINS.split(",") if name.strip()}
+    if current_admin['username'] not in allowed:
+        raise HTTPException(status_code=403, detail="没有剖析权限")
+
+@router_admin.get("/profiling/cpu")
+async def profile_cpu(
+    seconds: float = Query(10, gt=0, le=profiler.MAX_PROFILE_SECONDS),
+    interval_ms: float = Query(10, ge=1, le=1000),
+    current_admin: dict = Depends(security.get_current_admin)
+):
+    """
+    对当前 worker 采样剖析 seconds 秒，返回折叠栈文件 (flamegraph.pl / speedscope 可直接打开)
+    多 worker 部署时只剖析处理本请求的那一个 worker (见 X-Profile-Pid)
+    """
+    _require_profiling_admin(current_admin)
+    try:
+        result = await asyncio.to_thread(profiler.sampler.run, seconds, interval_ms / 1000)
+    except profiler.ProfilerBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    pid = os.getpid()
+    filename = f"profile-{pid}-{datetime.now().strftime('%Y%m%d%H%M%S')}.collapsed"
+    return PlainTextResponse(
+        profiler.format_collapsed(result["stacks"]),
+        headers={
+            "Content-Disposition": f"attachment; filename={filename}",
+            "X-Profile-Pid": str(pid),
+            "X-Profile-Samples": str(result["samples"]),
+        }
+    )
+
+@router_admin.put("/profiling/trace")
+async def configure_request_tracing(
+    req: models.TraceConfig,
+    current_admin: dict = Depends(security.get_current_admin)
+):
+    """开启/关闭当前 worker 的请求追踪 (按比例采样请求，记录每次 db_utils 调用与外部 I/O 的耗时)"""
+    _require_profiling_admin(current_admin)
+    profiler.tracer.configure(req.sample_rate)
+    return {"pid": os.getpid(), "sample_rate": profiler.tracer.sample_rate}
+
+@router_admin.get("/profiling/traces")
+async def get_request_traces(
+    limit: int = Query(50, ge=1, le=profiler.MAX_TRACES),
+    current_admin: dict = Depends(security.get_current_admin)
+):
+    """最近被追踪的请求及其各阶段耗时"""
+    _require_profiling_admin(current_admin)
+    return {
+        "pid": os.getpid(),
+        "sample_rate": profiler.tracer.sample_rate,
+        "traces": profiler.tracer.snapshot(limit),
+    }
+
+def _memory_sizes() -> dict:
+    """进程内随流量增长的结构的条目数"""
+    # slowapi 默认的内存存储：每个 (IP, 限流规则) 一个计数器
+    storage = getattr(limiter, "_storage", None)
+    return {
+        "activity_cache": len(cache.activity_cache),
+        "detail_cache": len(cache.detail_cache),
+        "limiter_keys": len(getattr(storage, "storage", ())),
+        "traces": len(profiler.tracer.traces),
+        "anomaly_windows": anomaly.detector.stats()["activities"],
+    }
+
+@router_admin.get("/profiling/memory")
+async def get_memory_snapshot(
+    top: int = Query(15, ge=1, le=100),
+    current_admin: dict = Depends(security.get_current_admin)
+):
+    """
+    当前 worker 的 RSS、文件描述符/套接字、线程、gc 对象数、进程内缓存条目数与 tracemalloc 分配热点
+    (scripts/soak.py 定期采样，检查长时间运行后的内存增长)
+    """
+    _require_profiling_admin(current_admin)
+    return await asyncio.to_thread(profiler.memory_snapshot, top, _memory_sizes())
+
+@router_admin.delete("/campaigns/{campaign_id}")
+async def cancel_notification_campaign(
+    campaign_id: str,
+    current_admin: dict = Depends(security.get_current_admin)
+):
+    """
+    取消尚未开始的定时群发
+    """
+    if not notifications.get_campaign(campaign_id, current_admin['id']):
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    if not notifications.cancel_campaign(campaign_id, current_admin['id']):
+        raise HTTPException(status_code=400, detail="群发已开始或已结束，无法取消")
+    return notifications.get_campaign(campaign_id, current_admin['id'])
+
 @router_admin.delete("/activities/{activity_code}")
 async def delete_activity(
     activity_code: str,
@@ -195,13 +665,16 @@ async def delete_activity(
     """
     删除一个活动 (受保护)
     """
-    with get_db_connection() as db:
+    with db_utils.get_activity_connection(activity_code) as db:
         activity = db_utils.get_activity_by_code(db, activity_code)
         if not activity:
             raise HTTPException(status_code=404, detail="Activity not found")
         
         try:
             db_utils.db_delete_activity(db, activity['id'])
+            db_utils.unregister_activity_tenant(activity_code)
+            db_utils.mark_primary_sticky(f"admin:{activity['admin_id']}")
+            cache_bus.publish([f"activity:{activity_code}", f"report:{activity['admin_id']}"])
             return {"message": "活动及所有签到记录已删除"}
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"删除失败: {e}")
@@ -215,7 +688,7 @@ async def update_activity(
     """
     更新活动信息 (时间、地点、范围)
     """
-    with get_db_connection() as db:
+    with db_utils.get_activity_connection(activity_code) as db:
         activity = db_utils.get_activity_by_code(db, activity_code)
         if not activity:
             raise HTTPException(status_code=404, detail="Activity not found")
@@ -227,52 +700,142 @@ async def update_activity(
             )
             # 返回更新后的最新数据
             updated_activity = db_utils.get_activity_by_code(db, activity_code)
-            return updated_activity
+            db_utils.mark_primary_sticky(f"admin:{updated_activity['admin_id']}")
+            cache_bus.publish([f"activity:{activity_code}"])
+            return db_utils.to_dict(updated_activity)
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"更新失败: {e}")
 
+@router_admin.post("/activities/{activity_code}/batch-checkin")
+async def batch_checkin(
+    activity_code: str,
+    req: models.BatchCheckInRequest,
+    current_admin: dict = Depends(security.get_current_admin)
+):
+    """
+    批量签到 (点名平板 / 离线签到机上传)：
+    地理围栏批量校验，IN 查询一次解析所有学号，单事务 executemany 写入，逐条返回结果
+    """
+    admin_id = current_admin['id']
+    now = datetime.now()
+
+    with db_utils.get_tenant_connection(admin_id) as db:
+        activity = db_utils.get_activity_by_code(db, activity_code)
+        if not activity or activity['admin_id'] != admin_id:
+            raise HTTPException(status_code=404, detail="Activity not found")
+
+        # 活动中心只转换一次
+        act_wgs_lon, act_wgs_lat = cache.wgs_center(float(activity['longitude']), float(activity['latitude']))
+        radius = activity['radius_meters']
+
+        student_ids = list({r.student_id for r in req.records})
+        participants = db_utils.get_participants_by_student_ids(db, student_ids, admin_id)
+        already = db_utils.get_checked_in_participant_ids(db, activity['id'], [p['id'] for p in participants.values()])
+
+        results = []
+        to_insert = []
+        accepted_index = []
+        accepted = 0
+        seen = set()
+        for i, r in enumerate(req.records):
+            result = {"index": i, "student_id": r.student_id, "status": "rejected"}
+            results.append(result)
+
+            ts = r.timestamp
+            if ts.tzinfo is not None:
+                ts = ts.astimezone().replace(tzinfo=None)
+
+            participant = participants.get(r.student_id)
+            if not participant:
+                result["detail"] = "学号未注册"
+                continue
+            if participant['id'] in already or participant['id'] in seen:
+                result["detail"] = "已签到"
+                continue
+            if not (activity['start_time'] <= ts <= activity['end_time']) or ts > now:
+                result["detail"] = "不在活动时间范围内"
+                continue
+
+            req_wgs_lon, req_wgs_lat = coord_utils.gcj2wgs(r.longitude, r.latitude)
+            distance = db_utils.calculate_distance(act_wgs_lat, act_wgs_lon, req_wgs_lat, req_wgs_lon)
+            if distance > radius:
+                result["detail"] = f"不在签到范围内 (距离 {int(distance)} 米)"
+                continue
+
+            seen.add(participant['id'])
+            to_insert.append((participant['id'], ts, r.latitude, r.longitude))
+            accepted_index.append(i)
+
+        if to_insert:
+            try:
+                tokens = db_utils.create_check_logs_bulk(db, activity['id'], to_insert)
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=f"批量签到写入失败: {e}")
+            for i, token in zip(accepted_index, tokens):
+                if token is None:
+                    # 校验之后学生自己完成了签到
+                    results[i]["detail"] = "已签到"
+                    continue
+                results[i]["status"] = "ok"
+                results[i]["device_session_token"] = token
+                accepted += 1
+            if accepted:
+                cache_bus.publish([f"report:{admin_id}"])
+                db_utils.mark_primary_sticky(f"admin:{admin_id}")
+
+    return {
+        "activity_name": activity['name'],
+        "accepted": accepted,
+        "rejected": len(results) - accepted,
+        "results": results,
+    }
+
 # ==================================================
 # 2. 参与者路由 (新增鉴权与邮箱功能)
 # ==================================================
 
+def _not_modified(request: Request, detail: cache.ActivityDetail) -> bool:
+    """条件请求：If-None-Match 优先，其次 If-Modified-Since"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # Nginx gzip 会把强 ETag 改为弱 ETag (W/"...")
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or detail.etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return since.tzinfo is not None and detail.modified_at.astimezone() <= since
+    return False
+
 @router_participant.get("/activity/{activity_code}")
-async def get_activity_details(activity_code: str):
+async def get_activity_details(activity_code: str, request: Request):
     """
     获取单个活动的公开信息 (用于签到页面显示)
+    返回缓存中预先序列化好的 JSON；浏览器带 ETag/Last-Modified 重新验证时未变化返回 304
     """
-    with get_db_connection() as db:
-        activity = db_utils.get_activity_by_code(db, activity_code)
-        if not activity:
-            raise HTTPException(status_code=404, detail="Activity not found")
-    
-    return {
-        "name": activity['name'],
-        "location_name": activity['location_name'],
-        "start_time": activity['start_time'],
-        "end_time": activity['end_time'],
-        "latitude": activity['latitude'],      
-        "longitude": activity['longitude'],    
-        "radius_meters": activity['radius_meters'] 
-    }
+    detail = cache.get_activity_detail(activity_code)
+    if detail is None:
+        raise HTTPException(status_code=404, detail="Activity not found")
+
+    headers = {"ETag": detail.etag, "Last-Modified": detail.last_modified, "Cache-Control": "no-cache"}
+    if _not_modified(request, detail):
+        return Response(status_code=304, headers=headers)
+    return Response(content=detail.body, media_type="application/json", headers=headers)
 
 @router_participant.get("/activity/{activity_code}/qr") 
 async def get_activity_qr_code(activity_code: str):
     """
     为活动生成签到二维码 (公开)
     """
-    with get_db_connection() as db:
-        activity = db_utils.get_activity_by_code(db, activity_code)
+    with db_utils.get_activity_connection(activity_code) as db:
+        activity = cache.get_activity(db, activity_code)
         if not activity:
             raise HTTPException(status_code=404, detail="Activity not found")
 
-    checkin_url = f"https://havenchannel.xyz/students_system/checkin.html?code={activity_code}"
-    
-    img = qrcode.make(checkin_url)
-    buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    buf.seek(0)
-    
-    return StreamingResponse(buf, media_type="image/png")
+    return Response(content=qr_utils.render_checkin_qr(activity_code), media_type="image/png")
 
 # --- 新增：邮箱验证码接口 ---
 @router_participant.post("/send-code")
@@ -280,36 +843,45 @@ async def get_activity_qr_code(activity_code: str):
 async def send_email_code(request: Request, req: models.EmailRequest):
     """发送 6 位数字验证码到邮箱 (使用 HTML 模板)"""
     code = str(random.randint(100000, 999999))
-    
+
+    # 扫码跳转来的：二维码此刻仍有效才记在验证码上，登录成功后再换发保留令牌 (本接口未鉴权，不直接发放)
+    qr_token = None
+    if req.qr_token:
+        try:
+            qr_tokens.verify(req.qr_token)
+            if req.qr_token.count(".") == 1:
+                qr_token = req.qr_token
+        except qr_tokens.QrTokenError:
+            pass  # 二维码已过期：登录后需重新扫码
+
     # 1. 保存到数据库
     with get_db_connection() as db:
-        db_utils.save_verification_code(db, req.email, code)
+        db_utils.save_verification_code(db, req.email, code, qr_token)
     
-    # 2. 发送邮件
+    # 2. 发送邮件 (复用持久化 SMTP 连接池)
     try:
-        # --- 修改开始：使用 HTML 模板 ---
-        # 生成 HTML 内容
         html_content = EmailTemplates.verification_code_email(code, valid_minutes=5)
-        
-        # 构造 MIMEText，注意第二个参数改为 'html'
-        msg = MIMEText(html_content, 'html', 'utf-8')
-        
-        msg['From'] = formataddr(["校园签到系统", settings.SMTP_USER])
-        msg['To'] = req.email
-        msg['Subject'] = "【安全验证】您的登录验证码" # 稍微改一下标题显得更正式
-        # --- 修改结束 ---
-
-        server = smtplib.SMTP_SSL(settings.SMTP_SERVER, settings.SMTP_PORT)
-        server.login(settings.SMTP_USER, settings.SMTP_PASSWORD)
-        server.sendmail(settings.SMTP_USER, [req.email], msg.as_string())
-        server.quit()
-    except Exception as e:
-        print(f"邮件发送失败: {e}")
-        # 在生产环境中，建议记录详细日志
+        await asyncio.to_thread(notifications.send_mail, req.email, "【安全验证】您的登录验证码", html_content)
+    except Exception:
+        logger.exception("邮件发送失败")
         raise HTTPException(status_code=500, detail="邮件发送失败，请检查邮箱地址或联系管理员")
 
     return {"message": "验证码已发送"}
 
+@router_participant.get("/nearby")
+async def get_nearby_activities(
+    latitude: float,
+    longitude: float,
+    max_distance: float = Query(1000, gt=0, le=5000),
+    current_user: dict = Depends(get_current_student)
+):
+    """
+    查找本组织在附近正在进行的活动 (无需扫码)，坐标为高德 GCJ02
+    由内存网格索引直接回答，不查询活动表
+    """
+    wgs_lon, wgs_lat = coord_utils.gcj2wgs(longitude, latitude)
+    return activity_index.nearby(current_user.get('admin_id'), wgs_lat, wgs_lon, max_distance)
+
 # 新增：获取当前签到状态接口
 @router_participant.get("/status")
 async def get_current_status(current_user: dict = Depends(get_current_student)):
@@ -317,7 +889,8 @@ async def get_current_status(current_user: dict = Depends(get_current_student)):
     # 新增：从 Token 解析出的 current_user 中获取 admin_id
     admin_id = current_user.get('admin_id') 
     
-    with get_db_connection() as db:
+    # 刚签到/签退的学生短时间内读主库，其余读取走只读副本
+    with db_utils.get_tenant_read_connection(admin_id, sticky_key=f"participant:{admin_id}:{student_id}") as db:
         # 修改：传入 admin_id
         participant = db_utils.get_participant(db, student_id, admin_id)
         
@@ -338,21 +911,61 @@ async def get_current_status(current_user: dict = Depends(get_current_student)):
         else:
             return {"is_checked_in": False}
 
+@router_participant.get("/history")
+async def get_my_history(
+    limit: int = Query(20, ge=1, le=100),
+    cursor: str = Query(None, max_length=200),
+    current_user: dict = Depends(get_current_student)
+):
+    """
+    我的签到历史 (按签到时间倒序，游标分页)，下一页请求带上返回的 next_cursor
+    """
+    student_id = current_user['sub']
+    admin_id = current_user.get('admin_id')
+    with db_utils.get_tenant_read_connection(admin_id, sticky_key=f"participant:{admin_id}:{student_id}") as db:
+        try:
+            logs, next_cursor = db_utils.get_participant_history(db, student_id, admin_id, limit, cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="无效的分页游标")
+    return {"items": logs, "next_cursor": next_cursor}
+
+def _find_or_register_student(db, req: models.StudentLogin, target_admin_id: int):
+    student = db_utils.get_participant_by_email_and_admin(db, req.email, target_admin_id)
+    
+    # 4. 注册逻辑
+    if not student:
+        if not req.student_id or not req.name:
+            # 返回特定状态码，告诉前端需要弹出注册框
+            raise HTTPException(status_code=400, detail="NEED_REGISTER_INFO")
+        
+        # 检查该学校下学号是否被占用
+        if db_utils.get_participant(db, req.student_id, target_admin_id):
+             raise HTTPException(status_code=400, detail="该学号在当前组织已被绑定")
+        
+        try:
+            # 注册时传入 admin_id
+            db_utils.register_student_with_email(db, req.student_id, req.name, req.email, target_admin_id)
+            student = db_utils.get_participant_by_email_and_admin(db, req.email, target_admin_id)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail="注册失败")
+    return student
+
 # [修改 3] 根据要求修改 login_with_email
 @router_participant.post("/login", response_model=models.Token)
 async def login_with_email(req: models.StudentLogin):
     """邮箱登录/注册一体化接口 (多租户版)"""
     with get_db_connection() as db:
         # 1. 校验验证码
-        valid_code = db_utils.get_valid_code(db, req.email)
+        code_record = db_utils.get_valid_code_record(db, req.email)
         
-        if not valid_code or valid_code != req.code:
+        if not code_record or code_record['code'] != req.code:
             raise HTTPException(status_code=400, detail="验证码错误或已过期")
             
         # 2. 【核心】确定上下文 (是哪个学校？)
         target_admin_id = None
         if req.activity_code: 
-            activity = db_utils.get_activity_by_code(db, req.activity_code)
+            with db_utils.get_activity_connection(req.activity_code, reuse=db) as activity_db:
+                activity = db_utils.get_activity_by_code(activity_db, req.activity_code)
             if activity:
                 target_admin_id = activity['admin_id']
         
@@ -360,26 +973,10 @@ async def login_with_email(req: models.StudentLogin):
         if not target_admin_id:
              raise HTTPException(status_code=400, detail="请通过扫描活动二维码进行注册/登录")
 
-        # 3. 在特定学校下查询用户
-        student = db_utils.get_participant_by_email_and_admin(db, req.email, target_admin_id)
+        # 3. 在特定学校下查询用户 (学生数据在该学校所在的分片)
+        with db_utils.get_tenant_connection(target_admin_id, reuse=db) as tenant_db:
+            student = _find_or_register_student(tenant_db, req, target_admin_id)
         
-        # 4. 注册逻辑
-        if not student:
-            if not req.student_id or not req.name:
-                # 返回特定状态码，告诉前端需要弹出注册框
-                raise HTTPException(status_code=400, detail="NEED_REGISTER_INFO")
-            
-            # 检查该学校下学号是否被占用
-            if db_utils.get_participant(db, req.student_id, target_admin_id):
-                 raise HTTPException(status_code=400, detail="该学号在当前组织已被绑定")
-            
-            try:
-                # 注册时传入 admin_id
-                db_utils.register_student_with_email(db, req.student_id, req.name, req.email, target_admin_id)
-                student = db_utils.get_participant_by_email_and_admin(db, req.email, target_admin_id)
-            except Exception as e:
-                raise HTTPException(status_code=500, detail="注册失败")
-
         # 5. 生成 Token (Payload 中放入学号 student_id 和 admin_id)
         access_token = security.create_access_token(
             data={
@@ -388,12 +985,45 @@ async def login_with_email(req: models.StudentLogin):
                 "admin_id": target_admin_id # <--- 放入 Token
             } 
         )
-        return {"access_token": access_token, "token_type": "bearer"}
+        refresh_token = security.issue_refresh_token(db, "student", student['student_id'], target_admin_id)
+
+    # 6. 请求验证码时附带了有效的动态二维码：换发绑定该邮箱的保留令牌，截止时间从请求验证码时算起
+    held_qr_token = None
+    if code_record['qr_token']:
+        try:
+            held_qr_token = qr_tokens.hold(code_record['qr_token'], req.email,
+                                           code_record['qr_requested_at'].timestamp())
+        except qr_tokens.QrTokenError:
+            pass
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token,
+            "qr_token": held_qr_token}
+
+@router_participant.post("/refresh", response_model=models.Token)
+async def refresh_student_token(req: models.RefreshRequest):
+    """访问令牌过期后静默续期，不再发送邮箱验证码"""
+    with get_db_connection() as db:
+        record, refresh_token = security.rotate_refresh_token(db, req.refresh_token, "student")
+        with db_utils.get_tenant_connection(record['admin_id'], reuse=db) as tenant_db:
+            participant = db_utils.get_participant(tenant_db, record['subject'], record['admin_id'])
+        if not participant:
+            security.revoke_refresh_token(db, refresh_token)
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="登录已过期，请重新登录")
+    access_token = security.create_access_token(
+        data={"sub": record['subject'], "role": "student", "admin_id": record['admin_id']}
+    )
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token}
+
+@router_participant.post("/logout")
+async def logout_student(req: models.RefreshRequest):
+    with get_db_connection() as db:
+        security.revoke_refresh_token(db, req.refresh_token)
+    return {"message": "已退出登录"}
 
 # [修改 4] 根据要求修改 checkin_authorized
 @router_participant.post("/checkin-auth", response_model=models.CheckInResponse)
 async def checkin_authorized(
     request: models.CheckInRequestAuthorized, 
+    http_request: Request,
     current_user: dict = Depends(get_current_student) 
 ):
     """已登录用户的签到接口"""
@@ -401,18 +1031,39 @@ async def checkin_authorized(
     # 新增：获取 admin_id
     admin_id = current_user.get('admin_id') 
 
+    # 动态二维码：令牌中已包含活动信息，校验签名即可，无需查询活动
+    token_activity = None
+    if request.qr_token:
+        try:
+            token_activity = qr_tokens.verify(request.qr_token)
+        except qr_tokens.QrTokenError as e:
+            return JSONResponse(status_code=200, content={"detail": str(e)})
+        if token_activity['unique_code'] != request.activity_code:
+            return JSONResponse(status_code=200, content={"detail": "二维码与活动不符"})
+        owner_admin_id = token_activity['admin_id']
+    else:
+        # 启用分片时，其他组织的活动不在本组织的分片上，先按目录判断归属
+        owner_admin_id = db_utils.resolve_activity_tenant(request.activity_code)
+    if owner_admin_id is not None and owner_admin_id != admin_id:
+        return JSONResponse(status_code=200, content={"detail": "您无权签到该活动 (组织不匹配)"})
+
     try:
-        with get_db_connection() as db:
+        with db_utils.get_tenant_connection(admin_id) as db:
             # 修改：传入 admin_id 查找学生
             participant = db_utils.get_participant(db, student_id, admin_id)
             if not participant:
                 raise HTTPException(status_code=401, detail="用户不存在")
+            if token_activity and not qr_tokens.hold_matches(token_activity, participant['email']):
+                return JSONResponse(status_code=200, content={"detail": "二维码无效"})
 
             now = datetime.now()
-            activity = db_utils.get_activity_by_code(db, request.activity_code)
+            activity = token_activity or cache.get_activity(db, request.activity_code)
             
             if not activity:
                 return JSONResponse(status_code=200, content={"detail": "活动不存在"})
+
+            if not token_activity and activity.get('dynamic_qr'):
+                return JSONResponse(status_code=200, content={"detail": "该活动需扫描现场动态二维码签到"})
             
             # 新增校验：防止 A 学校的学生扫 B 学校的码签到
             if activity['admin_id'] != admin_id:
@@ -425,7 +1076,7 @@ async def checkin_authorized(
             try:
                 act_lon_float = float(activity['longitude'])
                 act_lat_float = float(activity['latitude'])
-                act_wgs_lon, act_wgs_lat = coord_utils.gcj2wgs(act_lon_float, act_lat_float)
+                act_wgs_lon, act_wgs_lat = cache.wgs_center(act_lon_float, act_lat_float)
                 
                 req_lon_float = float(request.longitude)
                 req_lat_float = float(request.latitude)
@@ -436,27 +1087,45 @@ async def checkin_authorized(
                     req_wgs_lat, req_wgs_lon
                 )
             except Exception as e:
-                print(f"Check-in calc error: {e}")
+                logger.exception("Check-in calc error")
                 raise HTTPException(status_code=500, detail=f"定位计算失败: {str(e)}")
                 
             if distance > activity['radius_meters']:
                 return JSONResponse(status_code=200, content={"detail": f"您不在签到范围内 (距离 {int(distance)} 米)"})
 
-            # --- 检查重复签到 ---
+            # --- 检查重复签到 (同一动态令牌的重复提交在内存中直接拒绝) ---
+            if token_activity and not qr_tokens.replay_cache.add(request.qr_token, admin_id, student_id):
+                raise HTTPException(status_code=400, detail="您已签到，请勿重复操作")
             if db_utils.get_check_log(db, participant['id'], activity['id']):
                 raise HTTPException(status_code=400, detail="您已签到，请勿重复操作")
+            if token_activity:
+                # 令牌签发后活动可能已被删除 (令牌本身仍然有效)
+                stored_activity = cache.get_activity(db, request.activity_code)
+                if not stored_activity or stored_activity['id'] != token_activity['id']:
+                    raise HTTPException(status_code=404, detail="活动不存在")
 
             # --- 写入记录 ---
             device_token = db_utils.create_check_log(
                 db, activity['id'], participant['id'], request.latitude, request.longitude
             )
+            if device_token is None:
+                raise HTTPException(status_code=400, detail="您已签到，请勿重复操作")
+            cache_bus.publish([f"report:{admin_id}"])
+            db_utils.mark_primary_sticky(f"participant:{admin_id}:{student_id}")
+            anomaly.detector.observe(admin_id, activity['id'], participant['id'],
+                                     request.latitude, request.longitude, get_remote_address(http_request))
+            if settings.SEND_CHECKIN_RECEIPT:
+                if token_activity:
+                    # 回执需要活动名称与地点，令牌中不携带
+                    activity = stored_activity
+                notifications.send_checkin_receipt(participant['email'], participant['name'], activity, now)
             return {"message": "签到成功", "device_session_token": device_token}
             
     except HTTPException:
         raise
     except Exception as e:
         # 这里会捕获 TypeError (参数缺失) 并转为 500，就是你看到的报错
-        print(f"Error in checkin: {e}") 
+        logger.exception("Error in checkin")
         raise HTTPException(status_code=500, detail=f"签到未知错误: {str(e)}")
 
 
@@ -470,42 +1139,43 @@ async def checkout_authorized(
     # 新增：获取 admin_id
     admin_id = current_user.get('admin_id')
     
-    with get_db_connection() as db:
-        # 修改：传入 admin_id
-        participant = db_utils.get_participant(db, student_id, admin_id)
-        if not participant:
-            raise HTTPException(status_code=401, detail="用户不存在")
-            
-        # 2. 找记录 (查该用户当前活动的未签退记录)
-        active_log = db_utils.get_active_log_by_student(db, participant['id'])
-        
-        if not active_log:
-             raise HTTPException(status_code=400, detail="未找到有效的签到记录，或已签退")
-             
-        # 3. 校验活动是否匹配
-        if active_log['unique_code'] != request.activity_code:
-             raise HTTPException(status_code=400, detail="您当前的签到记录与此活动不符")
-
-        # 4. 校验时间
+    with db_utils.get_tenant_connection(admin_id) as db:
+        # 1. 活动信息走缓存 (与签到相同)，时间与地点在 Python 中校验
+        activity = cache.get_activity(db, request.activity_code)
+        if not activity or activity['admin_id'] != admin_id:
+            raise HTTPException(status_code=400, detail="您当前的签到记录与此活动不符")
+
         now = datetime.now()
-        if not (active_log['start_time'] <= now <= active_log['end_time']):
+        if not (activity['start_time'] <= now <= activity['end_time']):
              raise HTTPException(status_code=400, detail="不在活动时间范围内")
 
-        # 5. 校验地点
         try:
-            act_wgs_lat, act_wgs_lon = coord_utils.gcj2wgs(float(active_log['longitude']), float(active_log['latitude']))
-            req_wgs_lat, req_wgs_lon = coord_utils.gcj2wgs(float(request.longitude), float(request.latitude))
+            act_wgs_lon, act_wgs_lat = cache.wgs_center(float(activity['longitude']), float(activity['latitude']))
+            req_wgs_lon, req_wgs_lat = coord_utils.gcj2wgs(float(request.longitude), float(request.latitude))
             distance = db_utils.calculate_distance(act_wgs_lat, act_wgs_lon, req_wgs_lat, req_wgs_lon)
         except Exception:
             distance = 0
             
-        if distance > active_log['radius_meters']:
+        if distance > activity['radius_meters']:
              return JSONResponse(status_code=200, content={"detail": f"您不在签退范围内 (距离 {int(distance)} 米)"})
 
-        # 6. 执行签退
-        db_utils.update_check_log_checkout(db, active_log['id'], request.latitude, request.longitude)
-        
-        return {"message": "签退成功"}
+        # 2. 一条带条件的 UPDATE 完成签退，按影响行数判断是否生效
+        if db_utils.checkout_check_log(db, student_id, admin_id, request.activity_code,
+                                       request.latitude, request.longitude, now):
+            cache_bus.publish([f"report:{admin_id}"])
+            db_utils.mark_primary_sticky(f"participant:{admin_id}:{student_id}")
+            return {"message": "签退成功"}
+
+        # 3. 未生效 (仅失败路径多查一次)：重试或另一台设备已签退时按成功返回，不覆盖原签退记录
+        participant = db_utils.get_participant(db, student_id, admin_id)
+        if not participant:
+            raise HTTPException(status_code=401, detail="用户不存在")
+        log = db_utils.get_check_log(db, participant['id'], activity['id'])
+        if log and log['check_out_time'] is not None:
+            return {"message": "签退成功", "already_checked_out": True}
+        if not log and db_utils.get_active_log_by_student(db, participant['id']):
+            raise HTTPException(status_code=400, detail="您当前的签到记录与此活动不符")
+        raise HTTPException(status_code=400, detail="未找到有效的签到记录，或已签退")
 
 # ==================================================
 # 3. 注册路由和静态文件
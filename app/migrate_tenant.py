@@ -0,0 +1,289 @@
+"""
+在线迁移一个租户 (管理员及其学生、活动、签到记录) 到另一个数据库分片
+
+    python -m app.migrate_tenant --admin-id 3 --to shard_b            # 迁移并切换
+    python -m app.migrate_tenant --admin-id 3 --to shard_b --cleanup  # 切换后删除源分片上的数据
+
+流程：
+1. 在线复制：服务照常运行，按主键分批把 participants / activity_series / activities / check_logs 复制到目标分片
+   (目标分片的自增 ID 与源分片不同，复制时重新映射外键)
+2. 冻结：tenant_shards 标记为 frozen，各节点在 TENANT_MAP_REFRESH_SECONDS 内对该租户返回 503 (重试)
+3. 补齐：复制冻结前新增的记录，同步活动修改、删除以及之后才签退的记录
+4. 切换：tenant_shards 指向目标分片并解除冻结，广播缓存失效让各节点按新分片重建活动缓存/索引/排程
+冻结窗口通常只有几秒；任何一步失败都会解除冻结并保持在源分片。
+"""
+
+import argparse
+import time
+
+from . import cache_bus
+from . import db_utils
+from .config import settings
+from .db_utils import get_db_connection, get_shard_connection
+
+PARTICIPANT_COLUMNS = ("student_id", "name", "email", "admin_id", "created_at")
+SERIES_COLUMNS = ("admin_id", "name", "location_name", "latitude", "longitude", "radius_meters", "dynamic_qr",
+                  "weekdays", "interval_weeks", "start_date", "until_date", "start_clock", "end_clock",
+                  "materialized_until", "created_at")
+ACTIVITY_COLUMNS = ("unique_code", "name", "location_name", "latitude", "longitude", "radius_meters",
+                    "start_time", "end_time", "admin_id", "dynamic_qr", "series_id", "created_at")
+LOG_COLUMNS = ("activity_id", "participant_id", "device_session_token", "check_in_time", "check_out_time",
+               "check_in_lat", "check_in_lon", "check_out_lat", "check_out_lon", "anomaly")
+
+
+class TenantCopier:
+    def __init__(self, admin_id: int, source, target, batch_size: int):
+        self.admin_id = admin_id
+        self.source = source
+        self.target = target
+        self.batch_size = batch_size
+        self.participant_ids = {}   # 源 id -> 目标 id
+        self.activity_ids = {}
+        self.series_ids = {}
+        self.last_participant_id = 0
+        self.last_log_id = 0
+        self.open_logs = {}         # 复制时尚未签退的记录：源 id -> 目标 id
+
+    def _fetch(self, query: str, params: tuple) -> list:
+        cursor = self.source.cursor(dictionary=True)
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
+
+    def _insert(self, table: str, columns: tuple, row: dict) -> int:
+        cursor = self.target.cursor()
+        cursor.execute(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})",
+            tuple(row[c] for c in columns)
+        )
+        new_id = cursor.lastrowid
+        cursor.close()
+        return new_id
+
+    def ensure_target_empty(self):
+        cursor = self.target.cursor()
+        cursor.execute("SELECT COUNT(*) FROM participants WHERE admin_id = %s", (self.admin_id,))
+        participants = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FROM activities WHERE admin_id = %s", (self.admin_id,))
+        activities = cursor.fetchone()[0]
+        cursor.close()
+        if participants or activities:
+            raise RuntimeError("目标分片上已有该租户的数据，请先清理后再迁移")
+
+    def log_watermark(self) -> int:
+        rows = self._fetch(
+            "SELECT COALESCE(MAX(cl.id), 0) AS max_id FROM check_logs cl "
+            "JOIN activities a ON cl.activity_id = a.id WHERE a.admin_id = %s",
+            (self.admin_id,)
+        )
+        return rows[0]['max_id']
+
+    def copy_participants(self):
+        while True:
+            rows = self._fetch(
+                "SELECT * FROM participants WHERE admin_id = %s AND id > %s ORDER BY id LIMIT %s",
+                (self.admin_id, self.last_participant_id, self.batch_size)
+            )
+            if not rows:
+                break
+            for row in rows:
+                self.participant_ids[row['id']] = self._insert("participants", PARTICIPANT_COLUMNS, row)
+                self.last_participant_id = row['id']
+            self.target.commit()
+
+    def sync_series(self):
+        """周期活动系列：同 sync_activities，需在其之前执行以便映射 series_id"""
+        rows = self._fetch("SELECT * FROM activity_series WHERE admin_id = %s ORDER BY id", (self.admin_id,))
+        alive = set()
+        cursor = self.target.cursor()
+        for row in rows:
+            alive.add(row['id'])
+            target_id = self.series_ids.get(row['id'])
+            if target_id is None:
+                self.series_ids[row['id']] = self._insert("activity_series", SERIES_COLUMNS, row)
+            else:
+                cursor.execute(
+                    f"UPDATE activity_series SET {', '.join(f'{c} = %s' for c in SERIES_COLUMNS)} WHERE id = %s",
+                    tuple(row[c] for c in SERIES_COLUMNS) + (target_id,)
+                )
+        for source_id in list(self.series_ids):
+            if source_id not in alive:
+                cursor.execute("DELETE FROM activity_series WHERE id = %s", (self.series_ids.pop(source_id),))
+        cursor.close()
+        self.target.commit()
+
+    def sync_activities(self):
+        """新增的活动插入，已复制的按源数据更新，源上已删除的在目标上删除 (级联签到记录)"""
+        rows = self._fetch("SELECT * FROM activities WHERE admin_id = %s ORDER BY id", (self.admin_id,))
+        alive = set()
+        cursor = self.target.cursor()
+        for row in rows:
+            alive.add(row['id'])
+            row = dict(row, series_id=self.series_ids.get(row['series_id']))
+            target_id = self.activity_ids.get(row['id'])
+            if target_id is None:
+                self.activity_ids[row['id']] = self._insert("activities", ACTIVITY_COLUMNS, row)
+            else:
+                cursor.execute(
+                    "UPDATE activities SET name = %s, location_name = %s, latitude = %s, longitude = %s, "
+                    "radius_meters = %s, start_time = %s, end_time = %s, dynamic_qr = %s, series_id = %s WHERE id = %s",
+                    (row['name'], row['location_name'], row['latitude'], row['longitude'], row['radius_meters'],
+                     row['start_time'], row['end_time'], row['dynamic_qr'], row['series_id'], target_id)
+                )
+        for source_id in list(self.activity_ids):
+            if source_id not in alive:
+                cursor.execute("DELETE FROM activities WHERE id = %s", (self.activity_ids.pop(source_id),))
+        cursor.close()
+        self.target.commit()
+
+    def copy_logs(self, up_to: int = None):
+        while True:
+            query = ("SELECT cl.* FROM check_logs cl JOIN activities a ON cl.activity_id = a.id "
+                     "WHERE a.admin_id = %s AND cl.id > %s")
+            params = [self.admin_id, self.last_log_id]
+            if up_to is not None:
+                query += " AND cl.id <= %s"
+                params.append(up_to)
+            rows = self._fetch(query + " ORDER BY cl.id LIMIT %s", tuple(params + [self.batch_size]))
+            if not rows:
+                break
+            for row in rows:
+                self.last_log_id = row['id']
+                if row['activity_id'] not in self.activity_ids or row['participant_id'] not in self.participant_ids:
+                    continue  # 活动已被删除
+                row = dict(row, activity_id=self.activity_ids[row['activity_id']],
+                           participant_id=self.participant_ids[row['participant_id']])
+                target_id = self._insert("check_logs", LOG_COLUMNS, row)
+                if row['check_out_time'] is None:
+                    self.open_logs[row['id']] = target_id
+            self.target.commit()
+
+    def sync_checkouts(self):
+        """复制时尚未签退、之后签退 (含自动签退) 的记录"""
+        if not self.open_logs:
+            return
+        source_ids = list(self.open_logs)
+        cursor = self.target.cursor()
+        for start in range(0, len(source_ids), self.batch_size):
+            chunk = source_ids[start:start + self.batch_size]
+            placeholders = ", ".join(["%s"] * len(chunk))
+            rows = self._fetch(
+                f"SELECT id, check_out_time, check_out_lat, check_out_lon FROM check_logs "
+                f"WHERE id IN ({placeholders}) AND check_out_time IS NOT NULL",
+                tuple(chunk)
+            )
+            cursor.executemany(
+                "UPDATE check_logs SET check_out_time = %s, check_out_lat = %s, check_out_lon = %s WHERE id = %s",
+                [(r['check_out_time'], r['check_out_lat'], r['check_out_lon'], self.open_logs[r['id']]) for r in rows]
+            )
+        cursor.close()
+        self.target.commit()
+
+
+def delete_tenant_rows(db, admin_id: int):
+    """删除某分片上该租户的全部数据 (签到记录随活动级联删除)"""
+    cursor = db.cursor()
+    try:
+        cursor.execute("DELETE FROM activities WHERE admin_id = %s", (admin_id,))
+        cursor.execute("DELETE FROM activity_series WHERE admin_id = %s", (admin_id,))
+        cursor.execute("DELETE FROM participants WHERE admin_id = %s", (admin_id,))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def wait_for_nodes():
+    # 等待所有节点重新加载 tenant_shards，并让进行中的请求完成
+    time.sleep(settings.TENANT_MAP_REFRESH_SECONDS + 2)
+
+
+def migrate(admin_id: int, target_shard: str, batch_size: int, cleanup: bool):
+    source_shard = db_utils.shard_router.shard_for(admin_id)
+    db_utils.shard_router.shard_config(target_shard)  # 校验目标分片已配置
+    if source_shard == target_shard:
+        print(f"租户 {admin_id} 已在分片 {target_shard} 上")
+        return
+
+    print(f"迁移租户 {admin_id}: {source_shard} -> {target_shard}")
+    with get_shard_connection(source_shard) as source, get_shard_connection(target_shard) as target:
+        copier = TenantCopier(admin_id, source, target, batch_size)
+        copier.ensure_target_empty()
+
+        # 1. 在线复制 (签到记录只复制到开始时的水位，之后的在冻结后补齐)
+        watermark = copier.log_watermark()
+        copier.copy_participants()
+        copier.sync_series()
+        copier.sync_activities()
+        copier.copy_logs(up_to=watermark)
+        print(f"在线复制完成：学生 {len(copier.participant_ids)}，活动 {len(copier.activity_ids)}，"
+              f"签到记录至 #{copier.last_log_id}")
+
+        # 2. 冻结
+        with get_db_connection() as db:
+            db_utils.set_tenant_shard(db, admin_id, source_shard, "frozen")
+        switched = False
+        try:
+            wait_for_nodes()
+            source.commit()  # 结束源连接上的快照，读取冻结前的最新数据
+
+            # 3. 补齐
+            copier.copy_participants()
+            copier.sync_series()
+            copier.sync_activities()
+            copier.copy_logs()
+            copier.sync_checkouts()
+
+            # 4. 切换
+            with get_db_connection() as db:
+                db_utils.set_tenant_shard(db, admin_id, target_shard, "active")
+            switched = True
+        finally:
+            if not switched:
+                with get_db_connection() as db:
+                    db_utils.set_tenant_shard(db, admin_id, source_shard, "active")
+                print("迁移失败，已解除冻结，租户仍在源分片")
+
+    # 活动 ID 已变化，通知各节点重建活动缓存、空间索引和排程
+    cache_bus.bus.start()
+    cache_bus.publish([f"activity:{row['unique_code']}" for row in _activity_codes(target_shard, admin_id)]
+                      + [f"report:{admin_id}"])
+    print(f"切换完成，租户 {admin_id} 现在位于分片 {target_shard}")
+
+    if cleanup:
+        wait_for_nodes()
+        with get_shard_connection(source_shard) as source:
+            delete_tenant_rows(source, admin_id)
+        print(f"已删除源分片 {source_shard} 上的数据")
+    cache_bus.bus.stop()
+
+
+def _activity_codes(shard: str, admin_id: int) -> list:
+    with get_shard_connection(shard) as db:
+        cursor = db.cursor(dictionary=True)
+        cursor.execute("SELECT unique_code FROM activities WHERE admin_id = %s", (admin_id,))
+        rows = cursor.fetchall()
+        cursor.close()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="在线迁移租户到另一个数据库分片")
+    parser.add_argument("--admin-id", type=int, required=True, help="要迁移的管理员 (租户) ID")
+    parser.add_argument("--to", required=True, help="目标分片名 (DB_SHARDS 中的名称或 default)")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--cleanup", action="store_true", help="切换后删除源分片上的数据")
+    args = parser.parse_args()
+
+    try:
+        migrate(args.admin_id, args.to, args.batch_size, args.cleanup)
+    except Exception as e:
+        print(f"迁移失败: {e}")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
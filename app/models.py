@@ -1,6 +1,6 @@
-from pydantic import BaseModel
-from typing import Optional
-from datetime import datetime
+from pydantic import BaseModel, Field
+from typing import Optional, List, Annotated
+from datetime import datetime, date, time
 
 # --- 管理员认证模型 ---
 class AdminLogin(BaseModel):
@@ -10,6 +10,12 @@ class AdminLogin(BaseModel):
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
+    # 学生扫动态二维码后登录时返回的保留令牌
+    qr_token: Optional[str] = None
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
 
 class TokenData(BaseModel):
     username: Optional[str] = None
@@ -23,6 +29,8 @@ class ActivityCreate(BaseModel):
     radius_meters: int
     start_time: datetime
     end_time: datetime
+    # 动态二维码：只接受投屏页上定时刷新的签名令牌，截图转发很快失效
+    dynamic_qr: bool = False
 
 class ActivityResponse(ActivityCreate):
     id: int
@@ -32,6 +40,8 @@ class ActivityResponse(ActivityCreate):
 # --- 新增：学生认证相关 ---
 class EmailRequest(BaseModel):
     email: str
+    # 扫描动态二维码后跳转登录时附带，记在验证码上，登录成功后换取保留令牌
+    qr_token: Optional[str] = None
 
 class StudentLogin(BaseModel):
     email: str
@@ -45,6 +55,8 @@ class CheckInRequestAuthorized(BaseModel):
     activity_code: str
     latitude: float
     longitude: float
+    # 扫描动态二维码时附带的签名令牌
+    qr_token: Optional[str] = None
 
 
 # --- 参与者模型 ---
@@ -72,4 +84,56 @@ class ActivityUpdate(BaseModel):
     radius_meters: int
     location_name: str
     latitude: float
-    longitude: float
\ No newline at end of file
+    longitude: float
+    # 为空表示不修改
+    dynamic_qr: Optional[bool] = None
+
+# --- 周期活动 (系列) ---
+class ActivitySeriesCreate(BaseModel):
+    name: str
+    location_name: str
+    latitude: float
+    longitude: float
+    radius_meters: int
+    dynamic_qr: bool = False
+    # 每周的哪几天举行：0=周一 ... 6=周日
+    weekdays: List[Annotated[int, Field(ge=0, le=6)]] = Field(..., min_length=1, max_length=7)
+    # 每隔几周举行一次 (1 为每周)
+    interval_weeks: int = Field(1, ge=1, le=8)
+    start_date: date
+    # 为空表示一直重复
+    until_date: Optional[date] = None
+    # 每次的开始/结束时刻；结束早于开始表示跨过午夜
+    start_clock: time
+    end_clock: time
+
+class ActivitySeriesUpdate(BaseModel):
+    """系列级修改，作用于所有尚未开始的场次；为空的字段不修改"""
+    name: Optional[str] = None
+    location_name: Optional[str] = None
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    radius_meters: Optional[int] = None
+    dynamic_qr: Optional[bool] = None
+    start_clock: Optional[time] = None
+    end_clock: Optional[time] = None
+
+# --- 群发通知 ---
+class NotificationCampaignCreate(BaseModel):
+    # 为空表示立即发送
+    send_at: Optional[datetime] = None
+
+# --- 批量签到 (点名平板 / 离线签到机) ---
+class BatchCheckInRecord(BaseModel):
+    student_id: str
+    timestamp: datetime
+    latitude: float
+    longitude: float
+
+class BatchCheckInRequest(BaseModel):
+    records: List[BatchCheckInRecord] = Field(..., min_length=1, max_length=2000)
+
+# --- 线上剖析 ---
+class TraceConfig(BaseModel):
+    # 被追踪请求的比例，0 表示关闭
+    sample_rate: float = Field(..., ge=0, le=1)
@@ -0,0 +1,356 @@
+# app/notifications.py
+"""
+邮件发送与群发通知
+- SMTPPool：少量持久化 SMTP 连接，避免每封邮件重新握手/登录
+- 群发活动：模板只渲染一次，收件人按批次放入信封 (BCC)，全局每分钟限速；
+  任务与进度保存在 notification_campaigns 表，任一 worker 都能查询，定时任务由调度器到期后抢占发送
+- 验证码、签到回执等事务邮件走独立的小连接池且不计入群发限速，群发进行中也能及时送达
+smtplib / email 包在首次发信时才导入，连接池也在首次使用时创建
+"""
+
+import itertools
+import logging
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from .config import settings
+from . import db_utils
+from .db_utils import get_db_connection
+from .email_templates import EmailTemplates
+
+logger = logging.getLogger(__name__)
+
+SENDER_NAME = "校园签到系统"
+MAX_LISTED_CAMPAIGNS = 200
+# running 状态的任务超过这么久没有进度，视为发送它的进程已退出
+CAMPAIGN_STALE_AFTER = timedelta(minutes=10)
+
+
+class SMTPPool:
+    """
+    持久化 SMTP 连接池
+    连接按需建立，最多 size 个；连接断开时自动重连重试一次
+    """
+
+    def __init__(self, size: int):
+        self.size = max(1, size)
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        import smtplib
+        if settings.SMTP_USE_SSL:
+            server = smtplib.SMTP_SSL(settings.SMTP_SERVER, settings.SMTP_PORT, timeout=30)
+        else:
+            server = smtplib.SMTP(settings.SMTP_SERVER, settings.SMTP_PORT, timeout=30)
+        if settings.SMTP_PASSWORD:
+            server.login(settings.SMTP_USER, settings.SMTP_PASSWORD)
+        return server
+
+    def _acquire(self):
+        while True:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            # 连接都在使用中：等待归还，超时后重新检查 (期间可能有连接被丢弃)
+            try:
+                return self._idle.get(timeout=1)
+            except queue.Empty:
+                continue
+
+    def _discard(self, server):
+        with self._lock:
+            self._created -= 1
+        try:
+            server.close()
+        except Exception:
+            pass
+
+    def sendmail(self, recipients: list, message: str) -> dict:
+        """发送一封邮件到一批收件人 (同一 SMTP 事务)，返回被拒绝的收件人"""
+        import smtplib
+        server = self._acquire()
+        try:
+            try:
+                refused = server.sendmail(settings.SMTP_USER, recipients, message)
+            except smtplib.SMTPServerDisconnected:
+                # 空闲连接被服务器关闭，重连后重试一次
+                self._discard(server)
+                server = None  # 重连失败时不能再次丢弃 (否则 _created 被重复扣减)
+                server = self._acquire()
+                refused = server.sendmail(settings.SMTP_USER, recipients, message)
+        except smtplib.SMTPRecipientsRefused:
+            # 全部收件人被拒绝，连接本身仍然可用
+            self._idle.put(server)
+            raise
+        except Exception:
+            if server is not None:
+                self._discard(server)
+            raise
+        self._idle.put(server)
+        return refused
+
+    def close_all(self):
+        while True:
+            try:
+                server = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(server)
+            try:
+                server.quit()
+            except Exception:
+                pass
+
+
+class RateLimiter:
+    """按每分钟消息数限速 (预约式：并发调用者各自睡眠到分配的时间点)"""
+
+    def __init__(self, per_minute: int):
+        self.interval = 60.0 / max(1, per_minute)
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, n: int = 1):
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + n * self.interval
+        wait = start - now
+        if wait > 0:
+            time.sleep(wait)
+
+
+_pool = None
+_transactional_pool = None
+_rate_limiter = None
+_executor = None
+_transactional_executor = None
+_init_lock = threading.Lock()
+
+
+def _ensure_initialized():
+    """首次发信时创建连接池、限速器与发送线程池"""
+    global _pool, _transactional_pool, _rate_limiter, _executor, _transactional_executor
+    if _pool is not None:
+        return
+    with _init_lock:
+        if _pool is None:
+            pool = SMTPPool(settings.SMTP_POOL_SIZE)
+            _transactional_pool = SMTPPool(settings.SMTP_TRANSACTIONAL_POOL_SIZE)
+            _rate_limiter = RateLimiter(settings.MAIL_RATE_PER_MINUTE)
+            # 批次发送线程数与连接池大小一致
+            _executor = ThreadPoolExecutor(max_workers=pool.size, thread_name_prefix="mail")
+            _transactional_executor = ThreadPoolExecutor(
+                max_workers=_transactional_pool.size, thread_name_prefix="mail-tx"
+            )
+            _pool = pool
+
+
+def build_message(html: str, subject: str, to: str = None) -> str:
+    """构造 HTML 邮件；群发时 To 头写发件人，真实收件人只放在信封里"""
+    from email.mime.text import MIMEText
+    from email.utils import formataddr
+    msg = MIMEText(html, 'html', 'utf-8')
+    msg['From'] = formataddr([SENDER_NAME, settings.SMTP_USER])
+    msg['To'] = to or formataddr([SENDER_NAME, settings.SMTP_USER])
+    msg['Subject'] = subject
+    return msg.as_string()
+
+
+def send_mail(to: str, subject: str, html: str):
+    """
+    同步发送单封事务邮件 (验证码/回执)，使用事务邮件连接池，不受群发限速影响
+    会阻塞到连接可用，异步接口中需放到线程池调用
+    """
+    _ensure_initialized()
+    _transactional_pool.sendmail([to], build_message(html, subject, to=to))
+
+
+def send_checkin_receipt(email: str, student_name: str, activity: dict, checkin_time: datetime):
+    """后台发送签到回执，不阻塞签到请求"""
+    html = EmailTemplates.checkin_success_notification(
+        student_name,
+        activity['name'],
+        checkin_time.strftime('%Y-%m-%d %H:%M:%S'),
+        activity['location_name'] or "",
+    )
+    _ensure_initialized()
+    _transactional_executor.submit(send_mail, email, f"【签到回执】{activity['name']}", html)
+
+
+# ==================================================
+# 群发活动
+# ==================================================
+
+class Campaign:
+    """正在本 worker 上发送的群发任务；进度逐批累加到 notification_campaigns 表"""
+
+    def __init__(self, campaign_id: str, admin_id: int):
+        self.id = campaign_id
+        self.admin_id = admin_id
+
+    def _record(self, sent: int, failed: int):
+        try:
+            with get_db_connection() as db:
+                db_utils.add_campaign_progress(db, self.id, sent, failed, datetime.now())
+        except Exception:
+            logger.exception("记录群发进度失败 (%s)", self.id)
+
+
+def _to_dict(row: dict) -> dict:
+    total = row['total']
+    return {
+        "campaign_id": row['id'],
+        "activity_code": row['activity_code'],
+        "activity_name": row['activity_name'],
+        "status": row['status'],
+        "total": total,
+        "sent": row['sent'],
+        "failed": row['failed'],
+        "progress": round((row['sent'] + row['failed']) / total, 4) if total else 0,
+        "error": row['error'],
+        "created_at": row['created_at'],
+        "send_at": row['send_at'],
+        "started_at": row['started_at'],
+        "finished_at": row['finished_at'],
+    }
+
+
+def get_campaign(campaign_id: str, admin_id: int):
+    """任一 worker 都能查询；不存在或不属于该管理员时返回 None"""
+    with get_db_connection() as db:
+        row = db_utils.get_campaign(db, campaign_id, admin_id)
+    return _to_dict(row) if row else None
+
+
+def list_campaigns(admin_id: int) -> list:
+    with get_db_connection() as db:
+        rows = db_utils.get_recent_campaigns(db, admin_id, MAX_LISTED_CAMPAIGNS)
+    return [_to_dict(row) for row in rows]
+
+
+def cancel_campaign(campaign_id: str, admin_id: int) -> bool:
+    """只能取消尚未开始的定时活动"""
+    with get_db_connection() as db:
+        return db_utils.cancel_campaign(db, campaign_id, admin_id, datetime.now())
+
+
+def _send_batch(campaign: Campaign, recipients: list, message: str):
+    import smtplib
+    _rate_limiter.acquire(len(recipients))
+    try:
+        # 部分地址被拒绝时，其余地址仍已投递
+        refused = _pool.sendmail(recipients, message)
+        campaign._record(len(recipients) - len(refused), len(refused))
+    except smtplib.SMTPRecipientsRefused:
+        campaign._record(0, len(recipients))
+    except Exception:
+        logger.exception("群发批次发送失败")
+        campaign._record(0, len(recipients))
+
+
+def _run_campaign(campaign: Campaign, activity_code: str):
+    """已抢到 (status=running) 的任务在本 worker 上发送"""
+    status, error = "done", None
+    try:
+        _ensure_initialized()
+        with db_utils.get_activity_connection(activity_code) as db:
+            activity = db_utils.get_activity_by_code(db, activity_code)
+        if not activity:
+            raise LookupError("活动已删除")
+        # 模板只渲染一次，所有批次共用同一封邮件正文
+        html = EmailTemplates.activity_start_notification(
+            activity['name'],
+            activity['start_time'].strftime('%Y-%m-%d %H:%M'),
+            activity['location_name'] or "",
+            f"{settings.CHECKIN_PAGE_URL}?code={activity['unique_code']}",
+        )
+        message = build_message(html, f"【活动提醒】{activity['name']} 即将开始")
+
+        with db_utils.get_tenant_read_connection(campaign.admin_id) as db:
+            emails = db_utils.get_participant_emails(db, campaign.admin_id)
+        with get_db_connection() as db:
+            db_utils.set_campaign_total(db, campaign.id, len(emails), datetime.now())
+
+        it = iter(emails)
+        futures = []
+        while True:
+            batch = list(itertools.islice(it, settings.MAIL_BATCH_SIZE))
+            if not batch:
+                break
+            futures.append(_executor.submit(_send_batch, campaign, batch, message))
+        for f in futures:
+            f.result()
+    except Exception as e:
+        logger.exception("群发通知失败")
+        status, error = "failed", str(e)[:255]
+    try:
+        with get_db_connection() as db:
+            db_utils.finish_campaign(db, campaign.id, status, error, datetime.now())
+    except Exception:
+        logger.exception("记录群发结果失败 (%s)", campaign.id)
+
+
+def _claim_and_run(campaign_id: str):
+    with get_db_connection() as db:
+        row = db_utils.claim_campaign(db, campaign_id, datetime.now())
+    if row is None:
+        return  # 已被其他 worker 抢走或已取消
+    threading.Thread(
+        target=_run_campaign, args=(Campaign(row['id'], row['admin_id']), row['activity_code']), daemon=True
+    ).start()
+
+
+def run_due_campaigns(now: datetime = None) -> int:
+    """
+    调度器定时调用：抢占并启动所有到期的定时群发 (多个 worker 同时调用时每个任务只会被一个 worker 抢到)；
+    同时把长时间没有进度的 running 任务 (发送它的进程已退出) 标记为失败。返回本次启动的任务数
+    """
+    now = now or datetime.now()
+    with get_db_connection() as db:
+        db_utils.fail_stale_campaigns(db, now - CAMPAIGN_STALE_AFTER, now)
+        due = db_utils.get_due_campaign_ids(db, now)
+    for campaign_id in due:
+        _claim_and_run(campaign_id)
+    return len(due)
+
+
+def start_campaign(admin_id: int, activity: dict, send_at: datetime = None) -> dict:
+    """
+    立即或在 send_at 时刻向该组织所有学生发送活动开始提醒
+    任务写入 notification_campaigns 表：立即发送的由本 worker 抢占执行，定时的由调度器到期后触发，
+    进程重启不会丢失尚未开始的定时任务
+    """
+    now = datetime.now()
+    campaign = {
+        "id": uuid.uuid4().hex,
+        "admin_id": admin_id,
+        "activity_code": activity['unique_code'],
+        "activity_name": activity['name'],
+        "status": "scheduled" if send_at and send_at > now else "pending",
+        "created_at": now,
+        "send_at": send_at,
+    }
+    with get_db_connection() as db:
+        db_utils.insert_campaign(db, campaign)
+    if campaign['status'] == "pending":
+        _claim_and_run(campaign['id'])
+    return get_campaign(campaign['id'], admin_id)
@@ -0,0 +1,289 @@
+# app/profiler.py
+"""
+线上 worker 的按需剖析 (管理员触发，默认关闭)
+1. 采样剖析：后台线程每隔 interval 读取一次所有线程的调用栈 (sys._current_frames)，
+   运行 N 秒后输出折叠栈 (collapsed stacks)，可直接交给 flamegraph.pl / speedscope 生成火焰图
+2. 请求追踪：按采样率挑选请求，记录其中每次 db_utils 调用与外部 I/O (MySQL 连接、SMTP、二维码、
+   坐标转换、密码哈希) 的耗时。开启时才给这些函数装上计时包装，关闭后恢复原函数，
+   未开启时热路径上没有任何额外开销
+3. 内存快照：RSS、打开的文件描述符/套接字、线程数，以及 tracemalloc 的分配热点
+   (需以 PYTHONTRACEMALLOC=1 或 python -X tracemalloc 启动)，供长时间稳定性测试跟踪内存增长
+"""
+
+import contextvars
+import functools
+import gc
+import importlib
+import inspect
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+
+MAX_PROFILE_SECONDS = 120
+MAX_TRACES = 200
+MAX_SPANS_PER_TRACE = 500
+
+# 模块 -> 要计时的函数 (None 表示模块内定义的全部公开普通函数)
+TRACE_TARGETS = {
+    "app.db_utils": None,
+    "app.notifications": ("send_mail",),
+    "app.qr_utils": ("render_checkin_qr",),
+    "app.coord_utils": ("gcj2wgs",),
+    "app.security": ("verify_password", "get_password_hash"),
+    "mysql.connector": ("connect",),
+}
+# 查询层的通用函数会在外层 db_utils 调用之内重复出现，不单独计时
+TRACE_SKIP = {"fetch_row", "fetch_rows", "execute_write", "to_dict"}
+
+
+class ProfilerBusyError(Exception):
+    pass
+
+
+# --- 采样剖析 ---
+class SamplingProfiler:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running = False
+
+    @staticmethod
+    def _collapse(frame) -> str:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ";".join(reversed(stack))
+
+    def run(self, seconds: float, interval: float) -> dict:
+        """阻塞 seconds 秒采样 (请在线程中调用)，返回 {"samples", "stacks": Counter}"""
+        with self._lock:
+            if self._running:
+                raise ProfilerBusyError("已有剖析任务在运行")
+            self._running = True
+        try:
+            own_id = threading.get_ident()
+            names = {}
+            stacks = Counter()
+            samples = 0
+            deadline = time.monotonic() + min(seconds, MAX_PROFILE_SECONDS)
+            while time.monotonic() < deadline:
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_id:
+                        continue
+                    name = names.get(thread_id)
+                    if name is None:
+                        names = {t.ident: t.name for t in threading.enumerate()}
+                        name = names.get(thread_id, str(thread_id))
+                    stacks[f"{name};{self._collapse(frame)}"] += 1
+                samples += 1
+                time.sleep(interval)
+            return {"samples": samples, "stacks": stacks}
+        finally:
+            with self._lock:
+                self._running = False
+
+
+def format_collapsed(stacks: Counter) -> str:
+    """每行 "线程;外层帧;...;内层帧 次数"，flamegraph.pl 的输入格式"""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+# --- 内存快照 ---
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None  # 非 Linux
+
+
+def _descriptors() -> tuple:
+    """(打开的文件描述符数, 其中的套接字数)；非 Linux 返回 (None, None)"""
+    try:
+        fds = os.listdir("/proc/self/fd")
+    except OSError:
+        return None, None
+    sockets = 0
+    for fd in fds:
+        try:
+            if os.readlink(f"/proc/self/fd/{fd}").startswith("socket:"):
+                sockets += 1
+        except OSError:
+            pass  # 列目录后已关闭
+    return len(fds), sockets
+
+
+def memory_snapshot(top: int, sizes: dict) -> dict:
+    """当前进程的内存与资源占用 (请在线程中调用：遍历 gc 对象与 tracemalloc 快照都较慢)"""
+    fds, sockets = _descriptors()
+    result = {
+        "pid": os.getpid(),
+        "rss_bytes": _rss_bytes(),
+        "open_fds": fds,
+        "sockets": sockets,
+        "threads": threading.active_count(),
+        "gc_objects": len(gc.get_objects()),
+        "sizes": sizes,
+        "tracemalloc": None,
+    }
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        result["tracemalloc"] = {
+            "current_bytes": current,
+            "peak_bytes": peak,
+            "top": [
+                {"where": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                 "size_bytes": stat.size, "count": stat.count}
+                for stat in snapshot.statistics("lineno")[:top]
+            ],
+        }
+    return result
+
+
+# --- 请求追踪 ---
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Trace:
+    __slots__ = ("id", "method", "path", "status", "started", "duration_ms", "spans")
+
+    def __init__(self, trace_id: int, method: str, path: str):
+        self.id = trace_id
+        self.method = method
+        self.path = path
+        self.status = None
+        self.started = time.perf_counter()
+        self.duration_ms = None
+        self.spans = []     # (名称, 相对开始时间 ms, 耗时 ms)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "duration_ms": self.duration_ms,
+            "spans": [{"name": n, "start_ms": s, "duration_ms": d} for n, s, d in self.spans],
+        }
+
+
+def _timed(name: str, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        trace = _current_trace.get()
+        if trace is None or len(trace.spans) >= MAX_SPANS_PER_TRACE:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            end = time.perf_counter()
+            trace.spans.append((name, round((start - trace.started) * 1000, 3), round((end - start) * 1000, 3)))
+    wrapper.__traced_original__ = func
+    return wrapper
+
+
+def _trace_candidates(module, names):
+    if names is not None:
+        return [(n, getattr(module, n)) for n in names if hasattr(module, n)]
+    # 跳过上下文管理器 (带 __wrapped__) 与生成器：计时只会量到创建对象的耗时
+    return [
+        (n, f) for n, f in vars(module).items()
+        if inspect.isfunction(f) and f.__module__ == module.__name__ and not n.startswith("_") and n not in TRACE_SKIP
+        and not hasattr(f, "__wrapped__") and not inspect.isgeneratorfunction(f)
+    ]
+
+
+class RequestTracer:
+    def __init__(self):
+        self.sample_rate = 0.0
+        self._lock = threading.Lock()
+        self._patched = []      # (模块, 名称, 原函数)
+        self._ids = itertools.count(1)
+        self.traces = deque(maxlen=MAX_TRACES)
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0
+
+    def _install(self):
+        for module_name, names in TRACE_TARGETS.items():
+            module = importlib.import_module(module_name)
+            short = module_name.rsplit(".", 1)[-1]
+            for name, func in _trace_candidates(module, names):
+                setattr(module, name, _timed(f"{short}.{name}", func))
+                self._patched.append((module, name, func))
+
+    def _uninstall(self):
+        for module, name, func in reversed(self._patched):
+            setattr(module, name, func)
+        self._patched.clear()
+
+    def configure(self, sample_rate: float):
+        """sample_rate 为 0 时关闭追踪并恢复原函数"""
+        with self._lock:
+            if sample_rate > 0 and not self._patched:
+                self._install()
+            elif sample_rate <= 0 and self._patched:
+                self._uninstall()
+            self.sample_rate = max(sample_rate, 0.0)
+
+    def start(self, method: str, path: str):
+        """按采样率决定是否追踪本请求；返回 (trace, contextvar token) 或 None"""
+        if random.random() >= self.sample_rate:
+            return None
+        trace = Trace(next(self._ids), method, path)
+        return trace, _current_trace.set(trace)
+
+    def finish(self, started, status):
+        trace, token = started
+        _current_trace.reset(token)
+        trace.status = status
+        trace.duration_ms = round((time.perf_counter() - trace.started) * 1000, 3)
+        self.traces.append(trace)
+
+    def snapshot(self, limit: int) -> list:
+        return [trace.to_dict() for trace in list(self.traces)[-limit:]]
+
+
+class TraceMiddleware:
+    """纯 ASGI 中间件；追踪关闭时直接透传"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not tracer.enabled:
+            await self.app(scope, receive, send)
+            return
+        started = tracer.start(scope["method"], scope["path"])
+        if started is None:
+            await self.app(scope, receive, send)
+            return
+
+        status = None
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            tracer.finish(started, status)
+
+
+sampler = SamplingProfiler()
+tracer = RequestTracer()
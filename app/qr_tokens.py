@@ -0,0 +1,183 @@
+# app/qr_tokens.py
+"""
+动态二维码令牌
+投屏页每 QR_TOKEN_PERIOD_SECONDS 秒取一个新的令牌并重绘二维码，令牌内含签到所需的全部活动信息
+(活动 id、活动码、admin_id、时间片、围栏中心与半径、起止时间)，用 HMAC-SHA256 签名。
+签到时只做签名与时间片校验 (纯 CPU)，不需要查询活动；转发的截图超过 QR_TOKEN_TTL_SECONDS 即失效。
+令牌中的围栏信息是签发时的快照，修改活动后最多 QR_TOKEN_TTL_SECONDS 内旧令牌仍按旧围栏校验。
+未登录的学生扫码后需先邮箱登录，通常超过令牌有效期：发送验证码时若令牌仍有效，把令牌和请求时间记在
+验证码记录上；凭该验证码登录成功后才换发绑定该邮箱、自请求验证码起 QR_LOGIN_GRACE_SECONDS 内有效的
+保留令牌 (<令牌>.<截止时间>.<签名>)，签到时核对邮箱。
+注意：保留令牌削弱了"截图转发超过 QR_TOKEN_TTL_SECONDS 即失效"的保证——在有效期内拿到转发令牌的人，
+只要能收到自己邮箱的验证码，就能在 QR_LOGIN_GRACE_SECONDS 内签到，请按可接受的窗口调小该配置。
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache
+
+from .config import settings
+
+REPLAY_CACHE_SIZE = 100000
+
+
+class QrTokenError(Exception):
+    pass
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+@lru_cache(maxsize=1)
+def _signing_key() -> bytes:
+    # 由 JWT 密钥派生，与登录令牌的签名用途隔离
+    return hmac.new(settings.JWT_SECRET_KEY.encode(), b"checkin-qr-token", hashlib.sha256).digest()
+
+
+def _sign(body: str) -> str:
+    return _b64encode(hmac.new(_signing_key(), body.encode(), hashlib.sha256).digest()[:16])
+
+
+def current_slot(now: float = None) -> int:
+    return int((now if now is not None else time.time()) // settings.QR_TOKEN_PERIOD_SECONDS)
+
+
+def issue(activity: dict, now: float = None) -> dict:
+    """为活动签发当前时间片的令牌，返回 {"token", "refresh_in"}"""
+    now = now if now is not None else time.time()
+    slot = current_slot(now)
+    payload = [
+        activity['id'],
+        activity['unique_code'],
+        activity['admin_id'],
+        slot,
+        float(activity['latitude']),
+        float(activity['longitude']),
+        activity['radius_meters'],
+        int(activity['start_time'].timestamp()),
+        int(activity['end_time'].timestamp()),
+    ]
+    body = _b64encode(json.dumps(payload, separators=(",", ":")).encode())
+    period = settings.QR_TOKEN_PERIOD_SECONDS
+    return {"token": f"{body}.{_sign(body)}", "refresh_in": round((slot + 1) * period - now, 1)}
+
+
+def _email_key(email: str) -> str:
+    return email.strip().lower()
+
+
+def _digest_equal(signature: str, body: str) -> bool:
+    # 按字节比较：客户端传入的非 ASCII 字符串会让 compare_digest 抛出 TypeError
+    return hmac.compare_digest(signature.encode(), _sign(body).encode())
+
+
+def hold(token: str, email: str, requested_at: float) -> str:
+    """
+    凭验证码登录成功后换发绑定邮箱的保留令牌；requested_at 为服务端记录的验证码请求时间
+    令牌在请求验证码时必须有效，保留令牌自该时刻起 QR_LOGIN_GRACE_SECONDS 内有效；否则抛出 QrTokenError
+    """
+    # 只接受投屏页签发的原始令牌，保留令牌不能再续
+    if token.count(".") != 1:
+        raise QrTokenError("二维码无效")
+    verify(token, requested_at)
+    body = token.split(".")[0]
+    hold_until = int(requested_at + settings.QR_LOGIN_GRACE_SECONDS)
+    return f"{token}.{hold_until}.{_sign(f'{body}.{hold_until}.{_email_key(email)}')}"
+
+
+def hold_matches(activity: dict, email: str) -> bool:
+    """保留令牌必须由绑定的邮箱使用；普通令牌总是返回 True"""
+    held = activity.get('hold')
+    if held is None:
+        return True
+    body, hold_until, signature = held
+    return _digest_equal(signature, f"{body}.{hold_until}.{_email_key(email or '')}")
+
+
+def verify(token: str, now: float = None) -> dict:
+    """
+    校验令牌并还原活动信息 (字段与活动表一致)；签名错误或已过期抛出 QrTokenError
+    保留令牌只校验截止时间，返回值的 "hold" 需再用 hold_matches 核对邮箱
+    """
+    parts = token.split(".")
+    if len(parts) not in (2, 4):
+        raise QrTokenError("二维码无效")
+    body, signature = parts[0], parts[1]
+    if not _digest_equal(signature, body):
+        raise QrTokenError("二维码无效")
+
+    try:
+        activity_id, code, admin_id, slot, lat, lon, radius, start_ts, end_ts = json.loads(_b64decode(body))
+        slot = int(slot)
+        start_time = datetime.fromtimestamp(int(start_ts))
+        end_time = datetime.fromtimestamp(int(end_ts))
+        hold_until = int(parts[2]) if len(parts) == 4 else None
+    except (ValueError, TypeError, OverflowError, OSError):
+        # base64/JSON 解析失败、载荷结构不符、数值非法均视为无效令牌
+        raise QrTokenError("二维码无效")
+    held = None
+    if hold_until is not None:
+        if (now if now is not None else time.time()) > hold_until:
+            raise QrTokenError("二维码已过期，请重新扫描现场二维码")
+        held = (body, hold_until, parts[3])
+    else:
+        age_slots = current_slot(now) - slot
+        max_age_slots = max(settings.QR_TOKEN_TTL_SECONDS // settings.QR_TOKEN_PERIOD_SECONDS, 1)
+        # 允许 1 个时间片的时钟偏差
+        if age_slots < -1 or age_slots > max_age_slots:
+            raise QrTokenError("二维码已过期，请重新扫描现场二维码")
+
+    return {
+        "id": activity_id,
+        "unique_code": code,
+        "admin_id": admin_id,
+        "latitude": lat,
+        "longitude": lon,
+        "radius_meters": radius,
+        "start_time": start_time,
+        "end_time": end_time,
+        "slot": slot,
+        "hold": held,
+    }
+
+
+class ReplayCache:
+    """
+    通过时间/围栏校验后记录 (令牌, 学生)；同一学生重复提交同一令牌时直接拒绝，不再访问数据库
+    条目在令牌过期后淘汰
+    """
+
+    def __init__(self, maxsize: int = REPLAY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._seen = OrderedDict()   # (签名, admin_id, 学号) -> 过期时间
+        self._lock = threading.Lock()
+
+    def add(self, token: str, admin_id: int, student_id: str) -> bool:
+        """首次出现返回 True；重放返回 False"""
+        key = (token.rsplit(".", 1)[-1], admin_id, student_id)
+        now = time.monotonic()
+        with self._lock:
+            while self._seen:
+                oldest_key, expires = next(iter(self._seen.items()))
+                if expires > now and len(self._seen) < self.maxsize:
+                    break
+                del self._seen[oldest_key]
+            if key in self._seen:
+                return False
+            ttl = max(settings.QR_TOKEN_TTL_SECONDS, settings.QR_LOGIN_GRACE_SECONDS)
+            self._seen[key] = now + ttl + settings.QR_TOKEN_PERIOD_SECONDS
+            return True
+
+
+replay_cache = ReplayCache()
@@ -0,0 +1,26 @@
+# app/qr_utils.py
+"""
+二维码渲染
+qrcode 依赖 PIL，导入开销较大且只有少数请求会用到，因此在首次渲染时才导入
+"""
+
+import io
+from functools import lru_cache
+
+from .config import settings
+
+
+def render_qr_png(data: str) -> bytes:
+    """将文本渲染为 PNG 二维码图片"""
+    import qrcode  # 延迟导入 (见模块说明)
+
+    img = qrcode.make(data)
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+@lru_cache(maxsize=256)
+def render_checkin_qr(activity_code: str) -> bytes:
+    """活动签到二维码 (内容只取决于活动码，可直接缓存)"""
+    return render_qr_png(f"{settings.CHECKIN_PAGE_URL}?code={activity_code}")
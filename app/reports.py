@@ -0,0 +1,163 @@
+# app/reports.py
+"""
+学期考勤汇总报表
+一次聚合查询流式生成某管理员名下所有学生的出勤统计与 (学生 x 活动) 出勤矩阵，
+结果按管理员缓存，直到该管理员名下出现新的签到/签退 (经由 cache_bus 广播 "report:<admin_id>")；
+缓存最多保留 CACHE_SIZE 份 (LRU)。
+"""
+
+import csv
+import io
+import threading
+from collections import OrderedDict
+
+from . import db_utils
+
+CACHE_SIZE = 64
+
+# (admin_id, fmt) -> (generation, bytes)，按最近使用排序
+_cache = OrderedDict()
+# admin_id -> generation，每次失效 +1
+_generations = {}
+_lock = threading.Lock()
+
+CSV_FLUSH_ROWS = 200
+
+
+def invalidate(admin_id: int):
+    """该管理员名下数据发生变化 (签到/签退/活动增删)，丢弃其报表缓存"""
+    with _lock:
+        _generations[admin_id] = _generations.get(admin_id, 0) + 1
+        for fmt in ("csv", "xlsx"):
+            _cache.pop((admin_id, fmt), None)
+    # 之后短时间内从主库生成报表，避免把副本上的旧数据写进缓存
+    db_utils.mark_primary_sticky(f"report:{admin_id}")
+
+
+def clear():
+    """清空全部报表缓存 (缓存失效总线重连后调用)"""
+    with _lock:
+        for admin_id in list(_generations):
+            _generations[admin_id] += 1
+        _cache.clear()
+
+
+def _current_generation(admin_id: int) -> int:
+    with _lock:
+        return _generations.get(admin_id, 0)
+
+
+def _store(admin_id: int, fmt: str, generation: int, data: bytes):
+    """仅当生成期间没有发生失效时才写入缓存，避免缓存到过期数据"""
+    with _lock:
+        if _generations.get(admin_id, 0) == generation:
+            _cache[(admin_id, fmt)] = (generation, data)
+            _cache.move_to_end((admin_id, fmt))
+            while len(_cache) > CACHE_SIZE:
+                _cache.popitem(last=False)
+
+
+def get_cached(admin_id: int, fmt: str):
+    with _lock:
+        entry = _cache.get((admin_id, fmt))
+        if entry is not None:
+            _cache.move_to_end((admin_id, fmt))
+    return entry[1] if entry else None
+
+
+def _format_cell(checkin_count, seconds_present):
+    if not checkin_count:
+        return ""
+    if seconds_present is None:
+        return "未签退"
+    return int(seconds_present) // 60
+
+
+def iter_report_rows(admin_id: int):
+    """
+    逐行产出报表：第一行为表头，之后每个学生一行
+    [学号, 姓名, 出勤次数, 累计在场(分钟), 活动1, 活动2, ...]
+    活动单元格：在场分钟数 / "未签退" / 空 (缺席)
+    """
+    with db_utils.get_tenant_read_connection(admin_id, sticky_key=f"report:{admin_id}") as db:
+        activities = db_utils.get_report_activities(db, admin_id)
+        col_index = {a['id']: i for i, a in enumerate(activities)}
+        yield ["学号", "姓名", "出勤次数", "累计在场(分钟)"] + [a['name'] for a in activities]
+
+        current_id = None
+        current = None
+        for row in db_utils.iter_attendance_summary(db, admin_id):
+            if row['participant_id'] != current_id:
+                if current is not None:
+                    yield _finish_row(current)
+                current_id = row['participant_id']
+                current = {
+                    "student_id": row['student_id'],
+                    "name": row['name'],
+                    "attended": 0,
+                    "seconds": 0,
+                    "cells": [""] * len(activities),
+                }
+
+            idx = col_index.get(row['activity_id'])
+            if idx is None:
+                # LEFT JOIN 未命中 (该学生没有任何签到记录)
+                continue
+            if row['checkin_count']:
+                current['attended'] += 1
+            if row['seconds_present']:
+                current['seconds'] += int(row['seconds_present'])
+            current['cells'][idx] = _format_cell(row['checkin_count'], row['seconds_present'])
+
+        if current is not None:
+            yield _finish_row(current)
+
+
+def _finish_row(current: dict) -> list:
+    return [
+        current['student_id'],
+        current['name'],
+        current['attended'],
+        current['seconds'] // 60,
+    ] + current['cells']
+
+
+def stream_csv(admin_id: int):
+    """流式产出 CSV (带 BOM，Excel 可直接打开中文)，完整生成后写入缓存"""
+    generation = _current_generation(admin_id)
+    chunks = []
+    buf = io.StringIO()
+    buf.write("\ufeff")
+    writer = csv.writer(buf)
+
+    for n, row in enumerate(iter_report_rows(admin_id), start=1):
+        writer.writerow(row)
+        if n % CSV_FLUSH_ROWS == 0:
+            chunk = buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate(0)
+            chunks.append(chunk)
+            yield chunk
+
+    chunk = buf.getvalue().encode("utf-8")
+    if chunk:
+        chunks.append(chunk)
+        yield chunk
+    _store(admin_id, "csv", generation, b"".join(chunks))
+
+
+def build_xlsx(admin_id: int) -> bytes:
+    """使用 write_only 工作簿逐行写入，避免为每个单元格构建完整对象"""
+    from openpyxl import Workbook  # 延迟导入，仅导出时加载
+
+    generation = _current_generation(admin_id)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("学期考勤汇总")
+    for row in iter_report_rows(admin_id):
+        ws.append(row)
+
+    buf = io.BytesIO()
+    wb.save(buf)
+    data = buf.getvalue()
+    _store(admin_id, "xlsx", generation, data)
+    return data
@@ -0,0 +1,221 @@
+# app/scheduler.py
+"""
+活动生命周期调度器 (进程内)
+按时间排序的小顶堆保存每个活动的开始/结束事件：
+- 开始前 PREWARM_LEAD：预热活动缓存、二维码和地理围栏，避免开场时大量学生同时打到冷缓存
+- 结束后：一条 UPDATE 关闭该活动所有未签退的记录 (签退时间记为活动结束时间)；失败时按指数退避重试
+- 每 SERIES_EXTEND_INTERVAL：把周期活动的场次向后延伸到 SERIES_HORIZON_DAYS 天
+- 每 CAMPAIGN_POLL_INTERVAL：抢占并发送到期的定时群发 (任务在数据库中，多个 worker 只有一个能抢到)
+修改活动时间会重新排程；旧事件通过版本号作废，无需从堆中删除
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from . import cache
+from . import cache_bus
+from . import db_utils
+from . import notifications
+from . import qr_utils
+from . import series
+from .config import settings
+from .db_utils import get_db_connection
+from .geo_index import activity_index
+
+logger = logging.getLogger(__name__)
+
+# 时钟可能被调整，每次最多休眠这么久后重新检查
+MAX_SLEEP_SECONDS = 60
+
+EVENT_PREWARM = "prewarm"
+EVENT_END = "end"
+EVENT_SERIES = "series"
+EVENT_CAMPAIGNS = "campaigns"
+# 周期性事件在版本表中使用的键 (不会与活动码冲突)
+SERIES_EVENT_KEY = "series:extend"
+CAMPAIGN_EVENT_KEY = "campaigns:poll"
+SERIES_EXTEND_INTERVAL = timedelta(hours=1)
+CAMPAIGN_POLL_INTERVAL = timedelta(seconds=30)
+PERIODIC_EVENTS = {
+    EVENT_SERIES: (SERIES_EVENT_KEY, SERIES_EXTEND_INTERVAL),
+    EVENT_CAMPAIGNS: (CAMPAIGN_EVENT_KEY, CAMPAIGN_POLL_INTERVAL),
+}
+# 自动签退失败 (如数据库短暂不可用) 后的重试间隔：30 秒起翻倍，最长 30 分钟，直到成功或活动被重新排程
+END_RETRY_BASE = timedelta(seconds=30)
+END_RETRY_MAX = timedelta(minutes=30)
+
+
+class ActivityScheduler:
+    def __init__(self):
+        self._heap = []         # (when, seq, kind, activity_id, version, payload)
+        self._versions = {}     # activity code -> 当前版本号
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+    # --- 排程 ---
+    def schedule(self, activity: dict, now: datetime = None):
+        """新增或重新排程一个活动的开始/结束事件"""
+        if self._thread is None:
+            return  # 调度器未启用
+        now = now or datetime.now()
+        lead = timedelta(minutes=settings.PREWARM_LEAD_MINUTES)
+        code = activity['unique_code']
+        payload = {"code": code, "admin_id": activity['admin_id']}
+        with self._cond:
+            # 全局递增的版本号：删除后重新排程也不会与堆中旧事件重号
+            version = next(self._seq)
+            self._versions[code] = version
+            if activity['start_time'] > now:
+                when = max(activity['start_time'] - lead, now)
+                heapq.heappush(self._heap, (when, next(self._seq), EVENT_PREWARM, activity['id'], version, payload))
+            if activity['end_time'] > now:
+                heapq.heappush(self._heap, (activity['end_time'], next(self._seq), EVENT_END, activity['id'], version, payload))
+            else:
+                # 已结束的活动不再需要版本记录
+                self._versions.pop(code, None)
+            self._cond.notify()
+
+    def _schedule_periodic(self, kind: str, when: datetime):
+        key = PERIODIC_EVENTS[kind][0]
+        with self._cond:
+            version = next(self._seq)
+            self._versions[key] = version
+            heapq.heappush(self._heap, (when, next(self._seq), kind, None, version, {"code": key}))
+            self._cond.notify()
+
+    def _retry_end(self, activity_id: int, payload: dict):
+        """自动签退失败：以新版本号重新入堆；期间活动已被重新排程 (有了新的结束事件) 则不再重试"""
+        attempt = payload.get('attempt', 0) + 1
+        delay = min(END_RETRY_BASE * 2 ** (attempt - 1), END_RETRY_MAX)
+        with self._cond:
+            if payload['code'] in self._versions:
+                return
+            version = next(self._seq)
+            self._versions[payload['code']] = version
+            heapq.heappush(self._heap, (datetime.now() + delay, next(self._seq), EVENT_END, activity_id, version,
+                                        dict(payload, attempt=attempt)))
+            self._cond.notify()
+        logger.warning("活动 %s 自动签退将在 %d 秒后第 %d 次重试", payload['code'], delay.total_seconds(), attempt)
+
+    def unschedule(self, code: str):
+        """活动被删除：作废其所有待执行事件"""
+        with self._cond:
+            self._versions.pop(code, None)
+            self._cond.notify()
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._heap)
+
+    # --- 事件处理 ---
+    def _prewarm(self, payload: dict):
+        version = time.time_ns()
+        with db_utils.get_activity_connection(payload['code']) as db:
+            activity = db_utils.get_activity_by_code(db, payload['code'])
+        if not activity:
+            return
+        # 缓存一直保留到活动开始后一段时间，覆盖签到高峰
+        ttl = settings.PREWARM_LEAD_MINUTES * 60 + cache.ACTIVITY_CACHE_TTL * 10
+        cache.activity_cache.set(payload['code'], activity, ttl=ttl, version=version)
+        cache.detail_cache.set(payload['code'], cache.build_detail(activity), ttl=ttl, version=version)
+        if activity['latitude'] is not None and activity['longitude'] is not None:
+            cache.wgs_center(float(activity['longitude']), float(activity['latitude']))
+        activity_index.upsert(activity)
+        qr_utils.render_checkin_qr(payload['code'])
+
+    def _close_open_logs(self, activity_id: int, payload: dict):
+        with db_utils.get_tenant_connection(payload['admin_id']) as db:
+            closed = db_utils.auto_checkout_activity(db, activity_id, datetime.now())
+        if closed:
+            cache_bus.publish([f"report:{payload['admin_id']}"])
+            logger.info("活动 %s 已结束，自动签退 %d 条记录", payload['code'], closed)
+
+    def _dispatch(self, kind: str, activity_id: int, payload: dict):
+        try:
+            if kind == EVENT_PREWARM:
+                self._prewarm(payload)
+            elif kind == EVENT_END:
+                self._close_open_logs(activity_id, payload)
+            elif kind == EVENT_SERIES:
+                series.extend_all()
+            elif kind == EVENT_CAMPAIGNS:
+                notifications.run_due_campaigns()
+        except Exception:
+            logger.exception("调度事件 %s (活动 %s) 执行失败", kind, payload['code'])
+            if kind == EVENT_END:
+                # 丢弃会让未签退记录一直保持打开 (直到下次重启的补偿)，必须重试
+                self._retry_end(activity_id, payload)
+        finally:
+            if kind in PERIODIC_EVENTS:
+                self._schedule_periodic(kind, datetime.now() + PERIODIC_EVENTS[kind][1])
+
+    # --- 主循环 ---
+    def _bootstrap(self):
+        """启动时：关闭所有已结束活动遗留的未签退记录，清理过期的刷新令牌，并为未结束的活动排程"""
+        now = datetime.now()
+        closed = 0
+        activities = []
+        for name in db_utils.iter_shard_names():
+            with db_utils.get_shard_connection(name) as db:
+                closed += db_utils.close_expired_logs(db, now)
+                activities += db_utils.get_unfinished_activities(db, now)
+        with get_db_connection() as db:
+            db_utils.purge_expired_refresh_tokens(db, now)
+        if closed:
+            logger.info("启动时自动签退 %d 条已结束活动的记录", closed)
+        for activity in activities:
+            self.schedule(activity, now)
+
+    def _run(self):
+        try:
+            self._bootstrap()
+        except Exception:
+            logger.exception("调度器初始化失败")
+        for kind in PERIODIC_EVENTS:
+            self._schedule_periodic(kind, datetime.now())
+
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping:
+                        return
+                    if not self._heap:
+                        self._cond.wait(MAX_SLEEP_SECONDS)
+                        continue
+                    when, _, kind, activity_id, version, payload = self._heap[0]
+                    delay = (when - datetime.now()).total_seconds()
+                    if delay > 0:
+                        self._cond.wait(min(delay, MAX_SLEEP_SECONDS))
+                        continue
+                    heapq.heappop(self._heap)
+                    if self._versions.get(payload['code']) != version:
+                        # 已被重新排程或删除
+                        continue
+                    if kind == EVENT_END:
+                        self._versions.pop(payload['code'], None)
+                    break
+            self._dispatch(kind, activity_id, payload)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="activity-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+
+scheduler = ActivityScheduler()
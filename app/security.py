@@ -1,5 +1,8 @@
 from datetime import datetime, timedelta, timezone
 from typing import Optional
+import hashlib
+import secrets
+import uuid
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 from fastapi import Depends, HTTPException, status
@@ -7,6 +10,7 @@ from fastapi.security import OAuth2PasswordBearer
 
 from .config import settings
 from . import db_utils  # <--- 必须导入 db_utils
+from . import logs
 
 # 1. 密码哈希
 pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
@@ -29,6 +33,41 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, settings.JWT_SECRET_KEY, algorithm=settings.JWT_ALGORITHM)
     return encoded_jwt
 
+# 2.1 刷新令牌 (不透明随机串，轮换使用；库中只存摘要)
+def hash_refresh_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def issue_refresh_token(db, subject_type: str, subject: str, admin_id: Optional[int] = None) -> str:
+    """登录成功时签发，开启一个新的令牌族"""
+    token = secrets.token_urlsafe(32)
+    expires_at = datetime.now() + timedelta(days=settings.JWT_REFRESH_TOKEN_EXPIRE_DAYS)
+    db_utils.create_refresh_token(db, hash_refresh_token(token), uuid.uuid4().hex,
+                                  subject_type, subject, admin_id, expires_at)
+    return token
+
+def rotate_refresh_token(db, token: str, subject_type: str):
+    """
+    用刷新令牌换取新的刷新令牌，返回 (令牌记录, 新令牌)
+    旧令牌被重复使用时整个令牌族被吊销，调用方需重新登录
+    """
+    invalid = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="登录已过期，请重新登录",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    new_token = secrets.token_urlsafe(32)
+    now = datetime.now()
+    expires_at = now + timedelta(days=settings.JWT_REFRESH_TOKEN_EXPIRE_DAYS)
+    # 主体类型在事务内先于轮换检查：学生令牌打到管理员接口时不能被消耗或触发族吊销
+    record = db_utils.rotate_refresh_token(db, hash_refresh_token(token), hash_refresh_token(new_token),
+                                           subject_type, expires_at, now)
+    if not record:
+        raise invalid
+    return record, new_token
+
+def revoke_refresh_token(db, token: str):
+    db_utils.revoke_refresh_family(db, hash_refresh_token(token))
+
 # 3. OAuth2 依赖 (Admin)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/admin/login")
 
@@ -54,6 +93,7 @@ async def get_current_admin(token: str = Depends(oauth2_scheme)):
         admin = db_utils.get_admin_by_username(db, username)
         if not admin:
             raise credentials_exception
+        logs.bind(admin_id=admin['id'])
         return admin 
 
 # 4. OAuth2 依赖 (Student)
@@ -79,6 +119,7 @@ async def get_current_student(token: str = Depends(oauth2_student_scheme)):
         if student_id is None or role != "student":
             raise credentials_exception
         
+        logs.bind(admin_id=admin_id)
         # 返回包含 admin_id 的字典
         return {"sub": student_id, "role": role, "admin_id": admin_id}
     except JWTError:
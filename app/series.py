@@ -0,0 +1,156 @@
+# app/series.py
+"""
+周期活动 (系列)
+管理员定义一次重复规则 (每隔 interval_weeks 周的周几、开始/结束时刻、起止日期)，
+系统把 SERIES_HORIZON_DAYS 天内的场次一次性生成为普通活动 (单事务 executemany)，
+之后由调度器每小时把各系列的场次向后延伸 (materialized_until 为已生成到的日期)。
+每个场次都是独立的活动 (活动码、签到记录、二维码与普通活动完全一样)，只多一个 series_id；
+系列级修改用一条 UPDATE 改写所有尚未开始的场次。
+"""
+
+import logging
+from datetime import date, datetime, time, timedelta
+
+from . import cache_bus
+from . import db_utils
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def clock(value) -> time:
+    """TIME 列经 mysql-connector 读出为 timedelta"""
+    if isinstance(value, timedelta):
+        return (datetime.min + value).time()
+    return value
+
+
+def parse_weekdays(value) -> set:
+    if isinstance(value, str):
+        return {int(d) for d in value.split(",") if d}
+    return set(value)
+
+
+def occurrences(series: dict, after: date, through: date) -> list:
+    """(after, through] 之间的场次，返回 [(开始时间, 结束时间), ...]"""
+    weekdays = parse_weekdays(series['weekdays'])
+    start_clock, end_clock = clock(series['start_clock']), clock(series['end_clock'])
+    overnight = timedelta(days=1) if end_clock <= start_clock else timedelta(0)
+    # 以首场所在周的周一为第 0 周
+    anchor = series['start_date'] - timedelta(days=series['start_date'].weekday())
+    last = min(through, series['until_date']) if series['until_date'] else through
+
+    result = []
+    day = max(after + timedelta(days=1), series['start_date'])
+    while day <= last:
+        if day.weekday() in weekdays and ((day - anchor).days // 7) % series['interval_weeks'] == 0:
+            result.append((datetime.combine(day, start_clock), datetime.combine(day, end_clock) + overnight))
+        day += timedelta(days=1)
+    return result
+
+
+def horizon(today: date, series: dict) -> date:
+    through = today + timedelta(days=settings.SERIES_HORIZON_DAYS)
+    return min(through, series['until_date']) if series['until_date'] else through
+
+
+def bus_key(admin_id: int, series_id: int, codes: list) -> str:
+    """
+    一个系列的场次变更合成一条失效键 "series:<admin_id>:<系列 ID>:<活动码,...>"
+    各节点据此驱逐这些活动的缓存，再用一条按 series_id 的查询批量刷新索引与排程 (而不是每个场次查一次)
+    """
+    return f"series:{admin_id}:{series_id}:{','.join(codes)}"
+
+
+def parse_bus_key(key: str) -> tuple:
+    """bus_key 去掉 "series:" 前缀后的部分 -> (admin_id, 系列 ID, 活动码列表)"""
+    admin_id, series_id, codes = key.split(":", 2)
+    return int(admin_id), int(series_id), [code for code in codes.split(",") if code]
+
+
+def _broadcast(admin_id: int, series_id: int, codes: list):
+    cache_bus.publish([bus_key(admin_id, series_id, codes), f"report:{admin_id}"])
+
+
+def _publish(admin_id: int, series_id: int, codes: list):
+    if codes:
+        db_utils.register_activity_tenants(codes, admin_id)
+        _broadcast(admin_id, series_id, codes)
+
+
+def create(admin_id: int, data) -> tuple:
+    """创建系列并生成首批场次，返回 (系列 ID, 活动码列表)"""
+    series = data.model_dump()
+    series['weekdays'] = ",".join(str(d) for d in sorted(set(data.weekdays)))
+    before_start = data.start_date - timedelta(days=1)
+    through = max(horizon(date.today(), series), before_start)
+    with db_utils.get_tenant_connection(admin_id) as db:
+        series_id, codes = db_utils.db_create_series(
+            db, series, admin_id, occurrences(series, before_start, through), through
+        )
+    _publish(admin_id, series_id, codes)
+    return series_id, codes
+
+
+def extend(db, series: dict, today: date) -> list:
+    """把一个系列的场次延伸到 today + SERIES_HORIZON_DAYS；已被其他 worker 延伸时返回空列表"""
+    through = horizon(today, series)
+    if series['materialized_until'] >= through:
+        return []
+    codes = db_utils.db_extend_series(
+        db, series, occurrences(series, series['materialized_until'], through), through
+    )
+    if codes is None:
+        return []
+    _publish(series['admin_id'], series['id'], codes)
+    return codes
+
+
+def extend_all(today: date = None) -> int:
+    """调度器定时调用：延伸所有分片上到期的系列，返回新生成的场次数"""
+    today = today or date.today()
+    created = 0
+    for name in db_utils.iter_shard_names():
+        with db_utils.get_shard_connection(name) as db:
+            due = db_utils.get_series_due(db, today + timedelta(days=settings.SERIES_HORIZON_DAYS))
+        for series in due:
+            try:
+                # 迁移后源分片上残留的系列由新分片负责
+                if db_utils.shard_router.shard_for(series['admin_id']) != name:
+                    continue
+                with db_utils.get_tenant_connection(series['admin_id']) as db:
+                    created += len(extend(db, series, today))
+            except db_utils.TenantMigratingError:
+                continue
+    if created:
+        logger.info("周期活动新生成 %d 个场次", created)
+    return created
+
+
+def update(db, series: dict, changes: dict, now: datetime) -> list:
+    """合并修改后改写系列及其所有未开始的场次，返回受影响的活动码"""
+    merged = dict(series, **changes)
+    merged['start_clock'] = clock(merged['start_clock'])
+    merged['end_clock'] = clock(merged['end_clock'])
+    codes = db_utils.db_update_series(db, merged, now)
+    if codes:
+        _broadcast(series['admin_id'], series['id'], codes)
+    return codes
+
+
+def delete(db, series: dict, now: datetime) -> list:
+    codes = db_utils.db_delete_series(db, series['id'], now)
+    db_utils.unregister_activity_tenants(codes)
+    if codes:
+        _broadcast(series['admin_id'], series['id'], codes)
+    else:
+        cache_bus.publish([f"report:{series['admin_id']}"])
+    return codes
+
+
+def to_dict(series: dict) -> dict:
+    result = dict(series)
+    result['weekdays'] = sorted(parse_weekdays(series['weekdays']))
+    result['start_clock'] = clock(series['start_clock']).strftime("%H:%M:%S")
+    result['end_clock'] = clock(series['end_clock']).strftime("%H:%M:%S")
+    return result
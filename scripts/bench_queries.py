@@ -0,0 +1,173 @@
+"""
+热点查询基准：每个请求的 CPU 时间与每行内存
+
+    python scripts/bench_queries.py --activity-code <活动码> --student-id <学号> --admin-id 1
+    python scripts/bench_queries.py --rows-only          # 只比较每行内存，不需要数据库
+
+CPU：在同一个连接上重复执行一次签到请求的读查询序列 (查活动、查学生、查重复签到、查未签退记录)
+以及活动签到日志查询，分别在文本协议 + dict 行 (原实现)、文本协议 + Row、预处理语句 + Row 下统计每次的进程 CPU 时间。
+内存：用 tracemalloc 统计 dict 行与 Row 在大型活动日志 (默认 2 万行) 下的每行占用。
+需要项目根目录下的 .env 能连接到本地数据库。
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+LOG_COLUMNS = ("student_id", "name", "check_in_time", "check_out_time")
+
+
+def _sample_rows(n: int) -> list:
+    start = datetime(2025, 9, 1, 8, 0)
+    return [
+        (f"2025{i:06d}", f"学生{i}", start + timedelta(seconds=i), start + timedelta(hours=2, seconds=i))
+        for i in range(n)
+    ]
+
+
+def bytes_per_row(n: int) -> dict:
+    """同一批数据分别构造为 dict 行和 Row，返回每行字节数"""
+    from app.db_utils import _row_type
+
+    raw = _sample_rows(n)
+    row_type = _row_type(LOG_COLUMNS)
+    result = {}
+    for label, build in (
+        ("dict", lambda r: dict(zip(LOG_COLUMNS, r))),
+        ("Row", row_type),
+    ):
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        rows = [build(r) for r in raw]
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+        # 行内的值 (字符串、datetime) 两种方式共享同一批对象，差异只在容器本身
+        result[label] = allocated / n
+        del rows
+    return result
+
+
+def _dict_query(db, query: str, params: tuple) -> list:
+    cursor = db.cursor(dictionary=True)
+    cursor.execute(query, params)
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+
+def request_queries(db, fetch, activity_code: str, student_id: str, admin_id: int):
+    """一次签到请求在数据库上的读查询序列"""
+    activity = fetch(db, "SELECT * FROM activities WHERE unique_code = %s", (activity_code,))
+    participant = fetch(db, "SELECT * FROM participants WHERE student_id = %s AND admin_id = %s",
+                        (student_id, admin_id))
+    if activity and participant:
+        activity_id, participant_id = activity[0]['id'], participant[0]['id']
+        fetch(db, "SELECT * FROM check_logs WHERE participant_id = %s AND activity_id = %s LIMIT 1",
+              (participant_id, activity_id))
+        fetch(db, """
+            SELECT cl.*, a.name as activity_name, a.latitude, a.longitude, a.radius_meters, a.start_time, a.end_time, a.unique_code
+            FROM check_logs cl
+            JOIN activities a ON cl.activity_id = a.id
+            WHERE cl.participant_id = %s AND cl.check_out_time IS NULL
+            LIMIT 1
+        """, (participant_id,))
+    return activity
+
+
+def logs_query(db, fetch, activity_id: int):
+    return fetch(db, """
+    SELECT p.student_id, p.name, cl.check_in_time, cl.check_out_time
+    FROM check_logs cl
+    JOIN participants p ON cl.participant_id = p.id
+    WHERE cl.activity_id = %s
+    ORDER BY cl.check_in_time
+    """, (activity_id,))
+
+
+def cpu_per_call(func, runs: int) -> list:
+    timings = []
+    for _ in range(runs):
+        t = time.process_time()
+        func()
+        timings.append((time.process_time() - t) * 1e6)
+    return timings
+
+
+def _text_row_query(db, query: str, params: tuple) -> list:
+    from app.db_utils import _row_type
+
+    cursor = db.cursor()
+    cursor.execute(query, params)
+    rows = cursor.fetchall()
+    row_type = _row_type(tuple(column[0] for column in cursor.description))
+    cursor.close()
+    return [row_type(row) for row in rows]
+
+
+def _prepared_row_query(db, query: str, params: tuple) -> list:
+    from app.db_utils import _row_type, _statement_cursor
+
+    cursor = _statement_cursor(db, query)
+    cursor.execute(query, params)
+    rows = cursor.fetchall()
+    row_type = _row_type(tuple(column[0] for column in cursor.description))
+    return [row_type(row) for row in rows]
+
+
+def bench_cpu(args):
+    from app import db_utils
+
+    variants = (
+        ("text + dict", _dict_query),          # 原实现
+        ("text + Row", _text_row_query),
+        ("prepared + Row", _prepared_row_query),  # DB_PREPARED_STATEMENTS=true 时的实现
+    )
+    with db_utils.get_db_connection() as db:
+        activity = db_utils.get_activity_by_code(db, args.activity_code)
+        if not activity:
+            print(f"活动 {args.activity_code} 不存在")
+            sys.exit(1)
+
+        print(f"{'variant':<16} {'request p50(us)':>16} {'request p95(us)':>16} {'logs p50(ms)':>13} {'rows':>7}")
+        for label, fetch in variants:
+            request = lambda: request_queries(db, fetch, args.activity_code, args.student_id, args.admin_id)
+            logs = lambda: logs_query(db, fetch, activity['id'])
+            request()  # 预热 (预处理语句只在首次执行时准备)
+            rows = len(logs())
+            req_timings = sorted(cpu_per_call(request, args.runs))
+            log_timings = cpu_per_call(logs, max(args.runs // 20, 3))
+            print(f"{label:<16} {statistics.median(req_timings):>16.0f} "
+                  f"{req_timings[int(len(req_timings) * 0.95) - 1]:>16.0f} "
+                  f"{statistics.median(log_timings) / 1000:>13.2f} {rows:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="热点查询 CPU / 每行内存基准")
+    parser.add_argument("--activity-code", help="用于测量的活动码")
+    parser.add_argument("--student-id", default="", help="该活动所属组织下的学号")
+    parser.add_argument("--admin-id", type=int, default=1)
+    parser.add_argument("--runs", type=int, default=500, help="每种实现的请求次数")
+    parser.add_argument("--rows", type=int, default=20000, help="每行内存测量的行数")
+    parser.add_argument("--rows-only", action="store_true", help="只测量每行内存")
+    args = parser.parse_args()
+
+    per_row = bytes_per_row(args.rows)
+    print(f"每行内存 ({args.rows} 行日志): dict {per_row['dict']:.0f} B, Row {per_row['Row']:.0f} B "
+          f"({per_row['Row'] / per_row['dict']:.0%})")
+
+    if not args.rows_only:
+        if not args.activity_code:
+            parser.error("测量 CPU 需要 --activity-code")
+        bench_cpu(args)
+
+
+if __name__ == "__main__":
+    main()
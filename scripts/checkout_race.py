@@ -0,0 +1,108 @@
+"""
+签退并发测试：多台设备同时签退同一条签到记录时，只能有一次生效
+
+    python scripts/checkout_race.py --admin-id 1 --devices 16 --rounds 20
+
+每一轮在该管理员 (租户) 所在分片上创建临时活动、学生和一条未签退的签到记录，
+用 --devices 个线程 (各自独立连接) 在同一时刻调用 db_utils.checkout_check_log，检查：
+- 恰好一个线程返回 True
+- 数据库中的签退坐标等于获胜线程提交的坐标 (没有被后来者覆盖)
+- 之后的重试返回 False 且记录不变
+结束后删除临时数据。需要项目根目录下的 .env 能连接到本地数据库。
+"""
+
+import argparse
+import os
+import sys
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+from app import db_utils  # noqa: E402
+from app.models import ActivityCreate  # noqa: E402
+
+
+def setup_round(admin_id: int) -> tuple:
+    now = datetime.now()
+    student_id = f"RACE{uuid.uuid4().hex[:10]}"
+    with db_utils.get_tenant_connection(admin_id) as db:
+        code = db_utils.db_create_activity(db, ActivityCreate(
+            name="签退并发测试", location_name="测试", latitude=30.0, longitude=114.0, radius_meters=100,
+            start_time=now - timedelta(minutes=5), end_time=now + timedelta(hours=1),
+        ), admin_id)
+        activity = db_utils.get_activity_by_code(db, code)
+        participant_id = db_utils.register_student_with_email(
+            db, student_id, "并发测试", f"{student_id.lower()}@race.invalid", admin_id)
+        db_utils.create_check_log(db, activity['id'], participant_id, 30.0, 114.0)
+    return code, activity['id'], participant_id, student_id
+
+
+def cleanup_round(admin_id: int, activity_id: int, participant_id: int):
+    with db_utils.get_tenant_connection(admin_id) as db:
+        db_utils.db_delete_activity(db, activity_id)
+        cursor = db.cursor()
+        cursor.execute("DELETE FROM participants WHERE id = %s", (participant_id,))
+        db.commit()
+        cursor.close()
+
+
+def race(admin_id: int, devices: int) -> list:
+    code, activity_id, participant_id, student_id = setup_round(admin_id)
+    errors = []
+    try:
+        barrier = threading.Barrier(devices)
+        results = [None] * devices
+
+        def device(i: int):
+            # 每台设备提交不同的坐标，便于确认最终写入的是哪一次
+            lat, lon = 30.0 + i * 1e-5, 114.0 + i * 1e-5
+            with db_utils.get_tenant_connection(admin_id) as db:
+                barrier.wait()
+                results[i] = (db_utils.checkout_check_log(db, student_id, admin_id, code, lat, lon, datetime.now()),
+                              lat, lon)
+
+        threads = [threading.Thread(target=device, args=(i,)) for i in range(devices)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        winners = [r for r in results if r and r[0]]
+        if len(winners) != 1:
+            errors.append(f"{len(winners)} 个设备签退成功 (应为 1)")
+        with db_utils.get_tenant_connection(admin_id) as db:
+            log = db_utils.get_check_log(db, participant_id, activity_id)
+            _, lat, lon = winners[0] if winners else (None, None, None)
+            if winners and (abs(float(log['check_out_lat']) - lat) > 1e-7 or abs(float(log['check_out_lon']) - lon) > 1e-7):
+                errors.append("签退坐标被后到的请求覆盖")
+            if db_utils.checkout_check_log(db, student_id, admin_id, code, 0.0, 0.0, datetime.now()):
+                errors.append("重试再次签退成功")
+            if db_utils.get_check_log(db, participant_id, activity_id)['check_out_time'] != log['check_out_time']:
+                errors.append("重试修改了签退时间")
+    finally:
+        cleanup_round(admin_id, activity_id, participant_id)
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="签退并发测试")
+    parser.add_argument("--admin-id", type=int, required=True, help="用于创建临时数据的管理员 ID")
+    parser.add_argument("--devices", type=int, default=16, help="同时签退的设备数")
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    failed = 0
+    for i in range(args.rounds):
+        errors = race(args.admin_id, args.devices)
+        if errors:
+            failed += 1
+            print(f"第 {i + 1} 轮失败: {'; '.join(errors)}")
+    print(f"{args.rounds} 轮中 {failed} 轮失败 (每轮 {args.devices} 台设备并发签退)")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+"""
+活动开场签到高峰压测
+
+    # 1. 用本地数据库和脚本内置的 SMTP 收信端启动服务 (--proxy-headers 让限流按 X-Forwarded-For 区分学生)
+    SMTP_SERVER=127.0.0.1 SMTP_PORT=1025 SMTP_USE_SSL=false SMTP_PASSWORD= \\
+        uvicorn app.main:app --port 8000 --workers 4 --proxy-headers --forwarded-allow-ips 127.0.0.1
+    # 2. 压测 (管理员账号用 app/create_admin.py 创建)
+    python scripts/loadtest.py --admin-user loadtest --admin-password secret --students 500 --concurrency 100
+    python scripts/loadtest.py ... --save-baseline      # 记录基线
+    python scripts/loadtest.py ... --baseline scripts/loadtest_baseline.json  # 与基线比较，退化时非零退出
+
+场景：管理员创建一个正在进行的活动；每个学生 (独立的邮箱、学号与来源 IP) 依次
+send-code -> 从本地 SMTP 收信端取验证码 -> login -> status -> checkin-auth -> checkout-auth，
+签到/签退坐标在活动中心附近随机抖动；同时若干管理员轮询签到日志并定期导出 Excel。
+结束后删除压测活动 (级联删除签到记录)。输出各接口的吞吐、p50/p95/p99 与错误分布。
+"""
+
+import argparse
+import asyncio
+import email
+import http.client
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "loadtest_baseline.json")
+CODE_PATTERN = re.compile(r'class="verification-code">\s*(\d{6})')
+# 压测前后的准备/清理请求，不计入报告与基线
+SETUP_ENDPOINTS = {"admin-login", "admin-create", "admin-delete"}
+
+
+# --- 本地 SMTP 收信端 ---
+class SmtpSink:
+    """只实现 smtplib 用到的命令；收到验证码邮件后按收件人保存验证码"""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.received = 0
+        self._codes = {}
+        self._cond = threading.Condition()
+        self._loop = None
+
+    def wait_code(self, address: str, timeout: float) -> str:
+        with self._cond:
+            self._cond.wait_for(lambda: address in self._codes, timeout)
+            return self._codes.pop(address, None)
+
+    def _deliver(self, recipients: list, data: bytes):
+        message = email.message_from_bytes(data)
+        body = message.get_payload(decode=True) or b""
+        match = CODE_PATTERN.search(body.decode("utf-8", "replace"))
+        with self._cond:
+            self.received += 1
+            if match:
+                for address in recipients:
+                    self._codes[address] = match.group(1)
+                self._cond.notify_all()
+
+    async def _session(self, reader, writer):
+        def reply(line: str):
+            writer.write(line.encode() + b"\r\n")
+
+        reply("220 loadtest-sink ESMTP")
+        recipients = []
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode("utf-8", "replace").strip()
+                verb = command[:4].upper()
+                if verb == "EHLO":
+                    reply("250-loadtest-sink")
+                    reply("250 8BITMIME")
+                elif verb in ("HELO", "NOOP", "RSET"):
+                    if verb == "RSET":
+                        recipients = []
+                    reply("250 OK")
+                elif verb == "MAIL":
+                    recipients = []
+                    reply("250 OK")
+                elif verb == "RCPT":
+                    recipients.append(command.split(":", 1)[1].strip().strip("<>"))
+                    reply("250 OK")
+                elif verb == "DATA":
+                    reply("354 End data with <CR><LF>.<CR><LF>")
+                    await writer.drain()
+                    lines = []
+                    while True:
+                        data_line = await reader.readline()
+                        if data_line in (b".\r\n", b".\n", b""):
+                            break
+                        lines.append(data_line[1:] if data_line.startswith(b"..") else data_line)
+                    self._deliver(recipients, b"".join(lines))
+                    reply("250 OK")
+                elif verb == "QUIT":
+                    reply("221 Bye")
+                    break
+                else:
+                    reply("502 Command not implemented")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    def start(self):
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            server = self._loop.run_until_complete(asyncio.start_server(self._session, self.host, self.port))
+            ready.set()
+            self._loop.run_forever()
+            server.close()
+
+        threading.Thread(target=run, name="smtp-sink", daemon=True).start()
+        if not ready.wait(5):
+            raise RuntimeError("SMTP 收信端启动失败")
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+# --- HTTP 客户端与统计 ---
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+
+    def record(self, endpoint: str, seconds: float, error: str = None):
+        with self._lock:
+            self.latencies[endpoint].append(seconds * 1000)
+            if error:
+                self.errors[(endpoint, error)] += 1
+
+
+class Client:
+    """每个线程一个 keep-alive 连接"""
+
+    def __init__(self, base_url: str, stats: Stats):
+        url = urlparse(base_url)
+        self.host, self.port = url.hostname, url.port or 80
+        self.prefix = url.path.rstrip("/")
+        self.stats = stats
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        return conn
+
+    def request(self, endpoint: str, method: str, path: str, body: dict = None, token: str = None, ip: str = None):
+        headers = {"Content-Type": "application/json"}
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        if ip:
+            headers["X-Forwarded-For"] = ip
+        payload = json.dumps(body).encode() if body is not None else None
+        start = time.perf_counter()
+        try:
+            conn = self._connection()
+            conn.request(method, self.prefix + path, body=payload, headers=headers)
+            response = conn.getresponse()
+            raw = response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException) as e:
+            self._local.conn = None
+            self.stats.record(endpoint, time.perf_counter() - start, type(e).__name__)
+            return None, None
+        elapsed = time.perf_counter() - start
+
+        data = None
+        if raw and response.getheader("Content-Type", "").startswith("application/json"):
+            data = json.loads(raw)
+        error = None
+        if status >= 400:
+            error = f"{status} {data.get('detail') if isinstance(data, dict) else ''}".strip()
+        elif isinstance(data, dict) and "detail" in data:
+            # 签到/签退的业务失败以 200 + detail 返回
+            error = f"{status} {data['detail']}"
+        self.stats.record(endpoint, elapsed, error)
+        return status, data
+
+
+def jitter(lat: float, lon: float, meters: float) -> tuple:
+    """在中心点 meters 米范围内随机取点"""
+    distance = meters * math.sqrt(random.random())
+    angle = random.uniform(0, 2 * math.pi)
+    d_lat = distance * math.cos(angle) / 111320
+    d_lon = distance * math.sin(angle) / (111320 * math.cos(math.radians(lat)))
+    return lat + d_lat, lon + d_lon
+
+
+# --- 场景 ---
+def student_flow(client: Client, sink: SmtpSink, args, activity: dict, run_id: str, index: int):
+    address = f"lt-{run_id}-{index}@loadtest.invalid"
+    n = index + 1
+    ip = f"10.{(n >> 16) & 255}.{(n >> 8) & 255}.{n & 255}"
+    status, _ = client.request("send-code", "POST", "/api/participant/send-code", {"email": address}, ip=ip)
+    if status != 200:
+        return
+    code = sink.wait_code(address, args.code_timeout)
+    if code is None:
+        client.stats.record("send-code", 0, "验证码邮件未送达")
+        return
+    status, data = client.request("login", "POST", "/api/participant/login", {
+        "email": address, "code": code, "activity_code": activity["unique_code"],
+        "student_id": f"LT{run_id}{index:06d}", "name": f"压测学生{index}",
+    }, ip=ip)
+    if status != 200:
+        return
+    token = data["access_token"]
+    client.request("status", "GET", "/api/participant/status", token=token, ip=ip)
+
+    lat, lon = jitter(activity["latitude"], activity["longitude"], activity["radius_meters"] * 0.5)
+    status, data = client.request("checkin-auth", "POST", "/api/participant/checkin-auth", {
+        "activity_code": activity["unique_code"], "latitude": lat, "longitude": lon,
+    }, token=token, ip=ip)
+    if status != 200 or "device_session_token" not in (data or {}):
+        return
+    time.sleep(random.uniform(0, args.dwell))
+    lat, lon = jitter(activity["latitude"], activity["longitude"], activity["radius_meters"] * 0.5)
+    client.request("checkout-auth", "POST", "/api/participant/checkout-auth", {
+        "activity_code": activity["unique_code"], "latitude": lat, "longitude": lon,
+    }, token=token, ip=ip)
+
+
+def admin_poller(client: Client, args, token: str, code: str, stop: threading.Event):
+    polls = 0
+    while not stop.is_set():
+        client.request("admin-logs", "GET", f"/api/admin/activities/{code}/logs", token=token)
+        polls += 1
+        if polls % args.export_every == 0:
+            client.request("admin-export", "GET", f"/api/admin/activities/{code}/export", token=token)
+        stop.wait(args.poll_interval)
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * p / 100
+    low, high = math.floor(k), math.ceil(k)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (k - low)
+
+
+def summarize(stats: Stats, wall_seconds: float) -> dict:
+    endpoints = {}
+    for endpoint, values in sorted(stats.latencies.items()):
+        if endpoint in SETUP_ENDPOINTS:
+            continue
+        values = sorted(values)
+        errors = sum(n for (ep, _), n in stats.errors.items() if ep == endpoint)
+        endpoints[endpoint] = {
+            "count": len(values),
+            "rps": round(len(values) / wall_seconds, 2),
+            "p50_ms": round(percentile(values, 50), 1),
+            "p95_ms": round(percentile(values, 95), 1),
+            "p99_ms": round(percentile(values, 99), 1),
+            "error_rate": round(errors / len(values), 4),
+        }
+    total = sum(e["count"] for e in endpoints.values())
+    return {"throughput_rps": round(total / wall_seconds, 2), "endpoints": endpoints}
+
+
+def print_report(summary: dict, stats: Stats, wall_seconds: float):
+    print(f"\n{'endpoint':<15} {'count':>7} {'rps':>8} {'p50(ms)':>9} {'p95(ms)':>9} {'p99(ms)':>9} {'errors':>8}")
+    for endpoint, e in summary["endpoints"].items():
+        print(f"{endpoint:<15} {e['count']:>7} {e['rps']:>8.1f} {e['p50_ms']:>9.1f} {e['p95_ms']:>9.1f} "
+              f"{e['p99_ms']:>9.1f} {e['error_rate']:>8.2%}")
+    print(f"\n总计 {summary['throughput_rps']:.1f} 请求/秒，耗时 {wall_seconds:.1f} 秒")
+    if stats.errors:
+        print("\n错误分布:")
+        for (endpoint, error), count in stats.errors.most_common(20):
+            if endpoint in SETUP_ENDPOINTS:
+                continue
+            print(f"{count:>7}  {endpoint:<15} {error}")
+
+
+def compare_baseline(summary: dict, baseline: dict, tolerance: float) -> list:
+    """返回退化项列表：p95 变慢超过 tolerance、错误率上升超过 1 个百分点、总吞吐下降超过 tolerance"""
+    regressions = []
+    if summary["throughput_rps"] < baseline["throughput_rps"] * (1 - tolerance):
+        regressions.append(f"吞吐 {summary['throughput_rps']} < 基线 {baseline['throughput_rps']}")
+    for endpoint, base in baseline["endpoints"].items():
+        current = summary["endpoints"].get(endpoint)
+        if current is None:
+            regressions.append(f"{endpoint}: 本次没有请求")
+            continue
+        if current["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{endpoint}: p95 {current['p95_ms']} ms > 基线 {base['p95_ms']} ms")
+        if current["error_rate"] > base["error_rate"] + 0.01:
+            regressions.append(f"{endpoint}: 错误率 {current['error_rate']:.2%} > 基线 {base['error_rate']:.2%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="签到高峰压测")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000", help="服务地址 (不含 /students_system 前缀)")
+    parser.add_argument("--admin-user", required=True)
+    parser.add_argument("--admin-password", required=True)
+    parser.add_argument("--students", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50, help="同时进行的学生数")
+    parser.add_argument("--admins", type=int, default=2, help="轮询签到日志的管理员数")
+    parser.add_argument("--poll-interval", type=float, default=2.0)
+    parser.add_argument("--export-every", type=int, default=5, help="每轮询多少次导出一次 Excel")
+    parser.add_argument("--dwell", type=float, default=1.0, help="签到后到签退前的最长停留秒数")
+    parser.add_argument("--lat", type=float, default=30.5155, help="活动中心纬度 (GCJ02)")
+    parser.add_argument("--lon", type=float, default=114.4185, help="活动中心经度 (GCJ02)")
+    parser.add_argument("--radius", type=int, default=200)
+    parser.add_argument("--smtp-host", default="127.0.0.1")
+    parser.add_argument("--smtp-port", type=int, default=1025)
+    parser.add_argument("--code-timeout", type=float, default=30.0)
+    parser.add_argument("--baseline", help="与该基线文件比较，退化时以非零状态码退出")
+    parser.add_argument("--save-baseline", nargs="?", const=DEFAULT_BASELINE, help="把本次结果写为基线")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的 p95/吞吐退化比例")
+    parser.add_argument("--keep", action="store_true", help="结束后保留压测活动")
+    args = parser.parse_args()
+
+    sink = SmtpSink(args.smtp_host, args.smtp_port)
+    sink.start()
+    stats = Stats()
+    client = Client(args.base_url, stats)
+    run_id = uuid.uuid4().hex[:6]
+
+    status, data = client.request("admin-login", "POST", "/api/admin/login",
+                                  {"username": args.admin_user, "password": args.admin_password})
+    if status != 200:
+        print(f"管理员登录失败: {status} {data}")
+        sys.exit(1)
+    admin_token = data["access_token"]
+    now = datetime.now()
+    status, activity = client.request("admin-create", "POST", "/api/admin/activities", {
+        "name": f"压测活动 {run_id}", "location_name": "压测地点",
+        "latitude": args.lat, "longitude": args.lon, "radius_meters": args.radius,
+        "start_time": (now - timedelta(minutes=5)).isoformat(),
+        "end_time": (now + timedelta(hours=2)).isoformat(),
+    }, token=admin_token)
+    if status != 200:
+        print(f"创建压测活动失败: {status} {activity}")
+        sys.exit(1)
+    print(f"压测活动 {activity['unique_code']}，{args.students} 名学生，并发 {args.concurrency}")
+
+    stop = threading.Event()
+    pollers = [threading.Thread(target=admin_poller, args=(client, args, admin_token, activity["unique_code"], stop),
+                                daemon=True) for _ in range(args.admins)]
+    started = time.perf_counter()
+    for poller in pollers:
+        poller.start()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for i in range(args.students):
+            pool.submit(student_flow, client, sink, args, activity, run_id, i)
+    stop.set()
+    for poller in pollers:
+        poller.join()
+    wall_seconds = time.perf_counter() - started
+
+    if not args.keep:
+        client.request("admin-delete", "DELETE", f"/api/admin/activities/{activity['unique_code']}", token=admin_token)
+    sink.stop()
+
+    summary = summarize(stats, wall_seconds)
+    print_report(summary, stats, wall_seconds)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"\n基线已写入 {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare_baseline(summary, json.load(f), args.tolerance)
+        if regressions:
+            print("\n相对基线退化:")
+            for item in regressions:
+                print(f"  {item}")
+            sys.exit(1)
+        print("\n未发现相对基线的退化")
+
+
+if __name__ == "__main__":
+    main()
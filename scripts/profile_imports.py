@@ -0,0 +1,81 @@
+"""
+启动耗时分析与预算检查
+
+    python scripts/profile_imports.py                  # 列出导入 app.main 最耗时的模块
+    python scripts/profile_imports.py --budget-ms 800  # 冷启动超出预算时以非零状态码退出 (用于 CI)
+
+每次测量都在全新的子进程中导入 app.main (冷启动)，取多次运行的中位数。
+预算也可以通过环境变量 STARTUP_BUDGET_MS 设置。
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TARGET_MODULE = "app.main"
+
+MEASURE_SNIPPET = (
+    "import time; t = time.perf_counter(); "
+    f"import {TARGET_MODULE}; "
+    "print((time.perf_counter() - t) * 1000)"
+)
+
+
+def measure_cold_import_ms(runs: int) -> list:
+    """在新进程中导入目标模块 runs 次，返回每次的耗时 (毫秒)"""
+    timings = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", MEASURE_SNIPPET],
+            cwd=PROJECT_ROOT, capture_output=True, text=True, check=True
+        )
+        timings.append(float(out.stdout.strip().splitlines()[-1]))
+    return timings
+
+
+def import_time_table() -> list:
+    """解析 python -X importtime 的输出，返回 [(self_us, cumulative_us, module), ...]"""
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {TARGET_MODULE}"],
+        cwd=PROJECT_ROOT, capture_output=True, text=True, check=True
+    )
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        try:
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            rows.append((int(self_us), int(cumulative_us), name.rstrip()))
+        except ValueError:
+            continue
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="app.main 导入耗时分析")
+    parser.add_argument("--top", type=int, default=20, help="显示最耗时的前 N 个模块")
+    parser.add_argument("--runs", type=int, default=5, help="冷启动测量次数")
+    parser.add_argument("--budget-ms", type=float, default=float(os.environ.get("STARTUP_BUDGET_MS", 0)),
+                        help="冷启动预算 (毫秒)，超出则返回非零状态码；0 表示不检查")
+    args = parser.parse_args()
+
+    rows = import_time_table()
+    print(f"{'cumulative(ms)':>15} {'self(ms)':>10}  module")
+    for self_us, cumulative_us, name in sorted(rows, key=lambda r: r[1], reverse=True)[:args.top]:
+        print(f"{cumulative_us / 1000:>15.1f} {self_us / 1000:>10.1f}  {name}")
+
+    timings = measure_cold_import_ms(args.runs)
+    median = statistics.median(timings)
+    print(f"\n冷启动导入 {TARGET_MODULE}: 中位数 {median:.1f} ms "
+          f"(最小 {min(timings):.1f} ms，最大 {max(timings):.1f} ms，共 {len(timings)} 次)")
+
+    if args.budget_ms and median > args.budget_ms:
+        print(f"超出启动预算 {args.budget_ms:.0f} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+"""
+长时间稳定性 (浸泡) 测试：持续混合流量下跟踪 worker 的内存增长
+
+    # 1. 单 worker 启动服务并开启 tracemalloc (内存快照按 worker 统计)，SMTP 指向脚本内置的收信端
+    PYTHONTRACEMALLOC=1 PROFILING_ADMINS=soak SMTP_SERVER=127.0.0.1 SMTP_PORT=1025 SMTP_USE_SSL=false SMTP_PASSWORD= \\
+        uvicorn app.main:app --port 8000 --workers 1 --proxy-headers --forwarded-allow-ips 127.0.0.1
+    # 2. 运行 (管理员须在 PROFILING_ADMINS 中)
+    python scripts/soak.py --admin-user soak --admin-password secret --hours 8 --students-per-minute 120
+
+流量：每个学生都是新的邮箱、学号和来源 IP (覆盖限流器的按 IP 状态)，完成
+send-code -> login -> status -> 活动详情 -> checkin-auth -> 历史 -> checkout-auth；
+活动每 --activity-minutes 分钟轮换一次 (新活动码覆盖活动缓存、二维码、详情缓存)，
+轮换时对旧活动做导出、位置分布、签到日志查询后删除。
+每 --sample-interval 秒通过 GET /api/admin/profiling/memory 采样 RSS、tracemalloc、
+文件描述符、套接字与进程内缓存条目数。预热期之后对 RSS 与 tracemalloc 做最小二乘拟合，
+斜率超过 --max-rss-slope / --max-traced-slope (MB/小时) 或描述符持续增长时以非零状态码退出，
+并列出增长最多的分配位置。
+"""
+
+import argparse
+import csv
+import itertools
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from loadtest import Client, SmtpSink, Stats, jitter, percentile  # noqa: E402
+
+MB = 1024 * 1024
+
+
+class Admin:
+    """管理员请求；访问令牌过期时重新登录"""
+
+    def __init__(self, client: Client, username: str, password: str):
+        self.client = client
+        self.username = username
+        self.password = password
+        self.token = None
+        self._lock = threading.Lock()
+
+    def login(self):
+        status, data = self.client.request("admin-login", "POST", "/api/admin/login",
+                                           {"username": self.username, "password": self.password})
+        if status != 200:
+            raise RuntimeError(f"管理员登录失败: {status} {data}")
+        self.token = data["access_token"]
+
+    def request(self, endpoint: str, method: str, path: str, body: dict = None):
+        status, data = self.client.request(endpoint, method, path, body, token=self.token)
+        if status == 401:
+            with self._lock:
+                self.login()
+            status, data = self.client.request(endpoint, method, path, body, token=self.token)
+        return status, data
+
+
+class Activities:
+    """定期轮换的活动；学生总是签到当前活动"""
+
+    def __init__(self, admin: Admin, args, run_id: str):
+        self.admin = admin
+        self.args = args
+        self.run_id = run_id
+        self.current = None
+        self.previous = []
+        self._seq = itertools.count(1)
+
+    def rotate(self):
+        now = datetime.now()
+        status, activity = self.admin.request("admin-create", "POST", "/api/admin/activities", {
+            "name": f"浸泡测试 {self.run_id}-{next(self._seq)}", "location_name": "浸泡测试地点",
+            "latitude": self.args.lat, "longitude": self.args.lon, "radius_meters": self.args.radius,
+            "start_time": (now - timedelta(minutes=5)).isoformat(),
+            "end_time": (now + timedelta(minutes=self.args.activity_minutes * 2)).isoformat(),
+        })
+        if status != 200:
+            raise RuntimeError(f"创建活动失败: {status} {activity}")
+        if self.current is not None:
+            self.previous.append(self.current)
+        self.current = activity
+        # 上一轮的活动在其学生签退后再退役
+        while len(self.previous) > 1:
+            self.retire(self.previous.pop(0))
+
+    def retire(self, activity: dict):
+        code = activity["unique_code"]
+        self.admin.request("admin-logs", "GET", f"/api/admin/activities/{code}/logs")
+        self.admin.request("admin-heatmap", "GET", f"/api/admin/activities/{code}/heatmap?zoom=17")
+        status, job = self.admin.request("admin-export", "POST", f"/api/admin/activities/{code}/exports?format=xlsx")
+        deadline = time.monotonic() + 60
+        while status == 200 and job.get("status") == "running" and time.monotonic() < deadline:
+            time.sleep(1)
+            status, job = self.admin.request("admin-export-status", "GET", f"/api/admin/exports/{job['job_id']}")
+        if status == 200 and job.get("status") == "done":
+            self.admin.request("admin-export-download", "GET", f"/api/admin/exports/{job['job_id']}/download")
+        self.admin.request("admin-delete", "DELETE", f"/api/admin/activities/{code}")
+
+    def retire_all(self):
+        for activity in self.previous + ([self.current] if self.current else []):
+            self.retire(activity)
+        self.previous, self.current = [], None
+
+
+def student_flow(client: Client, sink: SmtpSink, args, activity: dict, run_id: str, index: int):
+    address = f"soak-{run_id}-{index}@soak.invalid"
+    n = index + 1
+    ip = f"10.{(n >> 16) & 255}.{(n >> 8) & 255}.{n & 255}"
+    code = activity["unique_code"]
+    status, _ = client.request("send-code", "POST", "/api/participant/send-code", {"email": address}, ip=ip)
+    if status != 200:
+        return
+    verification = sink.wait_code(address, args.code_timeout)
+    if verification is None:
+        client.stats.record("send-code", 0, "验证码邮件未送达")
+        return
+    status, data = client.request("login", "POST", "/api/participant/login", {
+        "email": address, "code": verification, "activity_code": code,
+        "student_id": f"SK{run_id}{index:07d}", "name": f"浸泡学生{index}",
+    }, ip=ip)
+    if status != 200:
+        return
+    token = data["access_token"]
+    client.request("status", "GET", "/api/participant/status", token=token, ip=ip)
+    client.request("activity", "GET", f"/api/participant/activity/{code}", ip=ip)
+
+    lat, lon = jitter(activity["latitude"], activity["longitude"], activity["radius_meters"] * 0.5)
+    status, data = client.request("checkin-auth", "POST", "/api/participant/checkin-auth", {
+        "activity_code": code, "latitude": lat, "longitude": lon,
+    }, token=token, ip=ip)
+    if status != 200 or "device_session_token" not in (data or {}):
+        return
+    client.request("history", "GET", "/api/participant/history", token=token, ip=ip)
+    time.sleep(args.dwell)
+    lat, lon = jitter(activity["latitude"], activity["longitude"], activity["radius_meters"] * 0.5)
+    client.request("checkout-auth", "POST", "/api/participant/checkout-auth", {
+        "activity_code": code, "latitude": lat, "longitude": lon,
+    }, token=token, ip=ip)
+
+
+def slope_per_hour(points: list) -> float:
+    """最小二乘拟合 [(小时, 值), ...] 的斜率"""
+    if len(points) < 3:
+        return 0.0
+    n = len(points)
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    if var_x == 0:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x
+
+
+def top_growth(first: dict, last: dict, limit: int = 10) -> list:
+    """两次 tracemalloc 快照之间增长最多的分配位置"""
+    if not first or not last:
+        return []
+    before = {item["where"]: item["size_bytes"] for item in first["top"]}
+    growth = [(item["size_bytes"] - before.get(item["where"], 0), item["where"]) for item in last["top"]]
+    return sorted((g for g in growth if g[0] > 0), reverse=True)[:limit]
+
+
+def interval_summary(stats: Stats) -> str:
+    values = sorted(v for endpoint, vs in stats.latencies.items() if endpoint.startswith(("checkin", "checkout"))
+                    for v in vs)
+    requests = sum(len(vs) for vs in stats.latencies.values())
+    errors = sum(stats.errors.values())
+    return f"req {requests:>6}  err {errors:>4}  签到/签退 p95 {percentile(values, 95):>7.1f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="长时间稳定性测试 (内存增长跟踪)")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000", help="服务地址 (不含 /students_system 前缀)")
+    parser.add_argument("--admin-user", required=True, help="须在服务端 PROFILING_ADMINS 中")
+    parser.add_argument("--admin-password", required=True)
+    parser.add_argument("--hours", type=float, default=4.0)
+    parser.add_argument("--students-per-minute", type=float, default=120)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--activity-minutes", type=float, default=10, help="每隔多久换一个新活动")
+    parser.add_argument("--dwell", type=float, default=1.0, help="签到后到签退前的停留秒数")
+    parser.add_argument("--sample-interval", type=float, default=60, help="内存采样间隔 (秒)")
+    parser.add_argument("--warmup-minutes", type=float, default=15, help="预热期内的样本不参与拟合")
+    parser.add_argument("--max-rss-slope", type=float, default=5.0, help="允许的 RSS 增长 (MB/小时)")
+    parser.add_argument("--max-traced-slope", type=float, default=2.0, help="允许的 tracemalloc 增长 (MB/小时)")
+    parser.add_argument("--max-fd-growth", type=int, default=20, help="预热后允许增加的文件描述符数")
+    parser.add_argument("--samples-csv", default="soak_samples.csv", help="采样结果写入的 CSV")
+    parser.add_argument("--lat", type=float, default=30.5155, help="活动中心纬度 (GCJ02)")
+    parser.add_argument("--lon", type=float, default=114.4185, help="活动中心经度 (GCJ02)")
+    parser.add_argument("--radius", type=int, default=200)
+    parser.add_argument("--smtp-host", default="127.0.0.1")
+    parser.add_argument("--smtp-port", type=int, default=1025)
+    parser.add_argument("--code-timeout", type=float, default=30.0)
+    args = parser.parse_args()
+
+    sink = SmtpSink(args.smtp_host, args.smtp_port)
+    sink.start()
+    client = Client(args.base_url, Stats())
+    run_id = uuid.uuid4().hex[:6]
+    admin = Admin(client, args.admin_user, args.admin_password)
+    admin.login()
+    status, probe = admin.request("memory", "GET", "/api/admin/profiling/memory")
+    if status != 200:
+        print(f"无法读取内存快照 (管理员是否在 PROFILING_ADMINS 中?): {status} {probe}")
+        sys.exit(1)
+    if probe["tracemalloc"] is None:
+        print("服务端未开启 tracemalloc，只跟踪 RSS (启动时设置 PYTHONTRACEMALLOC=1 可定位分配热点)")
+
+    activities = Activities(admin, args, run_id)
+    activities.rotate()
+    stop = threading.Event()
+    samples = []
+    csv_file = open(args.samples_csv, "w", newline="", encoding="utf-8")
+    writer = csv.writer(csv_file)
+    size_keys = sorted(probe["sizes"])
+    writer.writerow(["hours", "pid", "rss_mb", "traced_mb", "open_fds", "sockets", "threads", "gc_objects"] + size_keys)
+
+    def sampler():
+        started = time.monotonic()
+        next_rotation = started + args.activity_minutes * 60
+        while not stop.wait(args.sample_interval):
+            now = time.monotonic()
+            if now >= next_rotation:
+                activities.rotate()
+                next_rotation = now + args.activity_minutes * 60
+            status, snap = admin.request("memory", "GET", "/api/admin/profiling/memory?top=50")
+            if status != 200:
+                continue
+            hours = (now - started) / 3600
+            traced = snap["tracemalloc"]["current_bytes"] / MB if snap["tracemalloc"] else None
+            samples.append((hours, snap))
+            writer.writerow([round(hours, 4), snap["pid"], round(snap["rss_bytes"] / MB, 2),
+                             round(traced, 2) if traced is not None else "", snap["open_fds"], snap["sockets"],
+                             snap["threads"], snap["gc_objects"]] + [snap["sizes"].get(k) for k in size_keys])
+            csv_file.flush()
+            # 每个采样区间单独统计延迟，便于观察长时间运行后的退化
+            interval_stats, client.stats = client.stats, Stats()
+            traced_text = f"{traced:8.1f}" if traced is not None else "       -"
+            print(f"{hours:6.2f}h  pid {snap['pid']}  RSS {snap['rss_bytes'] / MB:8.1f} MB  traced {traced_text} MB  "
+                  f"fds {snap['open_fds']}  {interval_summary(interval_stats)}", flush=True)
+
+    sampler_thread = threading.Thread(target=sampler, name="soak-sampler", daemon=True)
+    sampler_thread.start()
+
+    deadline = time.monotonic() + args.hours * 3600
+    gap = 60 / args.students_per_minute
+    index = itertools.count()
+    next_start = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            while time.monotonic() < deadline:
+                pool.submit(student_flow, client, sink, args, activities.current, run_id, next(index))
+                next_start += gap
+                time.sleep(max(0.0, next_start - time.monotonic()))
+    except KeyboardInterrupt:
+        print("\n提前结束")
+    stop.set()
+    sampler_thread.join()
+    activities.retire_all()
+    sink.stop()
+    csv_file.close()
+
+    # --- 判定 ---
+    steady = [(h, s) for h, s in samples if h * 60 >= args.warmup_minutes]
+    print(f"\n共 {len(samples)} 个样本，预热后 {len(steady)} 个，已写入 {args.samples_csv}")
+    if len(steady) < 3:
+        print("预热后样本不足，无法判断内存趋势 (延长 --hours 或缩短 --sample-interval)")
+        sys.exit(1)
+    pids = {s["pid"] for _, s in steady}
+    if len(pids) > 1:
+        print(f"警告：样本来自多个 worker {sorted(pids)}，请用 --workers 1 启动服务")
+
+    failures = []
+    rss_slope = slope_per_hour([(h, s["rss_bytes"] / MB) for h, s in steady])
+    print(f"RSS 增长 {rss_slope:+.2f} MB/小时 (上限 {args.max_rss_slope})")
+    if rss_slope > args.max_rss_slope:
+        failures.append(f"RSS 增长 {rss_slope:.2f} MB/小时")
+    if steady[0][1]["tracemalloc"] and steady[-1][1]["tracemalloc"]:
+        traced_slope = slope_per_hour([(h, s["tracemalloc"]["current_bytes"] / MB) for h, s in steady
+                                       if s["tracemalloc"]])
+        print(f"tracemalloc 增长 {traced_slope:+.2f} MB/小时 (上限 {args.max_traced_slope})")
+        if traced_slope > args.max_traced_slope:
+            failures.append(f"tracemalloc 增长 {traced_slope:.2f} MB/小时")
+    fd_growth = (steady[-1][1]["open_fds"] or 0) - (steady[0][1]["open_fds"] or 0)
+    print(f"文件描述符 {steady[0][1]['open_fds']} -> {steady[-1][1]['open_fds']} (套接字 "
+          f"{steady[0][1]['sockets']} -> {steady[-1][1]['sockets']})")
+    if fd_growth > args.max_fd_growth:
+        failures.append(f"文件描述符增加 {fd_growth}")
+    print("进程内结构条目数: " + ", ".join(
+        f"{k} {steady[0][1]['sizes'].get(k)} -> {steady[-1][1]['sizes'].get(k)}" for k in size_keys))
+
+    growth = top_growth(steady[0][1]["tracemalloc"], steady[-1][1]["tracemalloc"])
+    if growth:
+        print("\n预热后增长最多的分配位置:")
+        for size, where in growth:
+            print(f"  {size / 1024:>10.1f} KiB  {where}")
+
+    if failures:
+        print("\n疑似内存泄漏: " + "; ".join(failures))
+        sys.exit(1)
+    print("\n未发现持续的内存增长")
+
+
+if __name__ == "__main__":
+    main()